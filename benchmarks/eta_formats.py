@@ -0,0 +1,146 @@
+'''Compare the default ETA dicts with the compact records, for each transport.
+
+Parses a synthetic upstream response of each transport many times, and reports the
+time per parse and the memory allocated for the results, which are kept alive as an
+aggregator would between two polls.
+
+Usage:
+    python benchmarks/eta_formats.py [--results N]
+'''
+import argparse
+import importlib
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1].joinpath('src')))
+
+NOW = datetime(2024, 1, 1, 8, 0, 0)
+
+
+def _iso(minutes: float, sep: str = 'T', offset: str = '+08:00') -> str:
+    return (NOW + timedelta(minutes=minutes)).isoformat(sep=sep, timespec='seconds') + offset
+
+
+def _kmb() -> dict:
+    return {
+        'generated_timestamp': _iso(0),
+        'data': [{
+            'dir': bound,
+            'service_type': 1,
+            'eta': _iso(minutes),
+            'dest_tc': '竹園邨', 'dest_en': 'CHUK YUEN ESTATE',
+            'rmk_tc': '', 'rmk_en': '',
+        } for bound in ('O', 'I') for minutes in (2, 9, 17)]
+    }
+
+
+def _ctb() -> dict:
+    return _kmb()
+
+
+def _nlb() -> dict:
+    return {'estimatedArrivals': [{
+        'estimatedArrivalTime': _iso(minutes, ' ', ''),
+        'routeVariantName': None,
+        'departed': '1',
+        'noGPS': '0',
+    } for minutes in (3, 12, 25)]}
+
+
+def _mtr() -> dict:
+    return {
+        'status': 1,
+        'curr_time': _iso(0, ' ', ''),
+        'data': {'TWL-TSW': {bound: [{
+            'time': _iso(minutes, ' ', ''),
+            'dest': 'CEN',
+            'plat': '1',
+        } for minutes in (1, 4, 7, 10)] for bound in ('UP', 'DOWN')}}
+    }
+
+
+def _lrt() -> dict:
+    return {
+        'status': 1,
+        'system_time': _iso(0, ' ', ''),
+        'platform_list': [{
+            'platform_id': platform,
+            'route_list': [{
+                'route_no': route,
+                'dest_ch': '屯門碼頭', 'dest_en': 'Tuen Mun Ferry Pier',
+                'time_ch': f'{minutes} 分鐘', 'time_en': f'{minutes} min',
+                'train_length': 2,
+            } for route in ('505', '507', '610') for minutes in (2, 8)]
+        } for platform in (1, 2)]
+    }
+
+
+def _lrtfeeder() -> dict:
+    return {
+        'routeStatusRemarkTitle': None,
+        'routeStatusTime': NOW.strftime('%Y/%m/%d %H:%M'),
+        'busStop': [{
+            'busStopId': f'K73-U{stop:03d}',
+            'bus': [{
+                'arrivalTimeInSecond': str(minutes * 60),
+                'arrivalTimeText': f'{minutes} 分鐘',
+                'departureTimeInSecond': '108000',
+                'departureTimeText': '',
+                'busLocation': {'longitude': 114.0},
+            } for minutes in (4, 15)]
+        } for stop in range(1, 21)]
+    }
+
+
+# transport: (response, route ID, stop ID)
+CASES = {
+    'kmb': (_kmb(), '1A_outbound_1', '18492910339410B1'),
+    'ctb': (_ctb(), '1_outbound_1', '001313'),
+    'nlb': (_nlb(), '1_outbound_1', '1'),
+    'mtr': (_mtr(), 'TWL_outbound', 'TSW'),
+    'lrt': (_lrt(), '505_outbound_Tuen Mun Ferry Pier', '1'),
+    'lrtfeeder': (_lrtfeeder(), 'K73_outbound_1', 'K73-U010'),
+}
+
+
+def measure(parse, args: tuple, results: int) -> tuple[float, int]:
+    '''Get the seconds per parse and the bytes allocated to keep `results` results.'''
+    start = time.perf_counter()
+    kept = [parse(*args) for _ in range(results)]
+    elapsed = time.perf_counter() - start
+    del kept
+
+    # traced separately, tracing slows the allocations down
+    tracemalloc.start()
+    kept = [parse(*args) for _ in range(results)]
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return elapsed / results, allocated
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--results', type=int, default=10000)
+    args = parser.parse_args()
+
+    print(f'{"transport":<10} {"dict us":>9} {"compact us":>11} '
+          f'{"dict KiB":>10} {"compact KiB":>12} {"saved":>7}')
+    for co, (response, route_id, stop_id) in CASES.items():
+        module = importlib.import_module(f'hketa.{co}')
+        case = (response, route_id, stop_id, 'tc')
+        # pylint: disable=protected-access
+        module._parse_etas(*case), module._parse_compact(*case)  # warm up caches
+        dict_time, dict_bytes = measure(module._parse_etas, case, args.results)
+        compact_time, compact_bytes = measure(module._parse_compact, case, args.results)
+        print(f'{co:<10} {dict_time * 1e6:>9.1f} {compact_time * 1e6:>11.1f} '
+              f'{dict_bytes / 1024:>10.0f} {compact_bytes / 1024:>12.0f} '
+              f'{1 - compact_bytes / dict_bytes:>7.0%}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
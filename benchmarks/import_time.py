@@ -0,0 +1,54 @@
+'''Guard the cold import time of `hketa` against regressions.
+
+Usage:
+    python benchmarks/import_time.py [--budget MS] [--runs N]
+
+Exits with a non-zero status when the median import time exceeds the budget,
+or when a dependency that should be loaded on demand is imported eagerly.
+'''
+import argparse
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+SRC = Path(__file__).parents[1].joinpath('src')
+
+# heavy dependencies that are only needed by some code paths
+LAZY_MODULES = ('pyproj', 'bs4', 'pytz')
+
+PROBE = f'''
+import sys, time
+sys.path.insert(0, {str(SRC)!r})
+start = time.perf_counter()
+import hketa, hketa.kmb, hketa.ctb, hketa.nlb, hketa.mtr, hketa.lrt, hketa.lrtfeeder
+print((time.perf_counter() - start) * 1000)
+print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))
+'''
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget', type=float, default=400, help='milliseconds')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    timings, eager = [], set()
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, '-c', PROBE],
+                                capture_output=True, check=True, text=True).stdout.splitlines()
+        timings.append(float(output[0]))
+        eager.update(filter(None, output[1].split(',')))
+
+    median = statistics.median(timings)
+    print(f'import hketa: median {median:.1f} ms, min {min(timings):.1f} ms '
+          f'over {args.runs} runs (budget {args.budget:.0f} ms)')
+    if eager:
+        print(f'FAIL: imported eagerly: {", ".join(sorted(eager))}')
+    if median > args.budget:
+        print('FAIL: over budget')
+    return 1 if eager or median > args.budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
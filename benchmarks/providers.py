@@ -0,0 +1,254 @@
+'''Measure the throughput and latency of `routes()`, `stops()` and `etas()` of every transport.
+
+Runs against the local stand-in upstream of `upstream.py`, without any network access.
+For each transport:
+    routes.cold   `routes()` with every cache of the package emptied beforehand
+    routes        `routes()` served from the cache
+    stops         `stops()` of the routes, in turn
+    etas          `etas()` of the stops of those routes, in turn
+
+The throttles of the package are lifted unless `--throttled` is given, so the figures
+reflect the package itself rather than the request rates it allows.
+
+The ETAs of the measured stops are also parsed both ways from the same upstream
+responses (and from an empty one): `expand()` of the compact ETAs must equal the
+default ETAs.
+
+Usage:
+    python benchmarks/providers.py [--transports kmb,ctb] [--requests N] [--concurrency N]
+                                   [--latency S] [--jitter S] [--json PATH]
+                                   [--repeat N] [--baseline PATH] [--tolerance 0.25]
+    python benchmarks/providers.py --results PATH --baseline PATH [--tolerance 0.25]
+
+Exits with a non-zero status when the two ETA formats differ, or when a throughput falls
+below the `--baseline` results (as written by `--json`) by more than `--tolerance`.
+Throughputs are only comparable when measured on the same machine, which is how CI
+measures the base commit of a pull request before comparing.
+'''
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Awaitable, Callable
+
+import aiohttp
+
+# importing the stand-in puts `src` on the path
+from upstream import Fixtures, StandIn
+
+import hketa  # pylint: disable=wrong-import-order
+from hketa import _cache, _freshness, _throttle, _utils, kmb, lrt, lrtfeeder, mtr
+
+TRANSPORTS = ('kmb', 'ctb', 'nlb', 'mtr', 'lrt', 'lrtfeeder')
+
+
+def reset_caches() -> None:
+    '''Empty the in-memory and on-disk caches, except for the GTFS store.'''
+    # pylint: disable=protected-access
+    _cache.ROUTES.clear()
+    _cache.STOP_DETAILS.clear()
+    _cache.ETAS.clear()
+    _freshness.FEEDS.clear()
+    kmb._route_stops = kmb._stops_loaded_at = None
+    kmb._BASE_PATH.joinpath('_hketa_kmb_route_stop.json').unlink(missing_ok=True)
+    for dataset in (mtr._STATIONS, lrt._ROUTES_STOPS, lrtfeeder._STOPS):
+        dataset.rows, dataset.index = [], {}
+    _utils._locations = None
+    _utils.LOCATIONS_PATH.unlink(missing_ok=True)
+
+
+def lift_throttles() -> None:
+    # pylint: disable=protected-access
+    for host in (*(h for h in _throttle._DEFAULT_LIMITS if h is not None),
+                 'opendata.mtr.com.hk', 'static.data.gov.hk', 'www.nlb.com.hk'):
+        hketa.configure_throttle(host, concurrency=1000, rate=None)
+
+
+async def measure(calls: list[Callable[[], Awaitable]],
+                  concurrency: int,
+                  repeat: int = 1) -> dict[str, float]:
+    '''Run `calls` by `concurrency` at a time and summarize their latencies.
+
+    The calls are run `repeat` times and the fastest run is kept, as the slower ones
+    measure the noise of the machine rather than the package.
+    '''
+    runs = [await _measure_once(calls, concurrency) for _ in range(repeat)]
+    return max(runs, key=lambda r: r['throughput'])
+
+
+async def _measure_once(calls: list[Callable[[], Awaitable]],
+                        concurrency: int) -> dict[str, float]:
+    latencies = []
+    pending = iter(calls)
+
+    async def worker():
+        for call in pending:
+            start = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(min(concurrency, len(calls)))])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'calls': len(calls),
+        'throughput': len(calls) / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p95_ms': latencies[int(len(latencies) * 0.95) - 1 if len(latencies) > 1 else 0] * 1000,
+        'max_ms': latencies[-1] * 1000,
+    }
+
+
+async def parity(co: str,
+                 keys: list[tuple[str, str]],
+                 session: aiohttp.ClientSession) -> list[str]:
+    '''Compare the default and the expanded compact ETAs parsed from the same responses.'''
+    # pylint: disable=protected-access
+    module = importlib.import_module(f'hketa.{co}')
+    found = []
+    for (route_id, stop_id), language in itertools.product(keys, ('tc', 'en')):
+        for response in (await module._fetch_etas(
+                module._eta_endpoint(route_id, stop_id, language), session), {}):
+            plain = module._parse_etas(response, route_id, stop_id, language)
+            expanded = hketa.expand(
+                module._parse_compact(response, route_id, stop_id, language), language)
+            if plain['etas'] is None:
+                # errors are timestamped when they are parsed
+                plain['timestamp'] = expanded['timestamp']
+            if (differences := list(_differences(plain, expanded))):
+                found.append(f'{co} {route_id} {stop_id} {language}: {"; ".join(differences)}')
+    return found
+
+
+def _differences(plain, expanded, path: str = ''):
+    if isinstance(plain, dict) and isinstance(expanded, dict):
+        for key in dict.fromkeys((*plain, *expanded)):
+            yield from _differences(plain.get(key, '<missing>'),
+                                    expanded.get(key, '<missing>'),
+                                    f'{path}.{key}')
+    elif isinstance(plain, list) and isinstance(expanded, list) \
+            and len(plain) == len(expanded):
+        for idx, (p, e) in enumerate(zip(plain, expanded)):
+            yield from _differences(p, e, f'{path}[{idx}]')
+    elif plain != expanded:
+        yield f'{path or "."}: {plain!r} != {expanded!r}'
+
+
+async def bench(co: str,
+                session: aiohttp.ClientSession,
+                args: argparse.Namespace,
+                mismatches: list[str]) -> dict[str, dict[str, float]]:
+    results = {}
+
+    async def cold_routes():
+        reset_caches()
+        await hketa.routes(co, session=session)
+
+    results['routes.cold'] = await measure([cold_routes] * args.rounds, 1, args.repeat)
+    routes = await hketa.routes(co, session=session)
+    results['routes'] = await measure(
+        [lambda: hketa.routes(co, session=session)] * args.requests, args.concurrency,
+        args.repeat)
+
+    route_ids = [s['id'] for bounds in routes.values()
+                 for services in bounds.values() for s in services][:args.requests]
+    stops = {}
+
+    async def fetch_stops(route_id: str):
+        stops[route_id] = list(await hketa.stops(co, route_id, session=session))
+
+    await fetch_stops(route_ids[0])  # warm up the per-transport indexes
+    results['stops'] = await measure(
+        [lambda r=r: fetch_stops(r) for r in itertools.islice(itertools.cycle(route_ids),
+                                                              args.requests)],
+        args.concurrency, args.repeat)
+
+    keys = [(route_id, stop['id']) for route_id, stops_ in stops.items() for stop in stops_]
+    results['etas'] = await measure(
+        [lambda k=k: hketa.etas(co, *k, session=session)
+         for k in itertools.islice(itertools.cycle(keys), args.requests)],
+        args.concurrency, args.repeat)
+    mismatches.extend(await parity(co, keys[:args.requests], session))
+    return results
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    found = []
+    for co, operations in results.items():
+        for operation, result in operations.items():
+            if (expected := baseline.get(co, {}).get(operation)) is None:
+                continue
+            if result['throughput'] < expected['throughput'] * (1 - tolerance):
+                found.append(f'{co} {operation}: {result["throughput"]:.1f}/s, '
+                             f'baseline {expected["throughput"]:.1f}/s')
+    return found
+
+
+async def run(args: argparse.Namespace) -> tuple[dict, list[str]]:
+    if not args.throttled:
+        lift_throttles()
+
+    results, mismatches = {}, []
+    async with StandIn(Fixtures(args.seed, args.scale),
+                       latency=args.latency,
+                       jitter=args.jitter) as upstream:
+        connector = upstream.connector(limit=args.concurrency * 2)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            for co in args.transports:
+                results[co] = await bench(co, session, args, mismatches)
+                for operation, result in results[co].items():
+                    print(f'{co:<10} {operation:<12} {result["calls"]:>6} '
+                          f'{result["throughput"]:>10.1f} {result["p50_ms"]:>9.2f} '
+                          f'{result["p95_ms"]:>9.2f}')
+        print(f'{upstream.requests} upstream requests served')
+    return results, mismatches
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transports', type=lambda s: s.split(','), default=TRANSPORTS)
+    parser.add_argument('--requests', type=int, default=200, help='calls per operation')
+    parser.add_argument('--rounds', type=int, default=3, help='cold routes() calls')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each operation, the fastest is kept')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--throttled', action='store_true', help='keep the default throttles')
+    parser.add_argument('--json', type=Path, help='write the results to this file')
+    parser.add_argument('--baseline', type=Path, help='results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--results', type=Path,
+                        help='compare these results with --baseline instead of running')
+    args = parser.parse_args()
+
+    if args.results is not None:
+        results = json.loads(args.results.read_text(encoding='utf-8'))
+    else:
+        print(f'{"transport":<10} {"operation":<12} {"calls":>6} {"calls/s":>10} '
+              f'{"p50 ms":>9} {"p95 ms":>9}')
+        results, mismatches = asyncio.run(run(args))
+        if mismatches:
+            print('Compact ETAs differing once expanded:', *mismatches, sep='\n  ')
+            return 1
+        if args.json is not None:
+            args.json.write_text(json.dumps(results, indent=2), encoding='utf-8')
+
+    if args.baseline is not None:
+        baseline = json.loads(args.baseline.read_text(encoding='utf-8'))
+        if (found := regressions(results, baseline, args.tolerance)):
+            print('Throughput regressions:', *found, sep='\n  ')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
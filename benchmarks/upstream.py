@@ -0,0 +1,551 @@
+'''A local stand-in for the upstream servers of every transport.
+
+Serves synthetic payloads shaped like the upstream responses, at about their real
+size, for every endpoint the providers call. The payloads are generated from a seed,
+so runs are comparable and need no network access. ETAs are generated relative to
+the time of each request.
+
+Usage as a standalone server, requests go to http://127.0.0.1:<port>/<host>/<path>:
+    python benchmarks/upstream.py [--port 8080] [--latency 0.05] [--jitter 0.02]
+
+Usage in a benchmark, a session on `StandIn.connector()` sends every request to the
+stand-in, including those of the sessions the package opens on its connector:
+    async with StandIn(latency=0.05, jitter=0.02) as upstream:
+        async with aiohttp.ClientSession(connector=upstream.connector()) as session:
+            await hketa.routes('kmb', session=session)
+'''
+import argparse
+import asyncio
+import csv
+import io
+import json
+import random
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import zlib
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+import aiohttp
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+from yarl import URL
+
+sys.path.insert(0, str(Path(__file__).parents[1].joinpath('src')))
+
+HKT = timezone(timedelta(hours=8))
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+
+def _name(tc: str, en: str, idx: int) -> tuple[str, str]:
+    return f'{tc}站{idx}', f'{en} STOP {idx}'
+
+
+def _csv(header: list[str], rows: list[list]) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(header)
+    writer.writerows(rows)
+    return buffer.getvalue().encode('utf-8-sig')
+
+
+def _json(data) -> web.Response:
+    return web.Response(body=json.dumps(data, ensure_ascii=False).encode(),
+                        content_type='application/json')
+
+
+def _static(body: bytes, content_type: str) -> Handler:
+    async def handler(_request: web.Request) -> web.Response:
+        return web.Response(body=body, content_type=content_type)
+    return handler
+
+
+class Fixtures:
+    '''Synthetic networks of the six transports and the handlers serving them.
+
+    Args:
+        seed: Seed of the generated networks.
+        scale: Multiplier of the number of routes of each bus transport.
+    '''
+
+    def __init__(self, seed: int = 0, scale: float = 1.0) -> None:
+        self.rng = random.Random(seed)
+        self.routes: dict[str, list[str]] = {}
+        self._static: dict[tuple[str, str], Handler] = {}
+        self._dynamic: list[tuple[str, str, Handler]] = []
+        self._kmb(int(400 * scale))
+        self._ctb(int(200 * scale))
+        self._nlb(int(40 * scale))
+        self._mtr()
+        self._lrt()
+        self._lrtfeeder()
+        self._geodata()
+        self._gtfs()
+
+    def handler(self, host: str, path: str) -> Optional[Handler]:
+        if (handler := self._static.get((host, path))) is not None:
+            return handler
+        for host_, prefix, handler in self._dynamic:
+            if host == host_ and path.startswith(prefix):
+                return handler
+        return None
+
+    def _stops(self, kind: str, count: int) -> dict[str, dict]:
+        return {f'{kind.upper()}{idx:06d}': {
+            'name': _name(kind, kind.upper(), idx),
+            'lat': f'{22.2 + self.rng.random() * 0.3:.6f}',
+            'long': f'{113.9 + self.rng.random() * 0.4:.6f}',
+        } for idx in range(count)}
+
+    def _kmb(self, count: int) -> None:
+        host = 'data.etabus.gov.hk'
+        stops = self._stops('kmb', count * 15)
+        stop_ids = list(stops)
+        routes, route_stops, specials = [], [], []
+        for idx in range(1, count + 1):
+            no = str(idx)
+            types = ('1', '2') if idx % 10 == 0 else ('1', )
+            for bound in ('O', 'I'):
+                for service_type in types:
+                    sequence = self.rng.sample(stop_ids, self.rng.randint(15, 40))
+                    orig, dest = sequence[0], sequence[-1]
+                    routes.append({
+                        'route': no, 'bound': bound, 'service_type': service_type,
+                        'orig_tc': stops[orig]['name'][0], 'orig_en': stops[orig]['name'][1],
+                        'dest_tc': stops[dest]['name'][0], 'dest_en': stops[dest]['name'][1],
+                    })
+                    route_stops.extend({'route': no, 'bound': bound,
+                                        'service_type': service_type,
+                                        'seq': str(seq), 'stop': stop}
+                                       for seq, stop in enumerate(sequence, 1))
+                if len(types) > 1:
+                    specials.append((no, '1' if bound == 'O' else '2'))
+        self.routes['kmb'] = [r['route'] for r in routes]
+
+        def stop_detail(stop_id: str) -> dict:
+            stop = stops[stop_id]
+            return {'stop': stop_id, 'name_tc': stop['name'][0], 'name_en': stop['name'][1],
+                    'lat': stop['lat'], 'long': stop['long']}
+
+        async def stop(request: web.Request) -> web.Response:
+            if (stop_id := request.path.rsplit('/', 1)[-1]) not in stops:
+                return _json({})
+            return _json({'data': stop_detail(stop_id)})
+
+        async def eta(request: web.Request) -> web.Response:
+            _, route, service_type = request.path.rsplit('/', 3)[-3:]
+            return _json(_bus_etas(route, service_type))
+
+        async def variants(request: web.Request) -> web.Response:
+            route, bound = request.query.get('route'), request.query.get('bound')
+            return _json({'data': {'routes': [
+                {'Route': route, 'Bound': bound, 'ServiceType': '01   ',
+                 'Desc_CHI': '', 'Desc_ENG': ''},
+                {'Route': route, 'Bound': bound, 'ServiceType': '02   ',
+                 'Desc_CHI': '特別班次', 'Desc_ENG': 'Special Departure'},
+            ] if (route, bound) in specials else []}})
+
+        base = '/v1/transport/kmb'
+        self._static.update({
+            (host, f'{base}/route'):
+                _static(json.dumps({'data': routes}).encode(), 'application/json'),
+            (host, f'{base}/stop'):
+                _static(json.dumps({'data': [stop_detail(s) for s in stops]}).encode(),
+                        'application/json'),
+            (host, f'{base}/route-stop'):
+                _static(json.dumps({'data': route_stops}).encode(), 'application/json'),
+            ('search.kmb.hk', '/KMBWebSite/Function/FunctionRequest.ashx'): variants,
+        })
+        self._dynamic += [(host, f'{base}/stop/', stop), (host, f'{base}/eta/', eta)]
+
+    def _ctb(self, count: int) -> None:
+        host = 'rt.data.gov.hk'
+        stops = self._stops('ctb', count * 12)
+        stop_ids = list(stops)
+        routes, route_stops = [], {}
+        for idx in range(1, count + 1):
+            no = str(idx)
+            route_stops[(no, 'outbound')] = self.rng.sample(stop_ids, self.rng.randint(15, 40))
+            # some routes only run in one direction
+            route_stops[(no, 'inbound')] = [] if idx % 5 == 0 else \
+                self.rng.sample(stop_ids, self.rng.randint(15, 40))
+            orig, dest = route_stops[(no, 'outbound')][0], route_stops[(no, 'outbound')][-1]
+            routes.append({'co': 'CTB', 'route': no,
+                           'orig_tc': stops[orig]['name'][0], 'orig_en': stops[orig]['name'][1],
+                           'dest_tc': stops[dest]['name'][0], 'dest_en': stops[dest]['name'][1]})
+        self.routes['ctb'] = [r['route'] for r in routes]
+
+        async def route_stop(request: web.Request) -> web.Response:
+            route, direction = request.path.rsplit('/', 2)[-2:]
+            return _json({'data': [{'co': 'CTB', 'route': route, 'dir': direction[0].upper(),
+                                    'seq': seq, 'stop': stop}
+                                   for seq, stop in enumerate(
+                                       route_stops.get((route, direction), []), 1)]})
+
+        async def stop(request: web.Request) -> web.Response:
+            if (stop_id := request.path.rsplit('/', 1)[-1]) not in stops:
+                return _json({'data': {}})
+            detail = stops[stop_id]
+            return _json({'data': {'stop': stop_id,
+                                   'name_tc': detail['name'][0], 'name_en': detail['name'][1],
+                                   'lat': detail['lat'], 'long': detail['long']}})
+
+        async def eta(request: web.Request) -> web.Response:
+            return _json(_bus_etas(request.path.rsplit('/', 1)[-1], '1'))
+
+        base = '/v2/transport/citybus'
+        self._static[(host, f'{base}/route/ctb')] = \
+            _static(json.dumps({'data': routes}).encode(), 'application/json')
+        self._dynamic += [(host, f'{base}/route-stop/ctb/', route_stop),
+                          (host, f'{base}/stop/', stop),
+                          (host, f'{base}/eta/ctb/', eta)]
+
+    def _nlb(self, count: int) -> None:
+        stops = self._stops('nlb', count * 10)
+        stop_ids = list(stops)
+        routes, route_stops = [], {}
+        for idx in range(1, count + 1):
+            sequence = self.rng.sample(stop_ids, self.rng.randint(8, 25))
+            for reverse in (False, True):
+                ends = [stops[s]['name'] for s in (sequence[::-1] if reverse else sequence)]
+                route_id = str(len(routes) + 1)
+                routes.append({'routeId': route_id, 'routeNo': str(idx),
+                               'routeName_c': f'{ends[0][0]} > {ends[-1][0]}',
+                               'routeName_s': f'{ends[0][0]} > {ends[-1][0]}',
+                               'routeName_e': f'{ends[0][1]} > {ends[-1][1]}',
+                               'overnightRoute': 0, 'specialRoute': 0})
+                route_stops[route_id] = sequence[::-1] if reverse else sequence
+        self.routes['nlb'] = [r['routeNo'] for r in routes]
+
+        async def stop_php(request: web.Request) -> web.Response:
+            if request.query.get('action') == 'list':
+                return _json({'stops': [{
+                    'stopId': stop,
+                    'stopName_c': stops[stop]['name'][0],
+                    'stopName_s': stops[stop]['name'][0],
+                    'stopName_e': stops[stop]['name'][1],
+                    'latitude': stops[stop]['lat'],
+                    'longitude': stops[stop]['long'],
+                } for stop in route_stops.get(request.query.get('routeId'), [])]})
+            now = datetime.now(HKT).replace(tzinfo=None)
+            return _json({'estimatedArrivals': [{
+                'estimatedArrivalTime': (now + timedelta(minutes=m))
+                .isoformat(sep=' ', timespec='seconds'),
+                'routeVariantName': None,
+                'departed': '1',
+                'noGPS': '0',
+            } for m in (3, 12, 25)]})
+
+        async def language(request: web.Request) -> web.Response:
+            response = web.Response(text='')
+            response.set_cookie('lang', request.path.rsplit('/', 1)[-1])
+            return response
+
+        async def route_page(request: web.Request) -> web.Response:
+            idx = 0 if request.cookies.get('lang') == 'zh' else 1
+            rows = ''.join(
+                f'<tr><td>{r["routeNo"]}</td>'
+                f'<td><br/><span>{r["routeName_c" if idx == 0 else "routeName_e"]}</span>'
+                f'<small>{"經" if idx == 0 else "via"} {r["routeId"]}</small></td></tr>'
+                for r in routes)
+            return web.Response(text='<table class="property-table"><tr><th></th></tr>'
+                                f'{rows}</table>',
+                                content_type='text/html')
+
+        self._static.update({
+            ('rt.data.gov.hk', '/v2/transport/nlb/route.php'):
+                _static(json.dumps({'routes': routes}, ensure_ascii=False).encode(),
+                        'application/json'),
+            ('rt.data.gov.hk', '/v2/transport/nlb/stop.php'): stop_php,
+            ('www.nlb.com.hk', '/route'): route_page,
+        })
+        self._dynamic.append(('www.nlb.com.hk', '/language/set/', language))
+
+    def _mtr(self) -> None:
+        rows, self.routes['mtr'] = [], []
+        lines: dict[str, list[str]] = {}
+        for line in ('AEL', 'TCL', 'TML', 'TKL', 'EAL', 'SIL', 'TWL', 'ISL', 'KTL', 'DRL'):
+            lines[line] = [f'{line[0]}{line[1]}{idx}' for idx in range(self.rng.randint(4, 17))]
+            for direction in ('DT', 'UT'):
+                stations = lines[line] if direction == 'DT' else lines[line][::-1]
+                rows.extend([line, direction, code, str(len(rows) + 1), f'{code}站',
+                             f'{code} Station', f'{seq}.00']
+                            for seq, code in enumerate(stations, 1))
+            self.routes['mtr'].append(line)
+        # a branch line, e.g. LMC-DT of the East Rail line
+        rows.extend(['EAL', 'LMC-DT', code, str(len(rows) + 1), f'{code}站', f'{code} Station',
+                     f'{seq}.00'] for seq, code in enumerate(lines['EAL'][:3] + ['LMC'], 1))
+
+        async def schedule(request: web.Request) -> web.Response:
+            line, station = request.query.get('line'), request.query.get('sta')
+            now = datetime.now(HKT).replace(tzinfo=None)
+            trains = [{'seq': str(seq), 'dest': lines.get(line, ['XXX'])[-1], 'plat': '1',
+                       'time': (now + timedelta(minutes=m)).isoformat(sep=' ', timespec='seconds'),
+                       'ttnt': str(m), 'valid': 'Y', 'source': '-'}
+                      for seq, m in enumerate((1, 4, 7, 10), 1)]
+            stamp = now.isoformat(sep=' ', timespec='seconds')
+            return _json({'status': 1, 'message': 'successful', 'isdelay': 'N',
+                          'curr_time': stamp, 'sys_time': stamp,
+                          'data': {f'{line}-{station}': {'curr_time': stamp, 'sys_time': stamp,
+                                                         'UP': trains, 'DOWN': trains}}})
+
+        self._static.update({
+            ('opendata.mtr.com.hk', '/data/mtr_lines_and_stations.csv'): _static(
+                _csv(['Line Code', 'Direction', 'Station Code', 'Station ID',
+                      'Chinese Name', 'English Name', 'Sequence'], rows), 'text/csv'),
+            ('rt.data.gov.hk', '/v1/transport/mtr/getSchedule.php'): schedule,
+        })
+
+    def _lrt(self) -> None:
+        rows, self.routes['lrt'] = [], []
+        stations = [str(idx) for idx in range(1, 70)]
+        destinations = {}
+        for route in ('505', '507', '610', '614', '615', '705', '706', '751', '761P'):
+            sequence = self.rng.sample(stations, self.rng.randint(10, 20))
+            for direction in ('1', '2'):
+                stops = sequence if direction == '1' else sequence[::-1]
+                rows.extend([route, direction, f'S{stop}', stop, *_name('輕鐵', 'LRT', int(stop)),
+                             f'{seq}.00'] for seq, stop in enumerate(stops, 1))
+            destinations[route] = sequence
+            self.routes['lrt'].append(route)
+
+        async def schedule(request: web.Request) -> web.Response:
+            station = request.query.get('station_id')
+            now = datetime.now(HKT).replace(tzinfo=None)
+            return _json({'status': 1,
+                          'system_time': now.isoformat(sep=' ', timespec='seconds'),
+                          'platform_list': [{'platform_id': platform, 'route_list': [{
+                              'route_no': route,
+                              'dest_ch': _name('輕鐵', 'LRT', int(stops[-1]))[0],
+                              'dest_en': _name('輕鐵', 'LRT', int(stops[-1]))[1],
+                              'time_ch': f'{m} 分鐘', 'time_en': f'{m} min',
+                              'train_length': 2,
+                          } for route, stops in destinations.items() if station in stops
+                              for m in (2, 8)]} for platform in (1, 2)]})
+
+        self._static.update({
+            ('opendata.mtr.com.hk', '/data/light_rail_routes_and_stops.csv'): _static(
+                _csv(['Line Code', 'Direction', 'Stop Code', 'Stop ID',
+                      'Chinese Name', 'English Name', 'Sequence'], rows), 'text/csv'),
+            ('rt.data.gov.hk', '/v1/transport/mtr/lrt/getSchedule'): schedule,
+        })
+
+    def _lrtfeeder(self) -> None:
+        rows, self.routes['lrtfeeder'], stops = [], [], {}
+        for route in ('506', 'K12', 'K14', 'K17', 'K18', 'K51', 'K52', 'K53', 'K54', 'K58',
+                      'K65', 'K66', 'K68', 'K73', 'K74', 'K75P', 'K76'):
+            for direction in ('O', 'I'):
+                for seq in range(1, self.rng.randint(8, 25)):
+                    stop = f'{route}-{"U" if direction == "O" else "D"}{seq:03d}'
+                    stops.setdefault(route, []).append(stop)
+                    rows.append([route, direction, f'{seq}.00', stop,
+                                 f'{22.38 + self.rng.random() * 0.1:.6f}',
+                                 f'{113.95 + self.rng.random() * 0.1:.6f}',
+                                 *_name('港鐵巴士', 'MTR BUS', seq)])
+            self.routes['lrtfeeder'].append(route)
+
+        async def schedule(request: web.Request) -> web.Response:
+            route = (await request.json()).get('routeName')
+            return _json({'status': '1', 'routeStatusRemarkTitle': None,
+                          'routeStatusTime': datetime.now(HKT).strftime('%Y/%m/%d %H:%M'),
+                          'busStop': [{'busStopId': stop, 'bus': [{
+                              'arrivalTimeInSecond': str(m * 60),
+                              'arrivalTimeText': f'{m} 分鐘',
+                              'departureTimeInSecond': '108000',
+                              'departureTimeText': '',
+                              'busLocation': {'longitude': 114.0},
+                          } for m in (4, 15)]} for stop in stops.get(route, [])]})
+
+        self._static.update({
+            ('opendata.mtr.com.hk', '/data/mtr_bus_stops.csv'): _static(
+                _csv(['ROUTE_ID', 'DIRECTION', 'STATION_SEQNO', 'STATION_ID',
+                      'STATION_LATITUDE', 'STATION_LONGITUDE',
+                      'STATION_NAME_CHI', 'STATION_NAME_ENG'], rows), 'text/csv'),
+            ('rt.data.gov.hk', '/v1/transport/mtr/bus/getSchedule'): schedule,
+        })
+
+    def _geodata(self) -> None:
+        async def search(request: web.Request) -> web.Response:
+            # a stable location in the HK 1980 grid for each query
+            seed = zlib.crc32(request.query.get('q', '').encode())
+            return _json([{'nameZH': request.query.get('q'),
+                           'x': 810000 + seed % 50000,
+                           'y': 810000 + (seed >> 16) % 40000}])
+
+        self._static[('geodata.gov.hk', '/gs/api/v1.0.0/locationSearch')] = search
+
+    def _gtfs(self) -> None:
+        rows = []
+        for co, agency in (('kmb', 'KMB'), ('ctb', 'CTB'), ('nlb', 'NLB'),
+                           ('lrtfeeder', 'LRTFeeder')):
+            for no in dict.fromkeys(self.routes[co]):
+                rows.append([str(len(rows) + 1), agency, no,
+                             f'{co}站1 - {co}站2', '3', ''])
+        self._static.update({
+            ('static.data.gov.hk', '/td/pt-headway-en/DATA_LAST_UPDATED_DATE.csv'):
+                _static(b'DATA_LAST_UPDATED_DATE\n2024-01-01\n', 'text/csv'),
+            ('static.data.gov.hk', '/td/pt-headway-tc/routes.txt'): _static(
+                _csv(['route_id', 'agency_id', 'route_short_name', 'route_long_name',
+                      'route_type', 'route_url'], rows), 'text/plain'),
+        })
+
+
+def _bus_etas(route: str, service_type: str) -> dict:
+    now = datetime.now(HKT).replace(microsecond=0)
+    return {
+        'type': 'ETA',
+        'version': '1.0',
+        'generated_timestamp': now.isoformat(),
+        'data': [{
+            'co': 'KMB', 'route': route, 'dir': bound, 'service_type': int(service_type),
+            'seq': 1, 'dest_tc': '總站', 'dest_sc': '总站', 'dest_en': 'TERMINUS',
+            'eta_seq': seq, 'eta': (now + timedelta(minutes=minutes)).isoformat(),
+            'rmk_tc': '', 'rmk_sc': '', 'rmk_en': '', 'data_timestamp': now.isoformat(),
+        } for bound in ('O', 'I') for seq, minutes in enumerate((2, 9, 17), 1)]
+    }
+
+
+class StandIn:
+    '''Serve `Fixtures` on local ports with a simulated upstream latency.
+
+    Requests come either over HTTP as `/<host>/<path>`, or over HTTPS through
+    `connector()`, which connects every host to the stand-in. The HTTPS port uses a
+    self-signed certificate made by the `openssl` command.
+
+    Args:
+        latency: Mean seconds added before each response.
+        jitter: Maximum seconds randomly added to or removed from `latency`.
+        port: HTTP port to listen to, `0` for any free port.
+        isolate: Whether the on-disk caches of the package are moved to a temporary
+            directory inside the `async with` block.
+    '''
+
+    def __init__(self,
+                 fixtures: Fixtures = None,
+                 *,
+                 latency: float = 0.0,
+                 jitter: float = 0.0,
+                 port: int = 0,
+                 isolate: bool = True) -> None:
+        self.fixtures = fixtures or Fixtures()
+        self.latency = latency
+        self.jitter = jitter
+        self.port = port
+        self.tls_port = 0
+        self.isolate = isolate
+        self.requests = 0
+        self._rng = random.Random(1)
+        self._runner: Optional[web.AppRunner] = None
+        self._patched: list[tuple[object, str, object]] = []
+        self._tmp: Optional[tempfile.TemporaryDirectory] = None
+
+    @property
+    def url(self) -> URL:
+        return URL(f'http://127.0.0.1:{self.port}')
+
+    async def __aenter__(self) -> 'StandIn':
+        self._tmp = tempfile.TemporaryDirectory(prefix='hketa-bench-')
+        app = web.Application()
+        app.router.add_route('*', '/{path:.*}', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', self.port).start()
+        await web.TCPSite(self._runner, '127.0.0.1', 0,
+                          ssl_context=_self_signed(Path(self._tmp.name))).start()
+        self.port, self.tls_port = (a[1] for a in self._runner.addresses)
+        if self.isolate:
+            self._isolate()
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        for target, name, value in reversed(self._patched):
+            setattr(target, name, value)
+        self._patched.clear()
+        self._tmp.cleanup()
+        await self._runner.cleanup()
+
+    def connector(self, **kwargs) -> aiohttp.TCPConnector:
+        '''Create a connector sending the requests to every host to the stand-in.'''
+        return aiohttp.TCPConnector(resolver=_Resolver(self.tls_port), ssl=False, **kwargs)
+
+    async def _handle(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(
+                max(self.latency + self._rng.uniform(-self.jitter, self.jitter), 0))
+        if request.secure:
+            host, path = request.host.partition(':')[0], request.path
+        else:
+            host, _, path = request.path.removeprefix('/').partition('/')
+            path = '/' + path
+        if (handler := self.fixtures.handler(host, path)) is None:
+            raise web.HTTPNotFound()
+        return await handler(request)
+
+    def _isolate(self) -> None:
+        # pylint: disable=import-outside-toplevel,protected-access
+        from hketa import _gtfs_parser, _utils, kmb
+
+        tmp = Path(self._tmp.name)
+        for target, name, value in ((_gtfs_parser, '_BASE_PATH', tmp),
+                                    (kmb, '_BASE_PATH', tmp),
+                                    (_utils, 'LOCATIONS_PATH', tmp.joinpath('locations.json'))):
+            self._patched.append((target, name, getattr(target, name)))
+            setattr(target, name, value)
+
+
+class _Resolver(AbstractResolver):
+    '''Resolve every host to the HTTPS port of the stand-in.'''
+
+    def __init__(self, port: int) -> None:
+        self.port = port
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET):
+        return [{'hostname': host, 'host': '127.0.0.1', 'port': self.port,
+                 'family': socket.AF_INET, 'proto': 0, 'flags': socket.AI_NUMERICHOST}]
+
+    async def close(self) -> None:
+        pass
+
+
+def _self_signed(directory: Path) -> ssl.SSLContext:
+    cert, key = directory.joinpath('cert.pem'), directory.joinpath('key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', '/CN=hketa-stand-in', '-keyout', str(key), '-out', str(cert)],
+                   check=True, capture_output=True)
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+async def _serve(args: argparse.Namespace) -> None:
+    async with StandIn(Fixtures(args.seed, args.scale),
+                       latency=args.latency,
+                       jitter=args.jitter,
+                       port=args.port,
+                       isolate=False) as upstream:
+        print(f'Serving on {upstream.url}/<host>/<path>, press Ctrl+C to stop.')
+        await asyncio.Event().wait()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scale', type=float, default=1.0)
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,8 +14,7 @@ setup(
     install_requires=[
         'aiohttp',
         'beautifulsoup4',
-        'pyproj',
-        'pytz'
+        'pyproj'
     ],
     packages=find_packages(where='src'),
     package_dir={'': 'src'},
@@ -1,10 +1,21 @@
+import asyncio
 import importlib
 import sys
-from typing import Coroutine, Iterable
+from types import ModuleType
+from typing import Callable, Coroutine, Iterable, Union
 
 import aiohttp
 
 from . import t
+from ._cache import ETAS as eta_cache
+from ._metrics import MetricsRegistry, add_metrics_sink, remove_metrics_sink, trace_config
+from ._resilience import (CircuitOpenError, breaker_stats, configure_breaker,
+                          configure_endpoint)
+from ._scheduler import Scheduler
+from ._throttle import configure_throttle, throttle_stats
+from ._utils import ensure_session, error_compact, error_eta, expand
+from ._watch import watch, watchers
+from .client import Client
 
 
 def routes(co: t.Transport,
@@ -29,7 +40,206 @@ def etas(co: t.Transport,
          stop_id: str,
          language: t.Language = 'tc',
          *,
-         session: aiohttp.ClientSession = None) -> Coroutine[None, None, t.Etas]:
-    return importlib.import_module(f'.{co}', sys.modules[__name__].__package__)\
-        .__dict__\
-        .get('etas')(route_id, stop_id, language, session=session)
+         fallback: bool = False,
+         compact: bool = False,
+         session: aiohttp.ClientSession = None
+         ) -> Coroutine[None, None, Union[t.Etas, t.CompactEtas]]:
+    '''Retrieve the real-time ETAs of a route at a stop.
+
+    Args:
+        fallback: Replace an `empty` or `api-error` result of a bus route by the next
+            departures from its origin (not arrivals at the stop) estimated with the TD
+            timetable (headway) data, as told by the remark of each ETA.
+        compact: Return `t.CompactEtas` records, skipping the formatting of times and
+            the building of dicts. Use `expand()` to format them later.
+    '''
+    module = importlib.import_module(f'.{co}', sys.modules[__name__].__package__)
+    if compact:
+        etas_ = _compact_etas(module, route_id, stop_id, language, session=session)
+    else:
+        etas_ = module.__dict__.get('etas')(route_id, stop_id, language, session=session)
+    if not fallback:
+        return etas_
+    return _with_fallback(etas_, co, route_id, language, compact, session=session)
+
+
+@ensure_session
+async def etas_many(requests: Iterable[tuple[t.Transport, str, str]],
+                    language: t.Language = 'tc',
+                    *,
+                    fallback: bool = False,
+                    compact: bool = False,
+                    session: aiohttp.ClientSession) -> list[Union[t.Etas, t.CompactEtas]]:
+    '''Retrieve the ETAs of many (transport, route ID, stop ID) combinations at once.
+
+    Combinations that can be answered by the same upstream request (e.g. the
+    stops of a MTR Bus route, or the routes of a Light Rail station) share a
+    single request.
+
+    Args:
+        fallback: See `etas()`.
+        compact: See `etas()`.
+
+    Returns:
+        The ETAs in the same order as `requests`. A failed upstream request, or a
+        response that cannot be parsed, is reported as an `api-error` for every
+        combination relying on it, as is a malformed route or stop ID.
+    '''
+    # pylint: disable=protected-access
+    requests = [(importlib.import_module(f'.{co}', sys.modules[__name__].__package__),
+                 co,
+                 route_id,
+                 stop_id) for co, route_id, stop_id in requests]
+    keys = []
+    for module, co, route_id, stop_id in requests:
+        try:
+            keys.append((co, module._eta_endpoint(route_id, stop_id, language)))
+        except (AttributeError, KeyError, IndexError, TypeError, ValueError):
+            keys.append(None)  # a malformed route or stop ID
+    endpoints = {key: request[0] for key, request in zip(keys, requests) if key is not None}
+
+    responses = dict(zip(
+        endpoints.keys(),
+        await asyncio.gather(*[module._fetch_etas(endpoint, session)
+                               for (_, endpoint), module in endpoints.items()],
+                             return_exceptions=True)))
+
+    etas_ = []
+    for key, (module, _, route_id, stop_id) in zip(keys, requests):
+        parse = module._parse_compact if compact else module._parse_etas
+        try:
+            if key is not None and not isinstance(responses[key], Exception):
+                etas_.append(parse(responses[key], route_id, stop_id, language))
+                continue
+        except (KeyError, IndexError, TypeError, ValueError):
+            pass
+        etas_.append(error_compact('api-error') if compact
+                     else error_eta('api-error', language=language))
+
+    if fallback:
+        etas_ = await asyncio.gather(*[
+            _fallback(eta, co, route_id, language, compact, session)
+            for eta, (_, co, route_id, _) in zip(etas_, requests)])
+    return etas_
+
+
+# `_nearby` and `_warmup` import every provider, so they are only loaded once needed
+def nearby(lat: float,
+           lng: float,
+           radius: float = 300,
+           transports: Iterable[t.Transport] = None,
+           *,
+           session: aiohttp.ClientSession = None) -> Coroutine[None, None, list[dict[str,]]]:
+    '''Find the stops within `radius` metres of a point, see `nearby_many()`.'''
+    from ._nearby import nearby as nearby_  # pylint: disable=import-outside-toplevel
+    return nearby_(lat, lng, radius, transports, session=session)
+
+
+def nearby_many(points: Iterable[tuple[float, float]],
+                radius: float = 300,
+                transports: Iterable[t.Transport] = None,
+                *,
+                session: aiohttp.ClientSession = None
+                ) -> Coroutine[None, None, list[list[dict[str,]]]]:
+    '''Find the stops within `radius` metres of each (latitude, longitude) in `points`.
+
+    The stop locations of each transport are loaded once and indexed, later queries
+    are answered from memory. A transport whose stops cannot be loaded is left out.
+    Citybus and NLB have no stop listing, only their stops fetched so far are found.
+
+    Returns:
+        For each point, the stops found nearest first, as dicts of `co`, `id`, `name`,
+        `location` and `distance` (metres).
+    '''
+    from ._nearby import nearby_many as nearby_many_  # pylint: disable=import-outside-toplevel
+    return nearby_many_(points, radius, transports, session=session)
+
+
+def warmup(transports: Iterable[t.Transport] = None,
+           *,
+           concurrency: int = 4,
+           session: aiohttp.ClientSession = None
+           ) -> Coroutine[None, None, dict[str, Union[float, Exception]]]:
+    '''Load the static datasets (routes, stops, locations...) of the transports in parallel.
+
+    Args:
+        transports: Transports to load, defaults to all.
+        concurrency: Maximum number of datasets loading at the same time.
+
+    Returns:
+        Seconds taken to load each dataset keyed by `<transport>.<dataset>`,
+        or the exception raised when it failed to load.
+    '''
+    from ._warmup import warmup as warmup_  # pylint: disable=import-outside-toplevel
+    return warmup_(transports, concurrency=concurrency, session=session)
+
+
+def keep_fresh(transports: Iterable[t.Transport] = None,
+               interval: float = 3600,
+               *,
+               concurrency: int = 4,
+               on_refresh: Callable[[dict[str, Union[float, Exception]]], None] = None
+               ) -> asyncio.Task:
+    '''Reload the static datasets every `interval` seconds in the background.
+
+    The cached data keep being served while they are reloaded. Cancel the
+    returned task to stop refreshing.
+
+    Args:
+        on_refresh: Called with the result of `warmup()` after each reload.
+    '''
+    from ._warmup import keep_fresh as keep_fresh_  # pylint: disable=import-outside-toplevel
+    return keep_fresh_(transports, interval, concurrency=concurrency, on_refresh=on_refresh)
+
+
+@ensure_session
+async def _compact_etas(module: ModuleType,
+                        route_id: str,
+                        stop_id: str,
+                        language: t.Language,
+                        *,
+                        session: aiohttp.ClientSession) -> t.CompactEtas:
+    # pylint: disable=protected-access
+    try:
+        response = await module._fetch_etas(module._eta_endpoint(route_id, stop_id, language),
+                                            session)
+    except CircuitOpenError:
+        return error_compact('api-error')
+    return module._parse_compact(response, route_id, stop_id, language)
+
+
+@ensure_session
+async def _with_fallback(etas_: Coroutine[None, None, Union[t.Etas, t.CompactEtas]],
+                         co: t.Transport,
+                         route_id: str,
+                         language: t.Language,
+                         compact: bool,
+                         *,
+                         session: aiohttp.ClientSession) -> Union[t.Etas, t.CompactEtas]:
+    try:
+        result = await etas_
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        result = error_compact('api-error') if compact \
+            else error_eta('api-error', language=language)
+    return await _fallback(result, co, route_id, language, compact, session)
+
+
+async def _fallback(result: Union[t.Etas, t.CompactEtas],
+                    co: t.Transport,
+                    route_id: str,
+                    language: t.Language,
+                    compact: bool,
+                    session: aiohttp.ClientSession) -> Union[t.Etas, t.CompactEtas]:
+    # the GTFS modules (and SQLite) are only needed once a real-time lookup has failed
+    import sqlite3  # pylint: disable=import-outside-toplevel
+    from . import _headway  # pylint: disable=import-outside-toplevel
+
+    if co not in _headway.TRANSPORTS or not _headway.is_failure(result):
+        return result
+    try:
+        return await _headway.scheduled_etas(co, route_id, language,
+                                             compact=compact,
+                                             session=session)
+    except (aiohttp.ClientError, asyncio.TimeoutError, sqlite3.Error,
+            IndexError, KeyError, ValueError):
+        return result
@@ -0,0 +1,24 @@
+import argparse
+import asyncio
+
+from . import lrt, mtr
+
+
+async def _prefill_locations() -> None:
+    counts = await asyncio.gather(mtr.prefill_locations(), lrt.prefill_locations())
+    print(f'Geocoded {counts[0]} MTR and {counts[1]} Light Rail stations.')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog='python -m hketa')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('prefill-locations',
+                        help='geocode every MTR and Light Rail station into the on-disk cache')
+
+    args = parser.parse_args()
+    if args.command == 'prefill-locations':
+        asyncio.run(_prefill_locations())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+import asyncio
+import time
+from collections import OrderedDict
+from copy import deepcopy
+from datetime import datetime
+from functools import wraps
+from typing import Any, Awaitable, Callable, Hashable, Iterable, Optional
+
+import aiohttp
+
+from ._metrics import client_session
+from ._utils import HKT, single_flight
+
+_MISSING = object()
+
+
+class TTLCache:
+    '''A least-recently-used mapping whose entries expire after `ttl` seconds.'''
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            expiry, value = self._data[key]
+        except KeyError:
+            return default
+
+        if expiry < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float = None) -> None:
+        self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def items(self) -> list[tuple[Hashable, Any]]:
+        now = time.monotonic()
+        return [(key, value) for key, (expiry, value) in self._data.items() if expiry >= now]
+
+    def update(self, items: Iterable[tuple[Hashable, Any]], ttl: float = None) -> None:
+        for key, value in items:
+            self.set(key, value, ttl)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+# keyed by (transport, stop ID), shared by every module that resolves stop details
+STOP_DETAILS = TTLCache(maxsize=16384, ttl=86400)
+
+# keyed by transport
+ROUTES = TTLCache(maxsize=16, ttl=86400)
+
+
+def cached_stop_locations(co: str) -> list[tuple[str, dict[str, str], tuple[float, float]]]:
+    '''Get the (ID, name, location) of the stops of a transport found in `STOP_DETAILS`.'''
+    return [(stop_id, detail['name'], (float(detail['location'][0]), float(detail['location'][1])))
+            for (stop_co, stop_id), detail in STOP_DETAILS.items() if stop_co == co]
+
+
+_route_loaders: dict[str, Callable[..., Awaitable[dict]]] = {}
+
+
+def cached_routes(co: str):
+    '''Cache the result of a transport's `routes()` in `ROUTES`.
+
+    Callers receive their own copy, so the cached routes cannot be modified.
+    '''
+    def decorator(func: Awaitable):
+        _route_loaders[co] = func
+
+        @wraps(func)
+        async def wrapper(*, session: aiohttp.ClientSession) -> dict:
+            if (routes := ROUTES.get(co)) is None:
+                routes = await refresh_routes(co, session)
+            return deepcopy(routes)
+        return wrapper
+    return decorator
+
+
+@single_flight
+async def refresh_routes(co: str, session: aiohttp.ClientSession) -> dict:
+    '''Load the routes of a transport into `ROUTES`, once for all concurrent callers.
+
+    `routes()` only calls it on a miss and waits for the load to complete.
+    '''
+    # the matcher needs the GTFS modules, which are not imported until routes are loaded
+    from ._matcher import attach_gtfs_ids  # pylint: disable=import-outside-toplevel
+
+    routes = await attach_gtfs_ids(co, await _route_loaders[co](session=session), session)
+    ROUTES.set(co, routes)
+    return routes
+
+
+class EtaCache:
+    '''Opt-in cache of raw upstream ETA responses.
+
+    An entry is fresh until its upstream generation time plus the refresh
+    interval of the transport. A stale entry is still returned at once while
+    it is refreshed in the background, until it is `max_stale` seconds old.
+    '''
+
+    def __init__(self,
+                 intervals: dict[str, float],
+                 max_stale: float = 300,
+                 maxsize: int = 4096) -> None:
+        self.enabled = False
+        self.intervals = dict(intervals)
+        self._entries = TTLCache(maxsize, max_stale)
+        self._refreshing: dict[Hashable, asyncio.Task] = {}
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def cached(self, co: str, generated_at: Callable[[dict], Optional[datetime]]):
+        '''Cache the responses of a `(endpoint, session)` fetching coroutine.
+
+        Args:
+            co: Transport the responses belong to.
+            generated_at: Extracts the upstream generation time from a response,
+                a naive `datetime` is treated as Hong Kong time.
+        '''
+        def decorator(func: Awaitable):
+            @wraps(func)
+            async def wrapper(endpoint: Hashable, session: aiohttp.ClientSession) -> dict:
+                if not self.enabled:
+                    return await func(endpoint, session)
+
+                if (entry := self._entries.get((co, endpoint))) is None:
+                    return await self._fetch(co, endpoint, func, generated_at, session)
+
+                response, expiry = entry
+                if expiry <= time.time():
+                    self._revalidate(co, endpoint, func, generated_at, session)
+                return response
+            return wrapper
+        return decorator
+
+    async def _fetch(self,
+                     co: str,
+                     endpoint: Hashable,
+                     func: Awaitable,
+                     generated_at: Callable[[dict], Optional[datetime]],
+                     session: aiohttp.ClientSession) -> dict:
+        now = time.time()
+        if not (response := await func(endpoint, session)):
+            return response  # empty responses are upstream errors
+
+        try:
+            generated = generated_at(response)
+            if generated.tzinfo is None:
+                generated = generated.replace(tzinfo=HKT)
+            generated = min(generated.timestamp(), now)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            generated = now
+        # never consider a response stale on arrival, which happens when the
+        # upstream clock lags behind or the data are not regenerated in time
+        self._entries.set((co, endpoint),
+                          (response, max(generated + self.intervals.get(co, 0), now + 1)))
+        return response
+
+    def _revalidate(self,
+                    co: str,
+                    endpoint: Hashable,
+                    func: Awaitable,
+                    generated_at: Callable[[dict], Optional[datetime]],
+                    session: aiohttp.ClientSession) -> None:
+        async def refresh():
+            # the refresh keeps to the pool and limits of the caller's session,
+            # unless the caller has closed it meanwhile
+            if not session.closed:
+                await self._fetch(co, endpoint, func, generated_at, session)
+                return
+            async with client_session() as own:
+                await self._fetch(co, endpoint, func, generated_at, own)
+
+        if (co, endpoint) in self._refreshing:
+            return
+        task = asyncio.get_running_loop().create_task(refresh())
+        self._refreshing[(co, endpoint)] = task
+        # a failed refresh keeps serving the stale entry until it is evicted
+        task.add_done_callback(
+            lambda t: (self._refreshing.pop((co, endpoint), None),
+                       t.cancelled() or t.exception()))
+
+
+ETAS = EtaCache({
+    'kmb': 30,
+    'ctb': 30,
+    'nlb': 30,
+    'lrtfeeder': 30,
+    'mtr': 10,
+    'lrt': 10,
+})
@@ -0,0 +1,74 @@
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import aiohttp
+
+from ._resilience import guarded
+from ._store import Store
+from ._utils import single_flight
+
+
+class FeedVersions:
+    '''Versions (last updated dates) of the TD feed families.
+
+    The version of each family is requested at most once every `interval` seconds,
+    no matter how many of its datasets are loaded in the meantime.
+    '''
+
+    def __init__(self, interval: float = 3600) -> None:
+        self.interval = interval
+        self._versions: dict[str, tuple[float, str]] = {}
+
+    async def get(self, url: str, session: aiohttp.ClientSession) -> str:
+        '''Get the version of the family published at `url` (a `DATA_LAST_UPDATED_DATE.csv`).'''
+        checked_at, version = self._versions.get(url, (float('-inf'), None))
+        if checked_at + self.interval <= time.monotonic():
+            version = await _fetch_version(url, session)
+            self._versions[url] = (time.monotonic(), version)
+        return version
+
+    def clear(self) -> None:
+        self._versions.clear()
+
+
+@single_flight
+async def _fetch_version(url: str, session: aiohttp.ClientSession) -> str:
+    async with guarded(session.get, url, 'td.version') as request:
+        request.raise_for_status()
+        # the first line is the header
+        return (await request.text()).split('\n')[1].strip()
+
+
+FEEDS = FeedVersions()
+
+
+async def outdated(store: Store,
+                   dataset: str,
+                   feed_url: str,
+                   session: aiohttp.ClientSession) -> Optional[str]:
+    '''Get the current version of the feed when the stored `dataset` is older, otherwise `None`.'''
+    version = await FEEDS.get(feed_url, session)
+    return None if store.version(dataset) == version else version
+
+
+@asynccontextmanager
+async def get_if_modified(
+        store: Store,
+        url: str,
+        session: aiohttp.ClientSession,
+        endpoint: str = 'td.dataset') -> AsyncIterator[Optional[aiohttp.ClientResponse]]:
+    '''Request `url` conditionally on the stored response, yielding `None` when it is unchanged.
+
+    The response is left to be read as it arrives, see `guarded()`.
+
+    Raises:
+        aiohttp.ClientResponseError: The response is neither successful nor 304.
+    '''
+    async with guarded(session.get, url, endpoint,
+                       stream=True, headers=store.validators(url)) as response:
+        if response.status == 304:
+            yield None
+        else:
+            response.raise_for_status()
+            yield response
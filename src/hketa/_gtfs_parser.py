@@ -3,163 +3,233 @@ import json
 import tempfile
 import xml.etree.ElementTree as ET
 from pathlib import Path
-from typing import Literal, Union
+from typing import Callable, Iterator, Literal, Optional, Union
 
 import aiohttp
 
-from ._utils import ensure_session, is_up_to_date
+from ._freshness import get_if_modified, outdated
+from ._resilience import guarded
+from ._store import Store
+from ._utils import ensure_session, single_flight
 
 _BASE_PATH = Path(tempfile.gettempdir())
 
+_HEADWAY_VERSION = 'https://static.data.gov.hk/td/pt-headway-en/DATA_LAST_UPDATED_DATE.csv'
+_ROUTES_FARES_VERSION = 'https://static.data.gov.hk/td/routes-fares-xml/DATA_LAST_UPDATED_DATE.csv'
+
+_stores: dict[Path, Store] = {}
+
 
 def _bound_id_conv(bound_id: Literal['1', '2']):
     return 'outbound' if bound_id == '1' else 'inbound'
 
 
+def _store() -> Store:
+    # `_BASE_PATH` may be changed after import
+    path = _BASE_PATH.joinpath('_hketa_gtfs.sqlite3')
+    if path not in _stores:
+        _stores[path] = Store(path)
+    return _stores[path]
+
+
 @ensure_session
 async def journey_time(*, session: aiohttp.ClientSession):
-    path = _BASE_PATH.joinpath('_hketa_rb.json')
-    # path = Path(tempfile.gettempdir()).joinpath('_hketa_rb.xml')
-
-    if (path.exists()
-            and await is_up_to_date(path,
-                                    'https://static.data.gov.hk/td/routes-fares-xml/DATA_LAST_UPDATED_DATE.csv',
-                                    session)):
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-
-    async with session.get('https://static.data.gov.hk/td/routes-fares-xml/ROUTE_BUS.xml') as request:
-        data = {}
-        for r in ET.fromstring(await request.text()).iter('ROUTE'):
-            co = r.find('COMPANY_CODE').text.lower().split('+')
-            r_name = r.find('ROUTE_NAMEC').text
-
-            for c in co:
-                data.setdefault(c, {})
-                data[c].setdefault(r_name, [])
-                data[c][r_name].append({
-                    'td_route_id': r.find('ROUTE_ID').text,
-                    'orig': r.find('LOC_START_NAMEC').text,
-                    'dest': r.find('LOC_END_NAMEC').text,
-                    'time': r.find('JOURNEY_TIME').text,
-                })
-
-    path.write_text(json.dumps(data, ensure_ascii=False), encoding='utf-8')
+    url = 'https://static.data.gov.hk/td/routes-fares-xml/ROUTE_BUS.xml'
+    if (version := await outdated(_store(), 'journey_times', _ROUTES_FARES_VERSION, session)):
+        await _replace_if_modified('journey_times', url, version, _journey_time_rows, session)
+
+    data = {}
+    for co, route, *detail in _store().query('SELECT * FROM journey_times ORDER BY rowid'):
+        data.setdefault(co, {}).setdefault(route, []).append(_journey_time(detail))
     return data
 
 
+def find_journey_times(co: str, route: str) -> list[dict[str, str]]:
+    return [_journey_time(detail) for detail in _store().query(
+        'SELECT td_route_id, orig, dest, time FROM journey_times WHERE co = ? AND route = ?'
+        ' ORDER BY rowid',
+        (co, route))]
+
+
+def _journey_time(detail: tuple) -> dict[str, str]:
+    return dict(zip(('td_route_id', 'orig', 'dest', 'time'), detail))
+
+
+def _journey_time_rows(path: Path) -> Iterator[tuple]:
+    for _, r in ET.iterparse(path):
+        if r.tag != 'ROUTE':
+            continue
+        for c in r.find('COMPANY_CODE').text.lower().split('+'):
+            yield (c,
+                   r.find('ROUTE_NAMEC').text,
+                   r.find('ROUTE_ID').text,
+                   r.find('LOC_START_NAMEC').text,
+                   r.find('LOC_END_NAMEC').text,
+                   r.find('JOURNEY_TIME').text)
+        # the routes already stored are not kept in the tree
+        r.clear()
+
+
 @ensure_session
 async def gtfs_routes(*, session: aiohttp.ClientSession):
-    path = _BASE_PATH.joinpath('_hketa_gtfs_routes.json')
+    url = 'https://static.data.gov.hk/td/pt-headway-tc/routes.txt'
+    if (version := await outdated(_store(), 'routes', _HEADWAY_VERSION, session)):
+        await _replace_if_modified('routes', url, version, _route_rows, session)
+    return _all_routes()
 
-    if path.exists() and await is_up_to_date(path, 'https://static.data.gov.hk/td/pt-headway-en/DATA_LAST_UPDATED_DATE.csv', session):
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
 
+def _route_rows(path: Path) -> Iterator[tuple]:
+    for line in _read_csv(path):
+        if line[4] != '3':
+            continue
+        ends = line[3].replace('(循環線)', '').split(' - ')
+        for co in line[1].lower().split('+'):
+            yield (line[0], co, line[2], ends[0], ends[1] if len(ends) > 1 else None)
+
+
+def _all_routes() -> dict[str, dict[str, list[dict[str, str]]]]:
     routes = {}
-    async with session.get('https://static.data.gov.hk/td/pt-headway-tc/routes.txt') as request:
-        for line in (l for l in csv.reader((await request.text()).splitlines()[1:]) if l[4] == '3'):
-            for co in line[1].lower().split('+'):
-                routes.setdefault(co, {})
-                routes[co].setdefault(line[2], [])
-                routes[co][line[2]].append({
-                    'id': line[0],
-                    **dict(zip(('orig', 'dest'), line[3].replace('(循環線)', '').split(' - ')))
-                })
+    for rid, co, route, orig, dest in _store().query('SELECT * FROM routes ORDER BY rowid'):
+        routes.setdefault(co, {}).setdefault(route, []).append(_route(rid, orig, dest))
+    return routes
+
 
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(routes, f)
+def find_routes(co: str, route: str) -> list[dict[str, str]]:
+    '''Get the GTFS routes of a route number, `gtfs_routes()` must have been loaded.'''
+    return [_route(*r) for r in _store().query(
+        'SELECT id, orig, dest FROM routes WHERE co = ? AND route = ? ORDER BY rowid',
+        (co, route))]
+
+
+def _route(rid: str, orig: Optional[str], dest: Optional[str]) -> dict[str, str]:
+    return {'id': rid, 'orig': orig} if dest is None else {'id': rid, 'orig': orig, 'dest': dest}
 
 
 @ensure_session
 async def gtfs_calendar(*, session: aiohttp.ClientSession) -> dict[str, Union[str, list[str]]]:
-    path = _BASE_PATH.joinpath('_hketa_gtfs_calendar.json')
+    # the calendar spans two files, each is downloaded again only when it has changed
+    calendar_url = 'https://static.data.gov.hk/td/pt-headway-tc/calendar.txt'
+    dates_url = 'https://static.data.gov.hk/td/pt-headway-tc/calendar_dates.txt'
+    if (version := await outdated(_store(), 'calendar', _HEADWAY_VERSION, session)):
+        with tempfile.TemporaryDirectory() as staging:
+            rows, validators = {}, {}
+            for table, url, parse in (('calendar', calendar_url, _calendar_rows),
+                                      ('calendar_dates', dates_url, _calendar_date_rows)):
+                async with get_if_modified(_store(), url, session) as request:
+                    if request is not None:
+                        rows[table] = parse(await _save(request, Path(staging, f'{table}.txt')))
+                        validators[url] = request.headers
+
+            if rows:
+                # an unchanged file keeps its table as it is
+                await _store().replace('calendar', rows, version=version, validators=validators)
+            else:
+                await _store().set_version('calendar', version)
 
-    if path.exists() and await is_up_to_date(path, 'https://static.data.gov.hk/td/pt-headway-en/DATA_LAST_UPDATED_DATE.csv', session):
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+    calendar = {sid: _service(weekday)
+                for sid, weekday in _store().query('SELECT * FROM calendar')}
+    for sid, date, available in _store().query('SELECT * FROM calendar_dates ORDER BY rowid'):
+        calendar[sid]['incl' if available else 'excl'].append(date)
+    return calendar
 
-    async with session.get('https://static.data.gov.hk/td/pt-headway-tc/calendar.txt') as request:
-        calendar = {
-            c[0]: {
-                'weekday': tuple(1 if d == "1" else 0 for d in c[1:8]),
-                'incl': [],
-                'excl': []
-            } for c in csv.reader((await request.text()).splitlines()[1:])
-        }
 
-    async with session.get('https://static.data.gov.hk/td/pt-headway-tc/calendar_dates.txt') as request:
-        for d in csv.reader((await request.text()).splitlines()[1:]):
-            calendar[d[0]]['incl' if d[2] == '1' else 'excl'].append(d[1])
+def find_service(service_id: str) -> Optional[dict[str, Union[str, list[str]]]]:
+    '''Get the calendar of a service, `gtfs_calendar()` must have been loaded.'''
+    if not (weekday := _store().query(
+            'SELECT weekday FROM calendar WHERE service_id = ?', (service_id, ))):
+        return None
 
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(calendar, f)
+    service = _service(weekday[0][0])
+    for date, available in _store().query(
+            'SELECT date, available FROM calendar_dates WHERE service_id = ? ORDER BY rowid',
+            (service_id, )):
+        service['incl' if available else 'excl'].append(date)
+    return service
 
-    return calendar
+
+def _service(weekday: str) -> dict[str, Union[str, list[str]]]:
+    return {'weekday': tuple(int(d) for d in weekday), 'incl': [], 'excl': []}
+
+
+def _calendar_rows(path: Path) -> Iterator[tuple]:
+    return ((c[0], ''.join('1' if d == '1' else '0' for d in c[1:8])) for c in _read_csv(path))
+
+
+def _calendar_date_rows(path: Path) -> Iterator[tuple]:
+    return ((d[0], d[1], d[2] == '1') for d in _read_csv(path))
 
 
 @ensure_session
 async def gtfs_frequencies(*, session: aiohttp.ClientSession):
-    path = _BASE_PATH.joinpath('_hketa_gtfs_freq.json')
-    # schedules = {}
-    # async with session.get('https://static.data.gov.hk/td/pt-headway-tc/trips.txt') as request:
-    #     trips = {}
-    #     for t in (l[-1].split('-') for l in csv.reader((await request.text()).splitlines()[1:])):
-    #         direction = 'outbound' if t[1] == '1' else 'inbound'
-    #         trips.setdefault(t[0], {})
-    #         trips[t[0]].setdefault(direction, {})
-    #         trips[t[0]][direction].setdefault(t[2], [])
-    #         trips[t[0]][direction][t[2]].append(t[3])
-
-    async with session.get('https://static.data.gov.hk/td/pt-headway-tc/frequencies.txt') as request:
-        freqs = {}
-        for freq in csv.reader((await request.text()).splitlines()[1:]):
-            rid, bound, sid, _ = freq[0].split('-')
-            bound = _bound_id_conv(bound)
-
-            freqs.setdefault(rid, {'outbound': {}, 'inbound': {}})
-            freqs[rid][bound].setdefault(sid, [])
-            freqs[rid][bound][sid].append({
-                'start': freq[1],
-                'end': freq[2],
-                'interval': freq[3]
-            })
-
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(freqs, f)
+    url = 'https://static.data.gov.hk/td/pt-headway-tc/frequencies.txt'
+    if (version := await outdated(_store(), 'frequencies', _HEADWAY_VERSION, session)):
+        await _replace_if_modified('frequencies', url, version, _frequency_rows, session)
+    return _all_frequencies()
+
+
+def _frequency_rows(path: Path) -> Iterator[tuple]:
+    for freq in _read_csv(path):
+        rid, bound, sid, _ = freq[0].split('-')
+        yield (rid, _bound_id_conv(bound), sid, freq[1], freq[2], freq[3])
+
+
+def _all_frequencies() -> dict[str, dict[str, dict[str, list[dict[str, str]]]]]:
+    freqs = {}
+    for rid, *freq in _store().query('SELECT * FROM frequencies ORDER BY rowid'):
+        _add_frequency(freqs.setdefault(rid, {'outbound': {}, 'inbound': {}}), *freq)
+    return freqs
+
+
+def find_frequencies(route_id: str) -> dict[str, dict[str, list[dict[str, str]]]]:
+    '''Get the headways of a GTFS route, `gtfs_frequencies()` must have been loaded.'''
+    freqs = {'outbound': {}, 'inbound': {}}
+    for freq in _store().query(
+            'SELECT bound, service_id, start, end, interval FROM frequencies'
+            ' WHERE route_id = ? ORDER BY rowid',
+            (route_id, )):
+        _add_frequency(freqs, *freq)
+    return freqs
+
+
+def _add_frequency(freqs: dict, bound: str, sid: str, start: str, end: str, interval: str):
+    freqs[bound].setdefault(sid, []).append({'start': start, 'end': end, 'interval': interval})
 
 
 @ensure_session
 async def gtfs_fares(*, session: aiohttp.ClientSession):
-    path = _BASE_PATH.joinpath('_hketa_gtfs_fares.json')
+    url = 'https://static.data.gov.hk/td/pt-headway-tc/fare_attributes.txt'
+    if (version := await outdated(_store(), 'fares', _HEADWAY_VERSION, session)):
+        await _replace_if_modified('fares', url, version, _fare_rows, session)
+    return _all_fares()
 
-    if path.exists() and await is_up_to_date(path, 'https://static.data.gov.hk/td/pt-headway-en/DATA_LAST_UPDATED_DATE.csv', session):
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
 
-    async with session.get('https://static.data.gov.hk/td/pt-headway-tc/fare_attributes.txt') as request:
-        fares = {}
-        for fare in csv.reader((await request.text()).splitlines()[1:]):
-            rid, bound, idx_on, idx_off = fare[0].split('-')
+def _fare_rows(path: Path) -> Iterator[tuple]:
+    for fare in _read_csv(path):
+        rid, bound, idx_on, idx_off = fare[0].split('-')
 
-            if int(idx_off) - int(idx_on) != 1:
-                continue
+        if int(idx_off) - int(idx_on) != 1:
+            continue
+        yield (rid, _bound_id_conv(bound), fare[1])
 
-            fares.setdefault(rid, {'outbound': [], 'inbound': []})
-            fares[rid][_bound_id_conv(bound)].append(fare[1])
 
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(fares, f)
+def _all_fares() -> dict[str, dict[str, list[str]]]:
+    fares = {}
+    for rid, bound, fare in _store().query('SELECT * FROM fares ORDER BY rowid'):
+        fares.setdefault(rid, {'outbound': [], 'inbound': []})[bound].append(fare)
+    return fares
 
 
-@ensure_session
-async def gtfs_stops(*, session: aiohttp.ClientSession):
-    path = _BASE_PATH.joinpath('_hketa_gtfs_stops.json')
+def find_fares(route_id: str) -> dict[str, list[str]]:
+    '''Get the section fares of a GTFS route, `gtfs_fares()` must have been loaded.'''
+    fares = {'outbound': [], 'inbound': []}
+    for bound, fare in _store().query(
+            'SELECT bound, fare FROM fares WHERE route_id = ? ORDER BY rowid', (route_id, )):
+        fares[bound].append(fare)
+    return fares
 
-    if path.exists() and await is_up_to_date(path, 'https://static.data.gov.hk/td/pt-headway-en/DATA_LAST_UPDATED_DATE.csv', session):
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
 
+@ensure_session
+async def gtfs_stops(*, session: aiohttp.ClientSession):
     def parse_name(names: str):
         parsed = {}
         for name in [n for n in names.split('|') if '+' not in n]:
@@ -173,14 +243,161 @@ async def gtfs_stops(*, session: aiohttp.ClientSession):
         # {co: gtfs_name for name in names.split('|') for co, gtfs_name in [name.split(' ', 1)]}
         return parsed
 
-    async with session.get('https://static.data.gov.hk/td/pt-headway-tc/stops.txt') as request:
-        stops = {
-            s[0]: {
-                'name': parse_name(s[1]),
-                'lat': s[2],
-                'lng': s[3]
-            } for s in csv.reader((await request.text()).splitlines()[1:])
-        }
-
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(stops, f)
+    url = 'https://static.data.gov.hk/td/pt-headway-tc/stops.txt'
+    if (version := await outdated(_store(), 'stops', _HEADWAY_VERSION, session)):
+        await _replace_if_modified(
+            'stops', url, version,
+            lambda path: ((s[0], json.dumps(parse_name(s[1]), ensure_ascii=False), s[2], s[3])
+                          for s in _read_csv(path)),
+            session)
+
+    return {sid: _stop(*s) for sid, *s in _store().query('SELECT * FROM stops')}
+
+
+def find_stop(stop_id: str) -> Optional[dict[str,]]:
+    '''Get a GTFS stop, `gtfs_stops()` must have been loaded.'''
+    stop = _store().query('SELECT name, lat, lng FROM stops WHERE id = ?', (stop_id, ))
+    return _stop(*stop[0]) if stop else None
+
+
+def _stop(name: str, lat: str, lng: str) -> dict[str,]:
+    return {'name': json.loads(name), 'lat': lat, 'lng': lng}
+
+
+@ensure_session
+async def gtfs_trips(*, session: aiohttp.ClientSession) -> int:
+    '''Stream the trips and their stop times into the store, see `_trips` to read them.
+
+    Unlike the other loaders, nothing is read back into memory: the stop times run into
+    millions of rows and are only ever needed one route at a time. Both files are
+    downloaded to disk first, so the store is only locked while they are written.
+
+    Returns:
+        Number of trips stored.
+    '''
+    await _load_trips('trips', session)
+    return _store().query('SELECT COUNT(*) FROM trips')[0][0]
+
+
+@single_flight
+async def _load_trips(dataset: str, session: aiohttp.ClientSession) -> None:
+    '''Stage and store the trips once for all the concurrent callers, e.g. at a cold start.'''
+    if (version := await outdated(_store(), dataset, _HEADWAY_VERSION, session)):
+        with tempfile.TemporaryDirectory() as staging:
+            trips_path = await _stage(
+                'https://static.data.gov.hk/td/pt-headway-tc/trips.txt', staging, session)
+            stop_times_path = await _stage(
+                'https://static.data.gov.hk/td/pt-headway-tc/stop_times.txt', staging, session)
+
+            await _store().replace(dataset,
+                                   _trip_rows(trips_path, stop_times_path),
+                                   version=version)
+
+
+async def _stage(url: str, directory: str, session: aiohttp.ClientSession) -> Path:
+    '''Download `url` into `directory` chunk by chunk.'''
+    async with guarded(session.get, url, 'td.dataset', stream=True) as request:
+        request.raise_for_status()
+        return await _save(request, Path(directory, url.rsplit('/', 1)[-1]))
+
+
+async def _save(request: aiohttp.ClientResponse, path: Path) -> Path:
+    '''Write the body of `request` to `path` chunk by chunk.'''
+    with open(path, 'wb') as f:
+        async for chunk in request.content.iter_chunked(65536):
+            f.write(chunk)
+    return path
+
+
+async def _replace_if_modified(dataset: str,
+                               url: str,
+                               version: str,
+                               rows: Callable[[Path], Iterator[tuple]],
+                               session: aiohttp.ClientSession) -> None:
+    '''Replace the table `dataset` with the `rows` of the file at `url` if it has changed.
+
+    The file is staged on disk and its rows are read back by the worker thread of the
+    store, so they are never all held in memory.
+    '''
+    async with get_if_modified(_store(), url, session) as request:
+        if request is None:
+            await _store().set_version(dataset, version)
+            return
+        with tempfile.TemporaryDirectory() as staging:
+            path = await _save(request, Path(staging, url.rsplit('/', 1)[-1]))
+            await _store().replace(dataset,
+                                   {dataset: rows(path)},
+                                   version=version,
+                                   validators={url: request.headers})
+
+
+def _trip_rows(trips_path: Path, stop_times_path: Path) -> dict[str, Iterator[tuple]]:
+    '''Get generators of the rows of the trip tables, which must be consumed in order.'''
+    trips, stops = {}, {}
+
+    def trip_rows():
+        for trip in _read_csv(trips_path):
+            # trip ID: <route ID>-<bound>-<service ID>-<start time>
+            trips[trip[-1]] = len(trips)
+            yield (trips[trip[-1]],
+                   trip[-1],
+                   trip[0],
+                   _bound_id_conv(trip[-1].split('-')[1]),
+                   trip[1])
+
+    def stop_time_rows():
+        for st in _read_csv(stop_times_path):
+            if (stop := stops.get(st[3])) is None:
+                stop = stops[st[3]] = len(stops)
+            yield (trips[st[0]], int(st[4]), stop, to_seconds(st[1]), to_seconds(st[2]))
+
+    def stop_code_rows():
+        # the codes are assigned while reading the stop times
+        yield from ((code, sid) for sid, code in stops.items())
+
+    return {'trips': trip_rows(), 'stop_times': stop_time_rows(), 'stop_codes': stop_code_rows()}
+
+
+def _read_csv(path: Path) -> Iterator[list[str]]:
+    '''Read the rows of a downloaded CSV file, without its header.'''
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        yield from reader
+
+
+def to_seconds(hms: str) -> int:
+    '''Convert a GTFS time (which may exceed 24:00:00) to seconds, -1 if empty.'''
+    if not hms:
+        return -1
+    h, m, s = hms.split(':')
+    return int(h) * 3600 + int(m) * 60 + int(s)
+
+
+def find_trips(route_id: str) -> list[tuple[int, str, str, str]]:
+    '''Get the (code, ID, bound, service ID) of the trips of a GTFS route, ordered by code.
+
+    `gtfs_trips()` must have been loaded.
+    '''
+    return _store().query(
+        'SELECT code, id, bound, service_id FROM trips WHERE route_id = ? ORDER BY code',
+        (route_id, ))
+
+
+def find_stop_times(route_id: str) -> list[tuple[int, int, int, int]]:
+    '''Get the (trip code, stop code, arrival, departure) of a GTFS route, ordered by trip and
+    stop sequence. `gtfs_trips()` must have been loaded.
+    '''
+    return _store().query(
+        'SELECT trip, stop, arrival, departure FROM stop_times'
+        ' WHERE trip IN (SELECT code FROM trips WHERE route_id = ?) ORDER BY trip, seq',
+        (route_id, ))
+
+
+def stop_codes() -> list[str]:
+    '''Get the stop IDs indexed by the codes used in the stop times.'''
+    return [sid for sid, in _store().query('SELECT id FROM stop_codes ORDER BY code')]
+
+
+def dataset_version(dataset: str) -> Optional[str]:
+    return _store().version(dataset)
@@ -0,0 +1,158 @@
+import time
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from typing import Optional, Union
+
+import aiohttp
+
+from . import t
+from ._freshness import FEEDS
+from ._gtfs_parser import (find_routes, gtfs_calendar, gtfs_frequencies, gtfs_routes,
+                           to_seconds)
+from ._matcher import gtfs_id
+from ._utils import ERR_MESSAGES, HKT, ensure_session, error_compact, error_eta, expand
+
+# transports covered by the TD headway data
+TRANSPORTS = ('kmb', 'ctb', 'nlb', 'lrtfeeder')
+
+# the estimates are departures from the origin of the route, not arrivals at the stop
+REMARKS = {
+    'tc': '按班次表估算總站開出時間',
+    'en': 'Departure from Origin, Estimated from Timetable',
+}
+
+# real-time results worth replacing by an estimate, either as codes or messages
+_FAILURES = frozenset(('api-error', 'empty',
+                       *(m for k in ('api-error', 'empty') for m in ERR_MESSAGES[k].values())))
+
+_index: Optional['HeadwayIndex'] = None
+_index_expiry = 0.0
+
+
+class HeadwayIndex:
+    '''Headways of the GTFS routes keyed by (route ID, direction, service ID).
+
+    The rows of each key are kept as parallel arrays of seconds since the start of the
+    service day, sorted by start time, so the next departures are found by binary search.
+
+    Args:
+        frequencies: As returned by `gtfs_frequencies()`.
+        calendar: As returned by `gtfs_calendar()`.
+    '''
+
+    def __init__(self, frequencies: dict, calendar: dict) -> None:
+        self._services: dict[tuple[str, str], list[str]] = {}
+        self._rows: dict[tuple[str, str, str], tuple[array, array, array]] = {}
+        for rid, bounds in frequencies.items():
+            for bound, services in bounds.items():
+                for sid, freqs in services.items():
+                    freqs = sorted(
+                        (to_seconds(f['start']), to_seconds(f['end']), int(f['interval']))
+                        for f in freqs)
+                    self._services.setdefault((rid, bound), []).append(sid)
+                    self._rows[(rid, bound, sid)] = tuple(array('l', col) for col in zip(*freqs))
+        self._calendar = {sid: (s['weekday'], frozenset(s['incl']), frozenset(s['excl']))
+                          for sid, s in calendar.items()}
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def departures(self,
+                   route_id: str,
+                   direction: t.Direction,
+                   after: datetime,
+                   count: int = 3) -> list[datetime]:
+        '''Get the next `count` scheduled departures of a GTFS route after `after`.'''
+        after = after.astimezone(HKT)
+        midnight = after.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        found = []
+        # trips of the previous service day may run past midnight (e.g. 25:10:00),
+        # and the next service day may be needed late at night
+        for day in (midnight + timedelta(days=d) for d in (-1, 0, 1)):
+            secs = int((after - day).total_seconds())
+            for sid in self._services.get((route_id, direction), ()):
+                if self._runs_on(sid, day):
+                    rows = self._rows[(route_id, direction, sid)]
+                    found.extend(day + timedelta(seconds=s) for s in _next(rows, secs, count))
+        return sorted(found)[:count]
+
+    def _runs_on(self, service_id: str, day: datetime) -> bool:
+        weekday, incl, excl = self._calendar.get(service_id, ((0, ) * 7, (), ()))
+        date = day.strftime('%Y%m%d')
+        if date in excl:
+            return False
+        return date in incl or weekday[day.weekday()] == 1
+
+
+@ensure_session
+async def headway_index(*, session: aiohttp.ClientSession) -> HeadwayIndex:
+    '''Get the shared headway index, rebuilt once the feed version check is due again.'''
+    global _index, _index_expiry  # pylint: disable=global-statement
+
+    if _index is None or _index_expiry <= time.monotonic():
+        # one after another, as the datasets are written to the same store
+        frequencies = await gtfs_frequencies(session=session)
+        calendar = await gtfs_calendar(session=session)
+        await gtfs_routes(session=session)
+        _index, _index_expiry = HeadwayIndex(frequencies, calendar), \
+            time.monotonic() + FEEDS.interval
+    return _index
+
+
+@ensure_session
+async def scheduled_etas(co: t.Transport,
+                         route_id: str,
+                         language: t.Language = 'tc',
+                         *,
+                         count: int = 3,
+                         compact: bool = False,
+                         session: aiohttp.ClientSession) -> Union[t.Etas, t.CompactEtas]:
+    '''Estimate the next departures of a route from its origin with the TD headway data.
+
+    The times are not adjusted to any stop along the route, the remark of each ETA
+    says they are departures from the origin.
+    '''
+    route, direction, *_ = route_id.split('_')
+    index = await headway_index(session=session)
+    # without the routes having been loaded, assume the regular service, which is listed first
+    if (gtfs_route := gtfs_id(co, route_id)) is None:
+        if not (gtfs_routes_ := find_routes(co, route)):
+            raise KeyError('route not exists')
+        gtfs_route = gtfs_routes_[0]['id']
+
+    now = datetime.now(HKT)
+    if not (departures := index.departures(gtfs_route, direction, now, count)):
+        return error_compact('eos', int(now.timestamp())) if compact \
+            else error_eta('eos', now, language)
+
+    etas_ = t.CompactEtas(
+        int(now.timestamp()),
+        None,
+        tuple(t.CompactEta(int(d.timestamp()), False, True, None, None, None, None,
+                           REMARKS[language])
+              for d in departures))
+    return etas_ if compact else expand(etas_, language)
+
+
+def is_failure(etas: Union[t.Etas, t.CompactEtas]) -> bool:
+    '''Whether a real-time result is an `empty` or `api-error` that an estimate can replace.'''
+    if isinstance(etas, t.CompactEtas):
+        return etas.etas is None and etas.message in _FAILURES
+    return etas['etas'] is None and etas['message'] in _FAILURES
+
+
+def _next(rows: tuple[array, array, array], secs: int, count: int) -> list[int]:
+    starts, ends, intervals = rows
+    departures = []
+    # the last window starting before `secs` may still be running
+    for idx in range(max(bisect_right(starts, secs) - 1, 0), len(starts)):
+        if len(departures) >= count:
+            break
+        if ends[idx] <= secs:
+            continue
+        interval = max(intervals[idx], 1)
+        first = starts[idx] + max(-(-(secs - starts[idx]) // interval), 0) * interval
+        departures.extend(range(first, ends[idx], interval)[:count - len(departures)])
+    return departures
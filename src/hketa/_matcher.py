@@ -0,0 +1,150 @@
+import asyncio
+import sqlite3
+import string
+from typing import Optional
+
+import aiohttp
+
+from . import t
+from ._gtfs_parser import dataset_version, gtfs_routes
+
+# GTFS operators the routes of each transport may be listed under
+OPERATORS = {
+    'kmb': ('kmb', 'lwb'),
+    'ctb': ('ctb', ),
+    'nlb': ('nlb', ),
+    'lrtfeeder': ('lrtfeeder', ),
+}
+
+# minimum similarity (of both ends together, out of 2) to match a special service
+THRESHOLD = 0.6
+
+_PUNCTUATION = str.maketrans('', '', string.punctuation + string.whitespace + '（）．，、　')
+
+_index: Optional['GtfsIndex'] = None
+
+# keyed by transport: GTFS version and the matches keyed by service ID
+_matches: dict[str, tuple[Optional[str], dict[str, tuple[tuple, Optional[str]]]]] = {}
+
+
+class GtfsIndex:
+    '''N-grams of the normalized ends of the GTFS routes, keyed by (operator, route number).
+
+    Args:
+        version: Version of the GTFS routes the index is built from.
+        routes: As returned by `gtfs_routes()`.
+    '''
+
+    def __init__(self, version: Optional[str], routes: dict) -> None:
+        self.version = version
+        self._routes: dict[tuple[str, str], list[tuple[str, frozenset, frozenset]]] = {
+            (co, no): [(r['id'], ngrams(r['orig']), ngrams(r.get('dest') or r['orig']))
+                       for r in services]
+            for co, numbers in routes.items()
+            for no, services in numbers.items()
+        }
+
+    def candidates(self, co: t.Transport, route_no: str) -> list[tuple[str, frozenset, frozenset]]:
+        return [c for op in OPERATORS.get(co, ()) for c in self._routes.get((op, route_no), ())]
+
+
+def normalize(name: str) -> str:
+    return name.replace('(循環線)', '').translate(_PUNCTUATION).upper()
+
+
+def ngrams(name: Optional[str], n: int = 2) -> frozenset[str]:
+    if not (name := normalize(name or '')):
+        return frozenset()
+    return frozenset(name[i:i + n] for i in range(max(len(name) - n + 1, 1)))
+
+
+def similarity(a: frozenset[str], b: frozenset[str]) -> float:
+    '''Dice coefficient of two n-gram sets.'''
+    return 2 * len(a & b) / (len(a) + len(b)) if a and b else 0.0
+
+
+def match(candidates: list[tuple[str, frozenset, frozenset]],
+          services: list[t.Route.Service]) -> list[Optional[str]]:
+    '''Assign the GTFS routes to the services of a route number in one direction.
+
+    A GTFS route covers both directions, so each end is compared both ways. Every
+    GTFS route is assigned at most once, and the regular service (the first one)
+    always gets the closest remaining route.
+    '''
+    if not candidates:
+        return [None] * len(services)
+
+    scores = []
+    for idx, service in enumerate(services):
+        orig, dest = ngrams(service['orig'].get('tc')), ngrams(service['dest'].get('tc'))
+        desc = ngrams((service.get('description') or {}).get('tc'))
+        for cidx, (_, c_orig, c_dest) in enumerate(candidates):
+            score = max(similarity(orig, c_orig) + similarity(dest, c_dest),
+                        similarity(orig, c_dest) + similarity(dest, c_orig))
+            # special services often differ by a "via" stated in the description only
+            score += max(similarity(desc, c_orig), similarity(desc, c_dest)) / 2
+            scores.append((score, idx, cidx))
+
+    assigned: list[Optional[str]] = [None] * len(services)
+    used = set()
+    for score, idx, cidx in sorted(scores, key=lambda s: (-s[0], s[1], s[2])):
+        if assigned[idx] is None and cidx not in used and (idx == 0 or score >= THRESHOLD):
+            assigned[idx] = candidates[cidx][0]
+            used.add(cidx)
+    return assigned
+
+
+async def gtfs_index(session: aiohttp.ClientSession) -> GtfsIndex:
+    '''Get the shared index, rebuilt when the GTFS routes have been updated.'''
+    global _index  # pylint: disable=global-statement
+
+    routes = await gtfs_routes(session=session)
+    if _index is None or _index.version != dataset_version('routes'):
+        _index = GtfsIndex(dataset_version('routes'), routes)
+    return _index
+
+
+async def attach_gtfs_ids(co: t.Transport,
+                          routes: dict[str, t.Route],
+                          session: aiohttp.ClientSession) -> dict[str, t.Route]:
+    '''Set the `gtfs_id` of every service of `routes` in place.
+
+    Matches are cached against the GTFS version, so only new or changed services are matched
+    again on later reloads. Transports without GTFS data (e.g. rail) get `None`, as do all
+    services when the GTFS routes cannot be loaded.
+    '''
+    try:
+        index = await gtfs_index(session) if co in OPERATORS else None
+    except (aiohttp.ClientError, asyncio.TimeoutError, sqlite3.Error, IndexError, ValueError):
+        # matching is optional, the routes are served unmatched rather than not at all
+        index = None
+    if index is None:
+        for service in (s for bounds in routes.values() for ss in bounds.values() for s in ss):
+            service['gtfs_id'] = None
+        return routes
+
+    if _matches.get(co, (None, ))[0] != index.version:
+        _matches[co] = (index.version, {})
+    matches = _matches[co][1]
+    for no, bounds in routes.items():
+        for services in bounds.values():
+            keys = [_service_key(s) for s in services]
+            if any(matches.get(s['id'], (None, ))[0] != k for s, k in zip(services, keys)):
+                for service, key, matched in zip(services,
+                                                  keys,
+                                                  match(index.candidates(co, no), services)):
+                    matches[service['id']] = (key, matched)
+            for service in services:
+                service['gtfs_id'] = matches[service['id']][1]
+    return routes
+
+
+def gtfs_id(co: t.Transport, route_id: str) -> Optional[str]:
+    '''Get the GTFS route matched to a service by the last `attach_gtfs_ids()` of its transport.'''
+    return _matches.get(co, (None, {}))[1].get(route_id, (None, None))[1]
+
+
+def _service_key(service: t.Route.Service) -> tuple:
+    return (service['orig'].get('tc'),
+            service['dest'].get('tc'),
+            (service.get('description') or {}).get('tc'))
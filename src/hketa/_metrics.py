@@ -0,0 +1,144 @@
+import time
+from functools import wraps
+from types import SimpleNamespace
+from typing import Callable, Optional
+
+import aiohttp
+
+# called with the metric name, the value and its labels (`transport` and `endpoint`)
+Sink = Callable[[str, float, dict[str, str]], None]
+
+_sinks: list[Sink] = []
+
+
+class MetricsRegistry:
+    '''A sink keeping the count, sum and maximum of every metric and label set.
+
+        registry = hketa.MetricsRegistry()
+        hketa.add_metrics_sink(registry)
+        ...
+        print(registry.expose())
+    '''
+
+    def __init__(self) -> None:
+        self._series: dict[tuple[str, tuple[tuple[str, str], ...]], list[float]] = {}
+
+    def __call__(self, name: str, value: float, labels: dict[str, str]) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        if (series := self._series.get(key)) is None:
+            self._series[key] = [1, value, value]
+        else:
+            series[0] += 1
+            series[1] += value
+            series[2] = max(series[2], value)
+
+    def samples(self) -> list[tuple[str, dict[str, str], dict[str, float]]]:
+        '''Get the (name, labels, {`count`, `sum`, `max`}) of every series.'''
+        return [(name, dict(labels), {'count': count, 'sum': sum_, 'max': max_})
+                for (name, labels), (count, sum_, max_) in self._series.items()]
+
+    def expose(self) -> str:
+        '''Render the series in the Prometheus text format, as summaries without quantiles.'''
+        lines = []
+        for (name, labels), (count, sum_, _) in sorted(self._series.items()):
+            label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f'{name}_count{{{label_text}}} {count}')
+            lines.append(f'{name}_sum{{{label_text}}} {sum_}')
+        return '\n'.join(lines) + '\n'
+
+    def clear(self) -> None:
+        self._series.clear()
+
+
+def add_metrics_sink(sink: Sink) -> None:
+    '''Start passing the metrics of the package to `sink`.
+
+    Metrics, labelled by `transport` (empty for shared services such as geocoding)
+    and `endpoint`:
+        hketa_dns_seconds, hketa_connection_queue_seconds, hketa_connect_seconds:
+            Resolving the host, waiting for a free connection, and connecting.
+        hketa_wait_seconds: From sending the request headers to receiving the response headers.
+        hketa_read_seconds, hketa_response_bytes: Downloading the response body.
+        hketa_decode_seconds: Handling the downloaded body, mostly decoding the JSON.
+        hketa_request_seconds: The whole request, including retries.
+        hketa_request_errors: Failed attempts, with a value of 1.
+        hketa_parse_seconds: Turning an upstream response into ETAs.
+
+    The connection metrics are only available for the sessions created by the package,
+    add `trace_config()` to your own sessions to include them.
+    '''
+    if sink not in _sinks:
+        _sinks.append(sink)
+
+
+def remove_metrics_sink(sink: Sink) -> None:
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+
+def emit(name: str, value: float, labels: dict[str, str]) -> None:
+    for sink in _sinks:
+        sink(name, value, labels)
+
+
+def enabled() -> bool:
+    return bool(_sinks)
+
+
+def labels(endpoint: str) -> dict[str, str]:
+    '''Split an endpoint name (e.g. `kmb.eta`) into the labels of its metrics.'''
+    transport, _, name = endpoint.rpartition('.')
+    return {'transport': transport, 'endpoint': name}
+
+
+def timed(endpoint: str, name: str = 'hketa_parse_seconds'):
+    '''Report the time taken by each call of a function.'''
+    labels_ = labels(endpoint)
+
+    def decorator(func: Callable):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                emit(name, time.perf_counter() - start, labels_)
+        return wrapper
+    return decorator
+
+
+def _labels_of(ctx: SimpleNamespace) -> dict[str, str]:
+    return (ctx.trace_request_ctx or {}).get('labels') or {'transport': '', 'endpoint': ''}
+
+
+def _span(start_attr: str, metric: Optional[str]):
+    '''Trace callback saving the start time, or reporting the time since it.'''
+    async def callback(_session: aiohttp.ClientSession, ctx: SimpleNamespace, _params) -> None:
+        if not _sinks:
+            return
+        if metric is None:
+            setattr(ctx, start_attr, time.perf_counter())
+        elif (start := getattr(ctx, start_attr, None)) is not None:
+            emit(metric, time.perf_counter() - start, _labels_of(ctx))
+    return callback
+
+
+def trace_config() -> aiohttp.TraceConfig:
+    '''Get a trace config reporting the connection and server waiting times of requests.'''
+    config = aiohttp.TraceConfig()
+    config.on_dns_resolvehost_start.append(_span('dns', None))
+    config.on_dns_resolvehost_end.append(_span('dns', 'hketa_dns_seconds'))
+    config.on_connection_queued_start.append(_span('queued', None))
+    config.on_connection_queued_end.append(_span('queued', 'hketa_connection_queue_seconds'))
+    config.on_connection_create_start.append(_span('connect', None))
+    config.on_connection_create_end.append(_span('connect', 'hketa_connect_seconds'))
+    config.on_request_headers_sent.append(_span('sent', None))
+    config.on_request_end.append(_span('sent', 'hketa_wait_seconds'))
+    return config
+
+
+def client_session(**kwargs) -> aiohttp.ClientSession:
+    '''Create a session reporting to the metrics sinks, see `trace_config()`.'''
+    return aiohttp.ClientSession(trace_configs=[trace_config()], **kwargs)
@@ -0,0 +1,126 @@
+import asyncio
+import math
+from array import array
+from typing import Iterable
+
+import aiohttp
+
+from . import ctb, kmb, lrt, lrtfeeder, mtr, nlb, t
+from ._cache import TTLCache
+from ._utils import ensure_session, single_flight
+
+# metres per degree around Hong Kong, distances are measured on this local projection
+_M_PER_LAT = 110_574
+_M_PER_LNG = 111_320 * math.cos(math.radians(22.35))
+
+_SOURCES = {
+    'kmb': kmb.stop_locations,
+    'ctb': ctb.stop_locations,
+    'nlb': nlb.stop_locations,
+    'mtr': mtr.stop_locations,
+    'lrt': lrt.stop_locations,
+    'lrtfeeder': lrtfeeder.stop_locations,
+}
+
+# transports without a bulk stop listing, only the stops fetched so far are known
+_FETCHED_SO_FAR = {'ctb', 'nlb'}
+
+# keyed by transport, rebuilt hourly to include the stops changed in the meantime
+GRIDS = TTLCache(maxsize=16, ttl=3600)
+
+
+class StopGrid:
+    '''Stops bucketed into square cells of `cell` metres for radius queries.
+
+    A query only measures the stops in the cells overlapping its circle.
+
+    Args:
+        stops: (ID, name, (latitude, longitude)) of each stop.
+        cell: Length of a cell side in metres, about the usual query radius.
+    '''
+
+    def __init__(self,
+                 stops: Iterable[t.StopLocation],
+                 cell: float = 250) -> None:
+        self.cell = cell
+        self.stops = list(stops)
+        self._xs = array('d', (lng * _M_PER_LNG for _, _, (_, lng) in self.stops))
+        self._ys = array('d', (lat * _M_PER_LAT for _, _, (lat, _) in self.stops))
+        self._cells: dict[tuple[int, int], list[int]] = {}
+        for idx, (x, y) in enumerate(zip(self._xs, self._ys)):
+            self._cells.setdefault((int(x // cell), int(y // cell)), []).append(idx)
+
+    def __len__(self) -> int:
+        return len(self.stops)
+
+    def query(self, lat: float, lng: float, radius: float) -> list[tuple[float, int]]:
+        '''Get the (distance in metres, index) of the stops within `radius`, nearest first.'''
+        x, y = lng * _M_PER_LNG, lat * _M_PER_LAT
+        cx, cy, span = int(x // self.cell), int(y // self.cell), math.ceil(radius / self.cell)
+        found = []
+        for i in range(cx - span, cx + span + 1):
+            for j in range(cy - span, cy + span + 1):
+                for idx in self._cells.get((i, j), ()):
+                    if (distance := math.hypot(self._xs[idx] - x, self._ys[idx] - y)) <= radius:
+                        found.append((distance, idx))
+        found.sort()
+        return found
+
+
+@single_flight
+async def grid(co: t.Transport, session: aiohttp.ClientSession) -> StopGrid:
+    '''Get the shared grid of the stops of a transport.'''
+    if co in _FETCHED_SO_FAR:
+        # the stops fetched since the grid was built must not wait for it to expire
+        stops = await _SOURCES[co](session=session)
+        if (grid_ := GRIDS.get(co)) is None or grid_.stops != stops:
+            GRIDS.set(co, grid_ := StopGrid(stops))
+    elif (grid_ := GRIDS.get(co)) is None:
+        GRIDS.set(co, grid_ := StopGrid(await _SOURCES[co](session=session)))
+    return grid_
+
+
+@ensure_session
+async def nearby_many(points: Iterable[tuple[float, float]],
+                      radius: float = 300,
+                      transports: Iterable[t.Transport] = None,
+                      *,
+                      session: aiohttp.ClientSession) -> list[list[dict[str,]]]:
+    '''Find the stops within `radius` metres of each (latitude, longitude) in `points`.
+
+    The stop locations of each transport are loaded once and indexed, later queries
+    are answered from memory. A transport whose stops cannot be loaded is left out.
+    Citybus and NLB have no stop listing, only their stops fetched so far are found.
+
+    Returns:
+        For each point, the stops found nearest first, as dicts of `co`, `id`, `name`,
+        `location` and `distance` (metres).
+    '''
+    transports = list(transports or _SOURCES.keys())
+    loaded = await asyncio.gather(*[grid(co, session) for co in transports],
+                                  return_exceptions=True)
+    grids = [(co, g) for co, g in zip(transports, loaded) if not isinstance(g, Exception)]
+
+    results = []
+    for lat, lng in points:
+        found = [(distance, co, g.stops[idx])
+                 for co, g in grids for distance, idx in g.query(lat, lng, radius)]
+        found.sort(key=lambda f: f[0])
+        results.append([{
+            'co': co,
+            'id': stop_id,
+            'name': name,
+            'location': location,
+            'distance': distance,
+        } for distance, co, (stop_id, name, location) in found])
+    return results
+
+
+async def nearby(lat: float,
+                 lng: float,
+                 radius: float = 300,
+                 transports: Iterable[t.Transport] = None,
+                 *,
+                 session: aiohttp.ClientSession = None) -> list[dict[str,]]:
+    '''Find the stops within `radius` metres of a point, see `nearby_many()`.'''
+    return (await nearby_many([(lat, lng)], radius, transports, session=session))[0]
@@ -0,0 +1,72 @@
+import asyncio
+import csv
+import time
+from typing import Callable, Hashable, Optional
+
+import aiohttp
+
+from ._resilience import guarded
+from ._utils import single_flight
+
+
+class CsvDataset:
+    '''A MTR open data CSV file downloaded and parsed once, then indexed by `key`.
+
+    After `check_interval` seconds the file is revalidated with a conditional GET,
+    and only downloaded and parsed again when it has changed. The rows already loaded
+    are kept when the revalidation fails.
+
+    Args:
+        url: URL of the CSV file.
+        key: Maps a row to its index key, e.g. `(route, direction, branch)`.
+        check_interval: Seconds between two revalidations.
+        endpoint: Name of the requests for their policy and metrics, e.g. `mtr.stations`.
+    '''
+
+    def __init__(self,
+                 url: str,
+                 key: Callable[[list[str]], Hashable],
+                 check_interval: float = 3600,
+                 endpoint: str = 'opendata') -> None:
+        self.url = url
+        self.key = key
+        self.check_interval = check_interval
+        self.endpoint = endpoint
+        self.rows: list[list[str]] = []
+        self.index: dict[Hashable, list[list[str]]] = {}
+        self._etag: Optional[str] = None
+        self._last_modified: Optional[str] = None
+        self._checked_at = 0.0
+
+    async def load(self, session: aiohttp.ClientSession) -> 'CsvDataset':
+        if not self.rows or self._checked_at + self.check_interval <= time.monotonic():
+            try:
+                await self._refresh(session)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if not self.rows:
+                    raise
+        return self
+
+    @single_flight
+    async def _refresh(self, session: aiohttp.ClientSession) -> None:
+        headers = {}
+        if self.rows and self._etag is not None:
+            headers['If-None-Match'] = self._etag
+        if self.rows and self._last_modified is not None:
+            headers['If-Modified-Since'] = self._last_modified
+
+        async with guarded(session.get, self.url, self.endpoint, headers=headers) as request:
+            # an error page must not replace the rows
+            request.raise_for_status()
+            if request.status == 200:
+                self._parse(await request.text('utf-8'))
+                self._etag = request.headers.get('ETag')
+                self._last_modified = request.headers.get('Last-Modified')
+        self._checked_at = time.monotonic()
+
+    def _parse(self, text: str) -> None:
+        # the first line is the header
+        self.rows = [row for row in csv.reader(text.splitlines()[1:]) if any(row)]
+        self.index = {}
+        for row in self.rows:
+            self.index.setdefault(self.key(row), []).append(row)
@@ -0,0 +1,281 @@
+import asyncio
+import random
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import AsyncContextManager, AsyncIterator, Callable, Literal, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from ._metrics import emit, enabled, labels
+from ._throttle import limiter
+
+
+class Policy(NamedTuple):
+    '''How long a request may take and how it is retried.
+
+    Attributes:
+        deadline: Seconds for the request including its retries.
+        retries: Attempts after the first one.
+        backoff: Seconds before the first retry, doubled (with jitter) for each next one.
+        throttled: Whether the request waits for the limiter of its host (see `_throttle`),
+            the deadline includes that wait.
+    '''
+    deadline: float
+    retries: int
+    backoff: float
+    throttled: bool = True
+
+
+# keyed by endpoint (`<transport>.<name>`) or by name alone, see `policy()`
+_policies: dict[Optional[str], Policy] = {
+    None: Policy(deadline=30, retries=2, backoff=0.5),
+    # ETAs are single requests, left to the budgets of their callers (e.g. `Scheduler`)
+    'eta': Policy(deadline=5, retries=1, backoff=0.2, throttled=False),
+    # fan-outs queue for the limiter, their deadlines cover the wait for the whole fan-out
+    'variants': Policy(deadline=60, retries=1, backoff=0.2),
+    'stop': Policy(deadline=60, retries=1, backoff=0.2),
+    'geocode': Policy(deadline=30, retries=1, backoff=0.5),
+    # the GTFS datasets of TD run to tens of megabytes, read while they are downloaded
+    'dataset': Policy(deadline=300, retries=1, backoff=1),
+}
+
+# statuses of an upstream in trouble, worth retrying
+_RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+
+class CircuitOpenError(aiohttp.ClientError):
+    '''Requests towards a host are not sent while its circuit breaker is open.'''
+
+    def __init__(self, host: str, retry_in: float) -> None:
+        super().__init__(f'circuit of {host} is open, retry in {retry_in:.1f}s')
+        self.host = host
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    '''Stop sending requests to a host after `threshold` failures in a row.
+
+    After `reset` seconds the breaker is half-open: a single probe request is let
+    through, its success closes the breaker and its failure opens it for another
+    `reset` seconds. Other requests fail fast until the probe is done.
+    '''
+
+    def __init__(self, host: str, threshold: int = 5, reset: float = 30) -> None:
+        self.host = host
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.trips = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> Literal['closed', 'open', 'half-open']:
+        if self._opened_at is None:
+            return 'closed'
+        return 'open' if time.monotonic() - self._opened_at < self.reset else 'half-open'
+
+    def check(self) -> bool:
+        '''Raise `CircuitOpenError` while the breaker is open or its probe is in flight.
+
+        Returns:
+            Whether the caller is the probe of the half-open breaker, which must report
+            its outcome with `succeeded()`, `failed()` or `abandoned()`.
+        '''
+        state = self.state
+        if state == 'open':
+            raise CircuitOpenError(self.host,
+                                   self._opened_at + self.reset - time.monotonic())
+        if state == 'half-open':
+            if self._probing:
+                raise CircuitOpenError(self.host, 0)
+            self._probing = True
+            return True
+        return False
+
+    def succeeded(self) -> None:
+        self.failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def failed(self) -> None:
+        self._probing = False
+        self.failures += 1
+        if self.state == 'half-open' or \
+                (self._opened_at is None and self.failures >= self.threshold):
+            self._opened_at = time.monotonic()
+            self.trips += 1
+
+    def abandoned(self) -> None:
+        '''The probe ended without an outcome (e.g. cancelled), let the next request probe.'''
+        self._probing = False
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def breaker(url: str) -> CircuitBreaker:
+    '''Get the shared circuit breaker of the host of `url`.'''
+    host = urlsplit(url).hostname
+    if host not in _breakers:
+        _breakers[host] = CircuitBreaker(host)
+    return _breakers[host]
+
+
+def policy(endpoint: str) -> Policy:
+    '''Get the policy of an endpoint, else of its name (e.g. `eta`), else the default.'''
+    return _policies.get(endpoint) \
+        or _policies.get(endpoint.rsplit('.', 1)[-1]) \
+        or _policies[None]
+
+
+def configure_endpoint(endpoint: Optional[str],
+                       deadline: float = None,
+                       retries: int = None,
+                       backoff: float = None,
+                       throttled: bool = None) -> None:
+    '''Change the policy of an endpoint, omitted arguments are left unchanged.
+
+    Args:
+        endpoint: `<transport>.<name>` (e.g. `kmb.eta`), a name shared by all
+            transports (e.g. `eta`), or `None` for the default policy.
+    '''
+    current = policy(endpoint) if endpoint is not None else _policies[None]
+    _policies[endpoint] = current._replace(**{k: v for k, v in (('deadline', deadline),
+                                                                ('retries', retries),
+                                                                ('backoff', backoff),
+                                                                ('throttled', throttled))
+                                              if v is not None})
+
+
+def configure_breaker(host: str, threshold: int = None, reset: float = None) -> None:
+    '''Change the circuit breaker of a host, omitted arguments are left unchanged.'''
+    target = breaker(f'https://{host}')
+    if threshold is not None:
+        target.threshold = threshold
+    if reset is not None:
+        target.reset = reset
+
+
+def breaker_stats() -> dict[str, dict[str,]]:
+    '''Get the `state`, consecutive `failures` and number of `trips` of each host's breaker.'''
+    return {host: {'state': b.state,
+                   'failures': b.failures,
+                   'trips': b.trips,
+                   'threshold': b.threshold,
+                   'reset': b.reset}
+            for host, b in _breakers.items()}
+
+
+def _timeout(session_timeout: Optional[aiohttp.ClientTimeout],
+             remaining: float) -> aiohttp.ClientTimeout:
+    '''Bound the timeout of the session by the time left until the deadline.'''
+    if session_timeout is None:
+        return aiohttp.ClientTimeout(total=remaining)
+    return aiohttp.ClientTimeout(
+        total=remaining if session_timeout.total is None else min(remaining,
+                                                                  session_timeout.total),
+        connect=session_timeout.connect,
+        sock_read=session_timeout.sock_read,
+        sock_connect=session_timeout.sock_connect)
+
+
+@asynccontextmanager
+async def guarded(method: Callable[..., AsyncContextManager[aiohttp.ClientResponse]],
+                  url: str,
+                  endpoint: str,
+                  *,
+                  stream: bool = False,
+                  **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+    '''Send a request within the limits, circuit breaker and policy of its host and endpoint.
+
+        async with guarded(session.get, url, 'kmb.eta') as request:
+            return await request.json()
+
+    Failed attempts (connection errors, timeouts, 429 and 5xx) are retried until the
+    retries or the deadline run out. The deadline covers the whole call: waiting for
+    the limiter of the host, every attempt and reading the response. Each attempt is
+    also bounded by the timeout of the session, whichever is shorter.
+
+    Args:
+        method: `get` or `post` of a session.
+        endpoint: Name of the policy, see `policy()`.
+        stream: The body is read by the caller as it arrives (e.g. staged on disk),
+            so it is not read ahead to time its download apart from its decoding.
+
+    Raises:
+        CircuitOpenError: The breaker of the host is open.
+        asyncio.TimeoutError: The deadline has passed.
+    '''
+    breaker_, policy_, labels_ = breaker(url), policy(endpoint), labels(endpoint)
+    session_timeout = getattr(getattr(method, '__self__', None), 'timeout', None)
+    started = time.perf_counter()
+    give_up = time.monotonic() + policy_.deadline
+    attempt = 0
+    while True:
+        probe = breaker_.check()
+        stack = AsyncExitStack()
+        try:
+            if policy_.throttled:
+                # timing out in the own queue of the package is not held against the upstream
+                await asyncio.wait_for(stack.enter_async_context(limiter(url)),
+                                       max(give_up - time.monotonic(), 0))
+        except BaseException:
+            await stack.aclose()
+            if probe:
+                breaker_.abandoned()
+            raise
+
+        try:
+            request = await stack.enter_async_context(method(
+                url,
+                timeout=_timeout(session_timeout, max(give_up - time.monotonic(), 0.001)),
+                trace_request_ctx={'labels': labels_},
+                **kwargs))
+            if request.status in _RETRY_STATUSES:
+                raise aiohttp.ClientResponseError(request.request_info,
+                                                  request.history,
+                                                  status=request.status,
+                                                  message=request.reason)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            await stack.aclose()
+            breaker_.failed()
+            if enabled():
+                emit('hketa_request_errors', 1, labels_)
+            delay = policy_.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            if attempt >= policy_.retries or time.monotonic() + delay >= give_up:
+                raise
+            attempt += 1
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            await stack.aclose()
+            if probe:
+                breaker_.abandoned()
+            raise
+        breaker_.succeeded()
+        async with stack:
+            if not enabled():
+                yield request
+                return
+            if stream:
+                try:
+                    yield request
+                finally:
+                    emit('hketa_request_seconds', time.perf_counter() - started, labels_)
+                return
+
+            # the body is read ahead to tell the download apart from the decoding
+            read_at = time.perf_counter()
+            body = await request.read()
+            decode_at = time.perf_counter()
+            emit('hketa_read_seconds', decode_at - read_at, labels_)
+            emit('hketa_response_bytes', len(body), labels_)
+            try:
+                yield request
+            finally:
+                done_at = time.perf_counter()
+                emit('hketa_decode_seconds', done_at - decode_at, labels_)
+                emit('hketa_request_seconds', done_at - started, labels_)
+        return
@@ -0,0 +1,269 @@
+import asyncio
+import heapq
+import importlib
+import itertools
+import random
+import time
+from types import ModuleType
+from typing import Callable, Hashable, Iterable, Optional, Union
+
+import aiohttp
+
+from . import t
+from ._metrics import client_session
+from ._utils import error_compact, expand
+from ._watch import next_interval
+
+# upstream host of the real-time ETAs of each transport
+ETA_HOSTS = {
+    'kmb': 'data.etabus.gov.hk',
+    'ctb': 'rt.data.gov.hk',
+    'nlb': 'rt.data.gov.hk',
+    'mtr': 'rt.data.gov.hk',
+    'lrt': 'rt.data.gov.hk',
+    'lrtfeeder': 'rt.data.gov.hk',
+}
+
+# requests per second spent on each host unless told otherwise
+DEFAULT_BUDGETS = {
+    'data.etabus.gov.hk': 10,
+    'rt.data.gov.hk': 10,
+}
+
+Key = tuple[t.Transport, str, str]
+
+
+class _Endpoint:
+    '''An upstream ETA request and the keys it answers.'''
+
+    __slots__ = ('co', 'endpoint', 'module', 'keys', 'due', 'failures', 'polls', 'errors',
+                 'lateness', 'first', 'last', 'timestamp', 'budget')
+
+    def __init__(self, co: t.Transport, endpoint: Hashable, module: ModuleType) -> None:
+        self.co = co
+        self.endpoint = endpoint
+        self.module = module
+        self.keys: set[Key] = set()
+        self.due = time.time()
+        self.failures = 0
+        self.polls = 0
+        self.errors = 0
+        self.lateness = 0.0
+        self.first: Optional[float] = None
+        self.last: Optional[float] = None
+        self.timestamp: Optional[int] = None
+        self.budget = 0.0
+
+
+class Scheduler:
+    '''Poll the ETAs of many (transport, route ID, stop ID) keys within per-host budgets.
+
+    Keys answered by the same upstream request are polled together. Requests towards
+    a host are spaced evenly at its budget, with `jitter` to avoid lockstep with other
+    clients, and the request whose data is the closest to (or furthest past) going
+    stale is sent first. Data go stale as per `next_interval()` of `watch()`.
+
+        async with hketa.Scheduler(keys, {'rt.data.gov.hk': 5}, on_update=print) as s:
+            await asyncio.sleep(600)
+            print(s.report())
+
+    Args:
+        keys: Keys to poll, more can be `add()`ed later.
+        budgets: Requests per second of each host, see `ETA_HOSTS`. Omitted hosts
+            use `DEFAULT_BUDGETS`.
+        jitter: Fraction by which each gap between two requests is randomly varied.
+        compact: Pass `t.CompactEtas` to `on_update` instead of `t.Etas`.
+        on_update: Called with the key and its ETAs after each poll.
+        session: Used while it is open, otherwise the scheduler opens its own.
+    '''
+
+    def __init__(self,
+                 keys: Iterable[Key] = (),
+                 budgets: dict[str, float] = None,
+                 *,
+                 language: t.Language = 'tc',
+                 jitter: float = 0.2,
+                 compact: bool = False,
+                 on_update: Callable[[Key, Union[t.Etas, t.CompactEtas]], None] = None,
+                 session: aiohttp.ClientSession = None) -> None:
+        self.budgets = {**DEFAULT_BUDGETS, **(budgets or {})}
+        self.language = language
+        self.jitter = jitter
+        self.compact = compact
+        self.on_update = on_update
+        self.latest: dict[Key, Union[t.Etas, t.CompactEtas]] = {}
+        self._endpoints: dict[tuple[t.Transport, Hashable], _Endpoint] = {}
+        self._keys: dict[Key, _Endpoint] = {}
+        self._queues: dict[str, list[tuple[float, int, _Endpoint]]] = {}
+        self._wakeups: dict[str, asyncio.Event] = {}
+        self._order = itertools.count()
+        self._tasks: list[asyncio.Task] = []
+        self._polls: set[asyncio.Task] = set()
+        self._given = session
+        self._owned: Optional[aiohttp.ClientSession] = None
+        self.add(keys)
+
+    async def __aenter__(self) -> 'Scheduler':
+        self.start()
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.stop()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, keys: Iterable[Key]) -> None:
+        '''Start polling `keys`, the new requests are due at once.'''
+        # pylint: disable=protected-access
+        for key in keys:
+            if key in self._keys:
+                continue
+            co, route_id, stop_id = key
+            module = importlib.import_module(f'.{co}', __package__)
+            endpoint = module._eta_endpoint(route_id, stop_id, self.language)
+            if (entry := self._endpoints.get((co, endpoint))) is None:
+                entry = self._endpoints[(co, endpoint)] = _Endpoint(co, endpoint, module)
+                self._push(entry)
+            entry.keys.add(key)
+            self._keys[key] = entry
+
+    def remove(self, keys: Iterable[Key]) -> None:
+        '''Stop polling `keys`, a request is dropped with the last key it answers.'''
+        for key in keys:
+            if (entry := self._keys.pop(key, None)) is None:
+                continue
+            entry.keys.discard(key)
+            self.latest.pop(key, None)
+            if not entry.keys:
+                del self._endpoints[(entry.co, entry.endpoint)]
+
+    def start(self) -> None:
+        '''Start polling in the running event loop.'''
+        if not self._tasks:
+            loop = asyncio.get_running_loop()
+            self._tasks = [loop.create_task(self._dispatch(host))
+                           for host in set(ETA_HOSTS.values())]
+
+    async def stop(self) -> None:
+        '''Stop polling and wait for the requests in flight.'''
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._polls, return_exceptions=True)
+        self._tasks = []
+        if self._owned is not None:
+            await self._owned.close()
+            self._owned = None
+
+    def report(self) -> dict[Key, dict[str, Optional[float]]]:
+        '''Get the freshness achieved for each key.
+
+        Returns:
+            Keyed by key:
+                `polls`, `errors`: Requests made, and those that failed.
+                `age`: Seconds since the upstream generated the data held, failed
+                    polls hold no data.
+                `fresh`: Whether `age` is within the time the data held stay valid,
+                    as per `next_interval()` from their generation.
+                `mean_interval`: Mean seconds between two requests.
+                `mean_lateness`: Mean seconds a request was sent after its data went stale.
+        '''
+        now = time.time()
+        report = {}
+        for key, entry in self._keys.items():
+            report[key] = {
+                'polls': entry.polls,
+                'errors': entry.errors,
+                'age': None if entry.timestamp is None else now - entry.timestamp,
+                'fresh': entry.timestamp is not None and now - entry.timestamp <= entry.budget,
+                'mean_interval': (entry.last - entry.first) / (entry.polls - 1)
+                if entry.polls > 1 else None,
+                'mean_lateness': entry.lateness / entry.polls if entry.polls else None,
+            }
+        return report
+
+    def _push(self, entry: _Endpoint) -> None:
+        host = ETA_HOSTS[entry.co]
+        heapq.heappush(self._queues.setdefault(host, []), (entry.due, next(self._order), entry))
+        if host in self._wakeups:
+            self._wakeups[host].set()
+
+    async def _dispatch(self, host: str) -> None:
+        queue = self._queues.setdefault(host, [])
+        wakeup = self._wakeups.setdefault(host, asyncio.Event())
+        while True:
+            if not queue:
+                await wakeup.wait()
+                wakeup.clear()
+                continue
+
+            due, _, entry = queue[0]
+            if self._endpoints.get((entry.co, entry.endpoint)) is not entry:
+                heapq.heappop(queue)  # removed
+                continue
+            if (delay := due - time.time()) > 0:
+                # an earlier request may be added meanwhile
+                wakeup.clear()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(queue)
+            task = asyncio.get_running_loop().create_task(self._poll(entry))
+            self._polls.add(task)
+            task.add_done_callback(self._polls.discard)
+            await asyncio.sleep(
+                random.uniform(1 - self.jitter, 1 + self.jitter) / self.budgets[host])
+
+    async def _poll(self, entry: _Endpoint) -> None:
+        # pylint: disable=protected-access
+        started = time.time()
+        try:
+            response = await entry.module._fetch_etas(entry.endpoint, self._session())
+        except Exception:  # pylint: disable=broad-exception-caught
+            response = None
+        now = time.time()
+
+        entry.polls += 1
+        entry.lateness += max(started - entry.due, 0)
+        entry.first = entry.first or started
+        entry.last = started
+
+        results = []
+        for key in entry.keys:
+            _, route_id, stop_id = key
+            try:
+                etas = entry.module._parse_compact(response, route_id, stop_id, self.language) \
+                    if response is not None else error_compact('api-error')
+            except (KeyError, IndexError, TypeError, ValueError):
+                etas = error_compact('api-error')
+            results.append((key, etas))
+
+        if all(etas.message == 'api-error' for _, etas in results):
+            entry.errors += 1
+            entry.failures += 1
+        else:
+            entry.failures = 0
+        if self._endpoints.get((entry.co, entry.endpoint)) is entry:
+            entry.due = now + min((next_interval(entry.co, etas, now, entry.failures)
+                                   for _, etas in results), default=0)
+            self._push(entry)
+
+        if (held := [etas for _, etas in results if etas.message != 'api-error']):
+            entry.timestamp = max(etas.timestamp for etas in held)
+            entry.budget = min(next_interval(entry.co, etas, etas.timestamp) for etas in held)
+
+        for key, etas in results:
+            self.latest[key] = etas if self.compact else expand(etas, self.language)
+            if self.on_update is not None:
+                self.on_update(key, self.latest[key])
+
+    def _session(self) -> aiohttp.ClientSession:
+        if self._given is not None and not self._given.closed:
+            return self._given
+        if self._owned is None:
+            self._owned = client_session()
+        return self._owned
+
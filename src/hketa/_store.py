@@ -0,0 +1,205 @@
+import asyncio
+import itertools
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterable, Mapping, Optional
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    dataset TEXT PRIMARY KEY,
+    updated_at REAL NOT NULL,
+    version TEXT
+);
+CREATE TABLE IF NOT EXISTS validators (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT
+);
+CREATE TABLE IF NOT EXISTS journey_times (
+    co TEXT NOT NULL,
+    route TEXT NOT NULL,
+    td_route_id TEXT NOT NULL,
+    orig TEXT,
+    dest TEXT,
+    time TEXT
+);
+CREATE INDEX IF NOT EXISTS journey_times_co_route ON journey_times (co, route);
+CREATE TABLE IF NOT EXISTS routes (
+    id TEXT NOT NULL,
+    co TEXT NOT NULL,
+    route TEXT NOT NULL,
+    orig TEXT,
+    dest TEXT
+);
+CREATE INDEX IF NOT EXISTS routes_co_route ON routes (co, route);
+CREATE INDEX IF NOT EXISTS routes_id ON routes (id);
+CREATE TABLE IF NOT EXISTS calendar (
+    service_id TEXT PRIMARY KEY,
+    weekday TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS calendar_dates (
+    service_id TEXT NOT NULL,
+    date TEXT NOT NULL,
+    available INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS calendar_dates_service_id ON calendar_dates (service_id);
+CREATE TABLE IF NOT EXISTS frequencies (
+    route_id TEXT NOT NULL,
+    bound TEXT NOT NULL,
+    service_id TEXT NOT NULL,
+    start TEXT NOT NULL,
+    end TEXT NOT NULL,
+    interval TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS frequencies_route_id ON frequencies (route_id, bound, service_id);
+CREATE TABLE IF NOT EXISTS fares (
+    route_id TEXT NOT NULL,
+    bound TEXT NOT NULL,
+    fare TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fares_route_id ON fares (route_id, bound);
+CREATE TABLE IF NOT EXISTS trips (
+    code INTEGER PRIMARY KEY,
+    id TEXT NOT NULL,
+    route_id TEXT NOT NULL,
+    bound TEXT NOT NULL,
+    service_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS trips_route_id ON trips (route_id);
+CREATE TABLE IF NOT EXISTS stop_codes (
+    code INTEGER PRIMARY KEY,
+    id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stop_times (
+    trip INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    stop INTEGER NOT NULL,
+    arrival INTEGER NOT NULL,
+    departure INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stop_times_trip ON stop_times (trip, seq);
+CREATE TABLE IF NOT EXISTS stops (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    lat TEXT,
+    lng TEXT
+);
+'''
+
+
+class Store:
+    '''An on-disk SQLite store of the static datasets, shareable by many processes.
+
+    Each dataset is replaced in a single transaction, so readers (including
+    other processes) see either the complete old or the complete new data.
+    Writes run in a worker thread, one at a time, so waiting for the database
+    lock never blocks the event loop.
+    '''
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._write_lock = threading.Lock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = self._connect()
+        return self._conn
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        # readers are not blocked by a writer in write-ahead logging mode
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(_SCHEMA)
+        return conn
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def query(self, sql: str, params: tuple = ()) -> list[tuple]:
+        return self.conn.execute(sql, params).fetchall()
+
+    def updated_at(self, dataset: str) -> Optional[float]:
+        '''Get the time (since epoch) `dataset` was last replaced, `None` if never.'''
+        row = self.conn.execute(
+            'SELECT updated_at FROM meta WHERE dataset = ?', (dataset, )).fetchone()
+        return None if row is None else row[0]
+
+    def version(self, dataset: str) -> Optional[str]:
+        '''Get the upstream version `dataset` was loaded from, `None` if never loaded.'''
+        row = self.conn.execute(
+            'SELECT version FROM meta WHERE dataset = ?', (dataset, )).fetchone()
+        return None if row is None else row[0]
+
+    async def set_version(self, dataset: str, version: str) -> None:
+        '''Record that the stored `dataset` is still current as of `version`.'''
+        await self._write(lambda conn: conn.execute(
+            'UPDATE meta SET version = ? WHERE dataset = ?', (version, dataset)))
+
+    def validators(self, url: str) -> dict[str, str]:
+        '''Get the conditional request headers of the stored response of `url`.'''
+        row = self.conn.execute(
+            'SELECT etag, last_modified FROM validators WHERE url = ?', (url, )).fetchone()
+        if row is None:
+            return {}
+        return {h: v for h, v in zip(('If-None-Match', 'If-Modified-Since'), row) if v}
+
+    async def replace(self,
+                      dataset: str,
+                      rows: Mapping[str, Iterable[tuple]],
+                      *,
+                      version: Optional[str] = None,
+                      validators: Mapping[str, Mapping[str, str]] = None) -> None:
+        '''Replace the content of each table of `rows` with its rows, in a single transaction.
+
+        The data must be downloaded beforehand, the rows may still be generators over
+        it (e.g. over a staged file), they are consumed by the worker thread.
+
+        Args:
+            rows: Rows of each table, tables are filled in order.
+            validators: Headers of the responses the rows come from by URL, for later
+                conditional requests.
+        '''
+        validated = [(url, headers.get('ETag'), headers.get('Last-Modified'))
+                     for url, headers in (validators or {}).items()]
+
+        def write(conn: sqlite3.Connection) -> None:
+            for table, table_rows in rows.items():
+                conn.execute(f'DELETE FROM {table}')
+                _insert_many(conn, table, table_rows)
+            _insert_many(conn, 'validators', validated)
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?, ?)',
+                         (dataset, time.time(), version))
+        await self._write(write)
+
+    async def _write(self, write: Callable[[sqlite3.Connection], None]) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self._write_sync, write)
+
+    def _write_sync(self, write: Callable[[sqlite3.Connection], None]) -> None:
+        with self._write_lock:
+            conn = self._connect()
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    write(conn)
+                    conn.execute('COMMIT')
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+            finally:
+                conn.close()
+
+
+def _insert_many(conn: sqlite3.Connection, table: str, rows: Iterable[tuple]) -> None:
+    rows = iter(rows)
+    if (first := next(rows, None)) is None:
+        return
+    conn.executemany(
+        # later rows replace earlier ones sharing the same primary key
+        f'INSERT OR REPLACE INTO {table} VALUES ({", ".join("?" * len(first))})',
+        itertools.chain((first, ), rows))
@@ -0,0 +1,110 @@
+import asyncio
+import time
+import weakref
+from typing import Optional
+from urllib.parse import urlsplit
+
+# upstream hosts by transport, for reference when tuning the limits:
+#   kmb:               data.etabus.gov.hk, search.kmb.hk
+#   ctb, nlb, mtr,
+#   lrt, lrtfeeder:    rt.data.gov.hk
+#   mtr, lrt,
+#   lrtfeeder:         opendata.mtr.com.hk, geodata.gov.hk
+# ETA requests are not throttled, see `_resilience.Policy`
+_DEFAULT_LIMITS = {
+    'data.etabus.gov.hk': {'concurrency': 10, 'rate': 20},
+    'rt.data.gov.hk': {'concurrency': 10, 'rate': 20},
+    'search.kmb.hk': {'concurrency': 5, 'rate': 10},
+    'geodata.gov.hk': {'concurrency': 5, 'rate': 10},
+    None: {'concurrency': 10, 'rate': None},
+}
+
+
+class HostLimiter:
+    '''Bound the number of in-flight requests and the request rate towards a host.
+
+    Args:
+        concurrency: Maximum number of requests in flight.
+        rate: Requests per second allowed by the token bucket, `None` for unlimited.
+        burst: Capacity of the token bucket, defaults to `concurrency`.
+    '''
+
+    def __init__(self, concurrency: int, rate: Optional[float] = None, burst: int = None) -> None:
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst or concurrency
+        self.waiting = 0
+        self.active = 0
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        # asyncio primitives are bound to the event loop they are first used in
+        self._semaphores: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore] =\
+            weakref.WeakKeyDictionary()
+
+    async def __aenter__(self) -> None:
+        semaphore = self._semaphores.setdefault(asyncio.get_running_loop(),
+                                                asyncio.Semaphore(self.concurrency))
+        self.waiting += 1
+        try:
+            await semaphore.acquire()
+            try:
+                await self._take_token()
+            except BaseException:
+                semaphore.release()
+                raise
+        finally:
+            self.waiting -= 1
+        self.active += 1
+
+    async def __aexit__(self, *_) -> None:
+        self.active -= 1
+        self._semaphores[asyncio.get_running_loop()].release()
+
+    async def _take_token(self) -> None:
+        while self.rate is not None:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+_limiters: dict[str, HostLimiter] = {}
+
+
+def limiter(url: str) -> HostLimiter:
+    '''Get the shared limiter of the host of `url`.'''
+    host = urlsplit(url).hostname
+    if host not in _limiters:
+        _limiters[host] = HostLimiter(**_DEFAULT_LIMITS.get(host, _DEFAULT_LIMITS[None]))
+    return _limiters[host]
+
+
+def configure_throttle(host: str,
+                       concurrency: int = None,
+                       rate: Optional[float] = ...,
+                       burst: int = None) -> None:
+    '''Change the limits of a host, see `_DEFAULT_LIMITS` for the hosts of each transport.
+
+    Omitted arguments are left unchanged, pass `rate=None` to remove the rate limit.
+    Changing `concurrency` only affects event loops that have not used the host yet.
+    '''
+    target = limiter(f'https://{host}')
+    if concurrency is not None:
+        target.concurrency = concurrency
+        target.burst = burst or concurrency
+    if burst is not None:
+        target.burst = burst
+    if rate is not ...:
+        target.rate = rate
+
+
+def throttle_stats() -> dict[str, dict[str, int]]:
+    '''Get the number of queued (`waiting`) and in-flight (`active`) requests of each host.'''
+    return {host: {'waiting': l.waiting,
+                   'active': l.active,
+                   'concurrency': l.concurrency,
+                   'rate': l.rate}
+            for host, l in _limiters.items()}
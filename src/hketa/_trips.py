@@ -0,0 +1,102 @@
+import sys
+from array import array
+from itertools import accumulate
+from typing import Optional
+
+import aiohttp
+
+from ._cache import TTLCache
+from ._gtfs_parser import dataset_version, find_stop_times, find_trips, gtfs_trips, stop_codes
+from ._utils import ensure_session
+
+# keyed by (GTFS route ID, dataset version)
+_tables = TTLCache(maxsize=256, ttl=86400)
+
+_stop_ids: tuple[Optional[str], list[str]] = (None, [])
+
+
+class TripTable:
+    '''The trips of a GTFS route and their stop times, as typed columns.
+
+    Trip `i` calls at `stops[offsets[i]:offsets[i + 1]]`, with the matching `arrivals` and
+    `departures` in seconds since the start of its service day (-1 when not given).
+    Stops are codes shared by all routes, see `stop_ids()`.
+    '''
+
+    __slots__ = ('route_id', 'trip_ids', 'bounds', 'services', 'service_ids',
+                 'offsets', 'stops', 'arrivals', 'departures')
+
+    def __init__(self,
+                 route_id: str,
+                 trips: list[tuple[int, str, str, str]],
+                 stop_times: list[tuple[int, int, int, int]]) -> None:
+        self.route_id = route_id
+        self.trip_ids = [sys.intern(tid) for _, tid, _, _ in trips]
+        self.bounds = array('B', (bound == 'inbound' for _, _, bound, _ in trips))
+
+        services: dict[str, int] = {}
+        self.services = array('H', (services.setdefault(sid, len(services))
+                                    for *_, sid in trips))
+        self.service_ids = [sys.intern(sid) for sid in services]
+
+        positions = {code: idx for idx, (code, *_) in enumerate(trips)}
+        counts = [0] * len(trips)
+        self.stops, self.arrivals, self.departures = array('I'), array('i'), array('i')
+        # both are ordered by trip code, so the stop times of a trip are contiguous
+        for trip, stop, arrival, departure in stop_times:
+            counts[positions[trip]] += 1
+            self.stops.append(stop)
+            self.arrivals.append(arrival)
+            self.departures.append(departure)
+        self.offsets = array('I', accumulate(counts, initial=0))
+
+    def __len__(self) -> int:
+        return len(self.trip_ids)
+
+    def direction(self, idx: int) -> str:
+        return 'inbound' if self.bounds[idx] else 'outbound'
+
+    def service_id(self, idx: int) -> str:
+        return self.service_ids[self.services[idx]]
+
+    def stop_times(self, idx: int) -> list[tuple[str, int, int]]:
+        '''Get the (stop ID, arrival, departure) of the `idx`-th trip.'''
+        start, end, ids = self.offsets[idx], self.offsets[idx + 1], stop_ids()
+        return [(ids[s], a, d) for s, a, d in zip(self.stops[start:end],
+                                                      self.arrivals[start:end],
+                                                      self.departures[start:end])]
+
+    @property
+    def nbytes(self) -> int:
+        '''Approximate memory used by the table in bytes.'''
+        columns = (self.bounds, self.services, self.offsets,
+                   self.stops, self.arrivals, self.departures)
+        return sys.getsizeof(self)\
+            + sum(sys.getsizeof(c) for c in columns)\
+            + sum(sys.getsizeof(l) + sum(map(sys.getsizeof, l))
+                  for l in (self.trip_ids, self.service_ids))
+
+
+@ensure_session
+async def trips(route_id: str, *, session: aiohttp.ClientSession) -> TripTable:
+    '''Get the trips of a GTFS route, loading only that route into memory.'''
+    await gtfs_trips(session=session)
+    key = (route_id, dataset_version('trips'))
+    if (table := _tables.get(key)) is None:
+        table = TripTable(route_id, find_trips(route_id), find_stop_times(route_id))
+        _tables.set(key, table)
+    return table
+
+
+def stop_ids() -> list[str]:
+    '''Get the GTFS stop IDs indexed by their interned codes.'''
+    global _stop_ids  # pylint: disable=global-statement
+    if _stop_ids[0] != (version := dataset_version('trips')):
+        _stop_ids = (version, stop_codes())
+    return _stop_ids[1]
+
+
+def memory_footprint() -> dict[str, int]:
+    '''Get the bytes used by each loaded route and their `total`.'''
+    footprint = {table.route_id: table.nbytes for _, table in _tables.items()}
+    return {**footprint, 'total': sum(footprint.values())}
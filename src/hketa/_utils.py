@@ -1,17 +1,21 @@
+import asyncio
+import json
+import os
 import random
-from datetime import datetime
-from functools import wraps
+import sys
+import tempfile
+import time
+import weakref
+from datetime import datetime, timedelta, timezone
+from functools import cache, lru_cache, wraps
 from pathlib import Path
-from typing import Awaitable, Literal, Union
+from typing import Awaitable, Iterable, Literal, Optional, Union
 
 import aiohttp
-import pyproj
-import pytz
 
 from . import t
-
-with open(Path(__file__).parent.joinpath('ua.txt'), encoding='utf-8') as f:
-    USER_AGENTS = tuple(a.strip() for a in f.readline())
+from ._metrics import client_session
+from ._resilience import guarded
 
 ERR_MESSAGES = {
     'api-error': {
@@ -32,7 +36,25 @@ ERR_MESSAGES = {
     }
 }
 
-EPSG_TRANSFORMER = pyproj.Transformer.from_crs('epsg:2326', 'epsg:4326')
+HKT = timezone(timedelta(hours=8))
+
+# geocoding results keyed by query, locations never change so they never expire
+LOCATIONS_PATH = Path(tempfile.gettempdir()).joinpath('_hketa_locations.json')
+
+_locations: Optional[dict[str, tuple[float, float]]] = None
+
+
+@cache
+def epsg_transformer():
+    '''Get the HK1980 Grid to WGS84 transformer, `pyproj` is imported on first use.'''
+    import pyproj  # pylint: disable=import-outside-toplevel
+    return pyproj.Transformer.from_crs('epsg:2326', 'epsg:4326')
+
+
+@cache
+def user_agents() -> tuple[str]:
+    with open(Path(__file__).parent.joinpath('ua.txt'), encoding='utf-8') as f:
+        return tuple(a.strip() for a in f if a.strip())
 
 
 def ensure_session(func: Awaitable):
@@ -41,18 +63,52 @@ def ensure_session(func: Awaitable):
         if kwargs.get('session') is not None:
             assert isinstance(kwargs['session'], aiohttp.ClientSession)
             return await func(*args, **kwargs)
-        async with aiohttp.ClientSession() as s:
+        async with client_session() as s:
+            _transient.add(s)
             return await func(*args, **{**kwargs, 'session': s})
     return wrapper
 
 
+# sessions created by `ensure_session`, closed as soon as their caller returns
+_transient: 'weakref.WeakSet[aiohttp.ClientSession]' = weakref.WeakSet()
+
+
+def single_flight(func: Awaitable):
+    '''Share one in-flight call among concurrent callers with the same first argument.
+
+    The first argument must be hashable and fully describe the upstream request;
+    the remaining arguments (e.g. `session`) are taken from the first caller. A session
+    created by `ensure_session` for the first caller alone is not used, as it is closed
+    when that caller returns or is cancelled: the shared call gets its own instead.
+    '''
+    in_flight: dict[tuple, asyncio.Task] = {}
+
+    async def detached(key, *args, **kwargs):
+        if not any(a in _transient for a in (*args, *kwargs.values())):
+            return await func(key, *args, **kwargs)
+        async with client_session() as s:
+            return await func(key,
+                              *(s if a in _transient else a for a in args),
+                              **{k: s if a in _transient else a for k, a in kwargs.items()})
+
+    @wraps(func)
+    async def wrapper(key, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        if (task := in_flight.get((loop, key))) is None:
+            task = in_flight[(loop, key)] = loop.create_task(detached(key, *args, **kwargs))
+            task.add_done_callback(lambda _: in_flight.pop((loop, key), None))
+        # a cancelled caller must not cancel the request shared with the others
+        return await asyncio.shield(task)
+    return wrapper
+
+
 def dt_to_8601(dt: datetime) -> str:
     '''Convert a `datetime` instance to ISO-8601 formatted string.'''
     return dt.isoformat(sep='T', timespec='seconds')
 
 
 def timestamp():
-    return datetime.now().replace(tzinfo=pytz.timezone('Etc/GMT-8'))
+    return datetime.now(HKT)
 
 
 def error_eta(message: Union[Literal['api-error', 'empty', 'eos', 'ss-effect'], str],
@@ -65,97 +121,106 @@ def error_eta(message: Union[Literal['api-error', 'empty', 'eos', 'ss-effect'],
     }
 
 
-def ua_header():
-    return {'User-Agent': random.choice(USER_AGENTS)}
+def error_compact(message: Union[Literal['api-error', 'empty', 'eos', 'ss-effect'], str],
+                  ts: int = None) -> t.CompactEtas:
+    return t.CompactEtas(ts or int(time.time()), sys.intern(message), None)
+
+
+@lru_cache(maxsize=4096)
+def epoch(iso: str) -> int:
+    '''Convert an ISO-8601 time to seconds since epoch, a naive time is taken as Hong Kong time.'''
+    dt = datetime.fromisoformat(iso)
+    return int((dt if dt.tzinfo is not None else dt.replace(tzinfo=HKT)).timestamp())
+
 
+def intern(text: Optional[str]) -> Optional[str]:
+    '''Intern an upstream text, which repeats across many ETAs.'''
+    return sys.intern(text) if text else text
 
-async def search_location(name: str, session: aiohttp.ClientSession) -> tuple[str, str]:
-    async with session.get(
-            f'https://geodata.gov.hk/gs/api/v1.0.0/locationSearch?q={name}') as request:
+
+def expand(etas: t.CompactEtas, language: t.Language = 'tc') -> t.Etas:
+    '''Format compact ETAs as the `t.Etas` returned by default.'''
+    timestamp = dt_to_8601(datetime.fromtimestamp(etas.timestamp, HKT))
+    if etas.etas is None:
+        return {
+            'timestamp': timestamp,
+            'message': ERR_MESSAGES.get(etas.message, {}).get(language, etas.message),
+            'etas': None
+        }
+    return {
+        'timestamp': timestamp,
+        'message': None,
+        'etas': [{
+            'eta': None if eta.eta is None else dt_to_8601(datetime.fromtimestamp(eta.eta, HKT)),
+            'is_arriving': eta.is_arriving,
+            'is_scheduled': eta.is_scheduled,
+            'extras': {
+                'destinaion': eta.destination,
+                'varient': eta.varient,
+                'platform': eta.platform,
+                'car_length': eta.car_length
+            },
+            'remark': eta.remark,
+        } for eta in etas.etas]
+    }
+
+
+def ua_header():
+    return {'User-Agent': random.choice(user_agents())}
+
+
+def load_locations() -> dict[str, tuple[float, float]]:
+    '''Get the geocoding cache, loading it from disk on first use.'''
+    global _locations  # pylint: disable=global-statement
+    if _locations is None:
+        try:
+            with open(LOCATIONS_PATH, 'r', encoding='utf-8') as f:
+                _locations = {q: tuple(l) for q, l in json.load(f).items()}
+        except (OSError, ValueError):
+            _locations = {}
+    return _locations
+
+
+def save_locations() -> None:
+    tmp = LOCATIONS_PATH.with_suffix('.tmp')
+    tmp.write_text(json.dumps(load_locations(), ensure_ascii=False), encoding='utf-8')
+    os.replace(tmp, LOCATIONS_PATH)
+
+
+def grid_to_wgs84(points: Iterable[tuple[float, float]]) -> list[tuple[float, float]]:
+    '''Convert HK1980 Grid (northing, easting) points to WGS84 (latitude, longitude).
+
+    All points are converted by a single call to `pyproj`.
+    '''
+    if not (points := list(points)):
+        return []
+    lats, lngs = epsg_transformer().transform([p[0] for p in points], [p[1] for p in points])
+    return list(zip(lats, lngs))
+
+
+async def search_locations(names: Iterable[str],
+                           session: aiohttp.ClientSession,
+                           *,
+                           save: bool = True) -> list[tuple[float, float]]:
+    '''Geocode many places, the uncached ones are searched concurrently and converted at once.'''
+    names, locations = list(names), load_locations()
+    if (missing := list(dict.fromkeys(n for n in names if n not in locations))):
+        points = await asyncio.gather(*[_search_grid(n, session) for n in missing])
+        locations.update(zip(missing, grid_to_wgs84(points)))
+        if save:
+            save_locations()
+    return [locations[n] for n in names]
+
+
+async def search_location(name: str,
+                          session: aiohttp.ClientSession,
+                          *,
+                          save: bool = True) -> tuple[float, float]:
+    return (await search_locations([name], session, save=save))[0]
+
+
+async def _search_grid(name: str, session: aiohttp.ClientSession) -> tuple[float, float]:
+    url = f'https://geodata.gov.hk/gs/api/v1.0.0/locationSearch?q={name}'
+    async with guarded(session.get, url, 'geocode') as request:
         first = (await request.json())[0]
-        return EPSG_TRANSFORMER.transform(first['y'], first['x'])
-
-
-async def is_up_to_date(path: Path, url: str, session: aiohttp.ClientSession) -> bool:
-    async with session.get(url) as request:
-        return path.stat().st_mtime >= datetime.strptime((await request.text()).split('\n')[1], '%Y-%m-%d').timestamp()
-
-
-# async def gtfs_route_match(transport: t.Transport,
-#                            routes: t.Route,
-#                            session: aiohttp.ClientSession) -> t.Route:
-#     def similarity(a: str, b: str) -> float:
-#         return SequenceMatcher(None, a, b).quick_ratio()
-
-#     def clean_name(s: str) -> str:
-#         return s.replace('(循環線)', '')\
-#             .translate(str.maketrans('', '', string.punctuation))\
-#             .upper()
-
-#     def direction_aware(gtfs_services: list[dict]) -> bool:
-#         pairs = []
-#         for service in gtfs_services:
-#             if ((service['dest'], service['orig']) in pairs):
-#                 return True
-#             pairs.append((service['orig'], service['dest']))
-#         return False
-
-#     routes = deepcopy(routes)
-
-#     _gtfs_data = (await _gtfs_parser.gtfs_routes(session=session))
-#     routes_gtfs = _gtfs_data['kmb'] | _gtfs_data['lwb']
-
-#     for no, bound in routes.items():
-#         if no not in routes_gtfs:
-#             continue
-#         for direction, services in bound.items():
-#             if len(services) == 1 and len(routes_gtfs[no]) == 1:
-#                 routes[no][direction][0]['gtfs_id'] = routes_gtfs[no][0]['id']
-#                 continue
-
-#             matched_ids = set()
-#             is_multiple = len(routes_gtfs[no]) > 1
-
-#             # same orig & dest (272A)
-#             # Different ID in opposite dir (960X)
-#             # Via (28B, 30X)
-#             # Special orig & dest matched (296M)
-#             for idx, service in enumerate(services):
-#                 for service_gtfs in routes_gtfs[no]:
-#                     if service_gtfs['id'] in matched_ids:
-#                         continue
-
-#                     if idx == 0 and not direction_aware(routes_gtfs[no]):
-#                         routes[no][direction][0]['gtfs_id'] = routes_gtfs[no][0]['id']
-#                         matched_ids.add(routes_gtfs[no][0]['id'])
-#                         break
-
-#                     if (similarity(clean_name(service['orig']['zh']), service_gtfs['orig']) >= 0.6
-#                             and similarity(clean_name(service['dest']['zh']), service_gtfs['dest']) >= 0.6):
-#                         routes[no][direction][idx]['gtfs_id'] = service_gtfs['id']
-#                         matched_ids.add(service_gtfs['id'])
-#                         break
-
-#                     if not idx >= 1:
-#                         continue
-
-#                     if (similarity(clean_name(service['description']['zh']), clean_name(service_gtfs['orig'])) > 0
-#                             or similarity(clean_name(service['description']['zh']), clean_name(service_gtfs['dest'])) > 0):
-#                         routes[no][direction][idx]['gtfs_id'] = service_gtfs['id']
-#                         matched_ids.add(service_gtfs['id'])
-#                         break
-
-#                 if 'gtfs_id' in routes[no][direction][idx]:
-#                     continue
-
-#                 for service_gtfs in routes_gtfs[no]:
-#                     if service_gtfs['id'] in matched_ids:
-#                         continue
-#                     service_gtfs['orig'] = clean_name(service_gtfs['orig'])
-#                     service_gtfs['dest'] = clean_name(service_gtfs['dest'])
-
-#                     if (similarity(service['dest']['zh'], service_gtfs['orig']) >= 0.6
-#                             and similarity(service['orig']['zh'], service_gtfs['dest']) >= 0.6):
-#                         routes[no][direction][idx]['gtfs_id'] = service_gtfs['id']
-#                         matched_ids.add(service_gtfs['id'])
-#     return routes
+    return first['y'], first['x']
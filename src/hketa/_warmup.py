@@ -0,0 +1,93 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Iterable, Union
+
+import aiohttp
+
+# importing a provider registers its route loader for `refresh_routes()`
+from . import ctb, lrtfeeder, nlb  # pylint: disable=unused-import
+from . import kmb, lrt, mtr, t
+from ._cache import refresh_routes
+from ._utils import ensure_session
+
+# static datasets of each transport, in the order they should be loaded
+_DATASETS: dict[t.Transport, dict[str, Callable[[aiohttp.ClientSession], Awaitable]]] = {
+    'kmb': {
+        'routes': lambda s: refresh_routes('kmb', s),
+        'stops': lambda s: kmb.prefill_stops(session=s),
+        'route-stops': lambda s: kmb.prefill_route_stops(session=s),
+    },
+    'ctb': {
+        'routes': lambda s: refresh_routes('ctb', s),
+    },
+    'nlb': {
+        'routes': lambda s: refresh_routes('nlb', s),
+    },
+    'mtr': {
+        'routes': lambda s: refresh_routes('mtr', s),
+        'locations': lambda s: mtr.prefill_locations(session=s),
+    },
+    'lrt': {
+        'routes': lambda s: refresh_routes('lrt', s),
+        'locations': lambda s: lrt.prefill_locations(session=s),
+    },
+    'lrtfeeder': {
+        'routes': lambda s: refresh_routes('lrtfeeder', s),
+    },
+}
+
+
+@ensure_session
+async def warmup(transports: Iterable[t.Transport] = None,
+                 *,
+                 concurrency: int = 4,
+                 session: aiohttp.ClientSession) -> dict[str, Union[float, Exception]]:
+    '''Load the static datasets (routes, stops, locations...) of the transports in parallel.
+
+    Args:
+        transports: Transports to load, defaults to all.
+        concurrency: Maximum number of datasets loading at the same time.
+
+    Returns:
+        Seconds taken to load each dataset keyed by `<transport>.<dataset>`,
+        or the exception raised when it failed to load.
+    '''
+    async def load(name: str, loader: Callable[[aiohttp.ClientSession], Awaitable]):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await loader(session)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                return name, e
+            return name, time.perf_counter() - start
+
+    semaphore = asyncio.Semaphore(concurrency)
+    return dict(await asyncio.gather(*[
+        load(f'{co}.{name}', loader)
+        for co in (transports or _DATASETS.keys())
+        for name, loader in _DATASETS[co].items()]))
+
+
+def keep_fresh(transports: Iterable[t.Transport] = None,
+               interval: float = 3600,
+               *,
+               concurrency: int = 4,
+               on_refresh: Callable[[dict[str, Union[float, Exception]]], None] = None
+               ) -> asyncio.Task:
+    '''Reload the static datasets every `interval` seconds in the background.
+
+    The cached data keep being served while they are reloaded. Cancel the
+    returned task to stop refreshing.
+
+    Args:
+        on_refresh: Called with the result of `warmup()` after each reload.
+    '''
+    async def refresh():
+        while True:
+            await asyncio.sleep(interval)
+            timings = await warmup(transports, concurrency=concurrency)
+            if on_refresh is not None:
+                on_refresh(timings)
+
+    transports = list(transports or _DATASETS.keys())
+    return asyncio.get_running_loop().create_task(refresh())
@@ -0,0 +1,210 @@
+import asyncio
+import importlib
+import time
+from datetime import datetime
+from typing import AsyncIterator, Hashable, Optional
+
+import aiohttp
+
+from . import t
+from ._cache import ETAS
+from ._metrics import client_session
+from ._utils import HKT, error_compact, expand
+
+# bounds of the seconds between two polls of the same key
+MIN_INTERVAL = 5
+MAX_INTERVAL = 300
+
+# hours (Hong Kong time) in which an empty result is not expected to change soon
+_NIGHT = range(1, 6)
+
+_pollers: dict[Hashable, 'Poller'] = {}
+
+
+class Subscription:
+    '''The latest update of a poller not yet taken by a subscriber.'''
+
+    def __init__(self) -> None:
+        self._update: Optional[t.Etas] = None
+        self._error: Optional[Exception] = None
+        self._event = asyncio.Event()
+
+    def put(self, update: t.Etas) -> None:
+        # a slow subscriber skips to the latest update
+        self._update = update
+        self._event.set()
+
+    def fail(self, error: Exception) -> None:
+        self._error = error
+        self._event.set()
+
+    async def get(self) -> t.Etas:
+        await self._event.wait()
+        self._event.clear()
+        if self._error is not None:
+            raise self._error
+        return self._update
+
+
+class Poller:
+    '''Poll the ETAs of a route at a stop for all of its subscribers.
+
+    Only changed results are published. The poller stops once the last subscriber
+    leaves, and closes the session it had to create.
+    '''
+
+    def __init__(self,
+                 co: t.Transport,
+                 route_id: str,
+                 stop_id: str,
+                 language: t.Language,
+                 fallback: bool,
+                 session: Optional[aiohttp.ClientSession]) -> None:
+        self.co = co
+        self.route_id = route_id
+        self.stop_id = stop_id
+        self.language = language
+        self.fallback = fallback
+        self.polls = 0
+        self.latest: Optional[t.CompactEtas] = None
+        self._subscriptions: set[Subscription] = set()
+        self._given = session
+        self._owned: Optional[aiohttp.ClientSession] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._subscriptions)
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription()
+        if self.latest is not None:
+            subscription.put(expand(self.latest, self.language))
+        self._subscriptions.add(subscription)
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self._subscriptions.discard(subscription)
+        if not self._subscriptions and self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        failures = 0
+        try:
+            while self._subscriptions:
+                try:
+                    etas = await self._poll()
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    etas = error_compact('api-error')
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    # e.g. `KeyError` of an unknown route, polling again will not help
+                    for subscription in self._subscriptions:
+                        subscription.fail(e)
+                    self._task = None
+                    return
+                self.polls += 1
+
+                failures = failures + 1 if etas.message == 'api-error' else 0
+                # some transports are timestamped at the time of the request
+                changed = self.latest is None or etas[1:] != self.latest[1:]
+                self.latest = etas
+                if changed:
+                    update = expand(etas, self.language)
+                    for subscription in self._subscriptions:
+                        subscription.put(update)
+                await asyncio.sleep(next_interval(self.co, etas, time.time(), failures))
+        finally:
+            if self._owned is not None:
+                await self._owned.close()
+                self._owned = None
+
+    async def _poll(self) -> t.CompactEtas:
+        if self._given is not None and not self._given.closed:
+            session = self._given
+        else:
+            if self._owned is None:
+                self._owned = client_session()
+            session = self._owned
+        return await importlib.import_module(__package__).etas(
+            self.co, self.route_id, self.stop_id, self.language,
+            fallback=self.fallback, compact=True, session=session)
+
+
+def next_interval(co: t.Transport,
+                  etas: t.CompactEtas,
+                  now: float,
+                  failures: int = 0) -> float:
+    '''Get the seconds to wait before polling a key again after the result `etas`.
+
+    The shortest interval is the upstream generation cadence of the transport, aligned
+    to the next generation. It is used while a vehicle is arriving, and stretched to a
+    quarter of the time until the next ETA otherwise. Errors back off exponentially,
+    while the end of service and empty results at night are polled rarely.
+    '''
+    cadence = ETAS.intervals.get(co, 30)
+    if etas.etas is None:
+        if failures:
+            return min(cadence * 2 ** failures, MAX_INTERVAL)
+        if etas.message in ('eos', 'ss-effect') \
+                or datetime.fromtimestamp(now, HKT).hour in _NIGHT:
+            return MAX_INTERVAL
+        return min(cadence * 2, MAX_INTERVAL)
+
+    upcoming = [e.eta for e in etas.etas if e.eta is not None]
+    if upcoming and not any(e.is_arriving for e in etas.etas):
+        interval = (min(upcoming) - now) / 4
+        if interval > cadence:
+            return min(interval, MAX_INTERVAL)
+    # the upstream data is regenerated every `cadence` seconds since the timestamp
+    if now - cadence < etas.timestamp <= now:
+        return max(etas.timestamp + cadence - now + 1, MIN_INTERVAL)
+    return max(cadence, MIN_INTERVAL)
+
+
+async def watch(co: t.Transport,
+                route_id: str,
+                stop_id: str,
+                language: t.Language = 'tc',
+                *,
+                fallback: bool = False,
+                session: aiohttp.ClientSession = None) -> AsyncIterator[t.Etas]:
+    '''Iterate over the updates of the ETAs of a route at a stop.
+
+    All watchers of the same (transport, route, stop, language) share one poller,
+    whose interval adapts to the ETAs (see `next_interval()`). The latest result is
+    yielded at once to a new watcher, after that only changed results are yielded.
+    A watcher falling behind skips to the latest update.
+
+        async for etas in hketa.watch('kmb', '1A_outbound_1', '18492910339410B1'):
+            ...
+
+    Args:
+        fallback: See `etas()`.
+        session: Used by the poller while it is open, otherwise the poller opens its own.
+
+    Raises:
+        KeyError: The route or stop does not exist.
+    '''
+    key = (asyncio.get_running_loop(), co, route_id, stop_id, language, fallback)
+    if (poller := _pollers.get(key)) is None:
+        poller = _pollers[key] = Poller(co, route_id, stop_id, language, fallback, session)
+
+    subscription = poller.subscribe()
+    try:
+        while True:
+            yield await subscription.get()
+    finally:
+        poller.unsubscribe(subscription)
+        if not poller and _pollers.get(key) is poller:
+            del _pollers[key]
+
+
+def watchers() -> dict[tuple[t.Transport, str, str, t.Language, bool], dict[str, int]]:
+    '''Get the subscribers and the polls made so far of each active poller.
+
+    Returns:
+        Keyed by (transport, route ID, stop ID, language, fallback).
+    '''
+    return {key[1:]: {'subscribers': len(p), 'polls': p.polls} for key, p in _pollers.items()}
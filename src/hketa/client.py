@@ -0,0 +1,121 @@
+import importlib
+from typing import AsyncIterator, Iterable, Optional, Union
+
+import aiohttp
+
+from . import t
+from ._metrics import client_session
+
+
+class Client:
+    '''A long-lived client sharing one pooled connector across all requests.
+
+    Use it as an async context manager, or call `close()` when done:
+
+        async with hketa.Client(limit_per_host=20) as client:
+            await client.etas('kmb', '1A_outbound_1', '18492910339410B1')
+
+    Args:
+        limit: Maximum number of simultaneous connections.
+        limit_per_host: Maximum number of simultaneous connections to the same host.
+        ttl_dns_cache: Seconds to cache resolved DNS records for.
+        keepalive_timeout: Seconds to keep an idle connection open for reuse.
+        timeout: Timeouts of each request, defaults to 10 s in total and 5 s to connect.
+    '''
+
+    def __init__(self,
+                 *,
+                 limit: int = 100,
+                 limit_per_host: int = 10,
+                 ttl_dns_cache: Optional[int] = 300,
+                 keepalive_timeout: float = 30,
+                 timeout: aiohttp.ClientTimeout = None) -> None:
+        self._connector_args = {
+            'limit': limit,
+            'limit_per_host': limit_per_host,
+            'ttl_dns_cache': ttl_dns_cache,
+            'use_dns_cache': ttl_dns_cache is not None,
+            'keepalive_timeout': keepalive_timeout,
+        }
+        self._timeout = timeout or aiohttp.ClientTimeout(total=10, connect=5)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self) -> 'Client':
+        self.session  # pylint: disable=pointless-statement
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.close()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        '''The pooled session, created on first access within a running event loop.'''
+        if self._session is None or self._session.closed:
+            self._session = client_session(
+                connector=aiohttp.TCPConnector(**self._connector_args),
+                timeout=self._timeout)
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def routes(self, co: t.Transport) -> dict[str, t.Route]:
+        return await _api().routes(co, session=self.session)
+
+    async def stops(self, co: t.Transport, route_id: str) -> Iterable[t.Stop]:
+        return await _api().stops(co, route_id, session=self.session)
+
+    async def etas(self,
+                   co: t.Transport,
+                   route_id: str,
+                   stop_id: str,
+                   language: t.Language = 'tc',
+                   *,
+                   fallback: bool = False,
+                   compact: bool = False) -> Union[t.Etas, t.CompactEtas]:
+        return await _api().etas(co, route_id, stop_id, language,
+                                 fallback=fallback,
+                                 compact=compact,
+                                 session=self.session)
+
+    async def etas_many(self,
+                        requests: Iterable[tuple[t.Transport, str, str]],
+                        language: t.Language = 'tc',
+                        *,
+                        fallback: bool = False,
+                        compact: bool = False) -> list[Union[t.Etas, t.CompactEtas]]:
+        return await _api().etas_many(requests, language,
+                                      fallback=fallback,
+                                      compact=compact,
+                                      session=self.session)
+
+    def watch(self,
+              co: t.Transport,
+              route_id: str,
+              stop_id: str,
+              language: t.Language = 'tc',
+              *,
+              fallback: bool = False) -> AsyncIterator[t.Etas]:
+        return _api().watch(co, route_id, stop_id, language,
+                            fallback=fallback,
+                            session=self.session)
+
+    async def nearby(self,
+                     lat: float,
+                     lng: float,
+                     radius: float = 300,
+                     transports: Iterable[t.Transport] = None) -> list[dict[str,]]:
+        return await _api().nearby(lat, lng, radius, transports, session=self.session)
+
+    async def nearby_many(self,
+                          points: Iterable[tuple[float, float]],
+                          radius: float = 300,
+                          transports: Iterable[t.Transport] = None) -> list[list[dict[str,]]]:
+        return await _api().nearby_many(points, radius, transports, session=self.session)
+
+
+def _api():
+    # resolved on demand as the package itself imports this module
+    return importlib.import_module(__package__)
@@ -1,17 +1,23 @@
 import asyncio
 from datetime import datetime
+from typing import Iterable, Optional
 
 import aiohttp
 
 from . import t
-from ._utils import dt_to_8601, ensure_session, error_eta
+from ._cache import ETAS, STOP_DETAILS, cached_routes, cached_stop_locations
+from ._metrics import timed
+from ._resilience import CircuitOpenError, guarded
+from ._utils import (dt_to_8601, ensure_session, epoch, error_compact, error_eta, intern,
+                     single_flight)
 
 
 @ensure_session
+@cached_routes('ctb')
 async def routes(*, session: aiohttp.ClientSession) -> dict[str, t.Route]:
     async def ends(r: dict, s: aiohttp.ClientSession):
-        # pylint: disable=line-too-long
-        async with s.get(f'https://rt.data.gov.hk/v2/transport/citybus/route-stop/ctb/{r["route"]}/inbound') as request:
+        url = f'https://rt.data.gov.hk/v2/transport/citybus/route-stop/ctb/{r["route"]}/inbound'
+        async with guarded(s.get, url, 'ctb.route-stops') as request:
             return r['route'], {
                 'outbound': [{
                     'id': f'{r["route"]}_outbound_1',
@@ -40,7 +46,9 @@ async def routes(*, session: aiohttp.ClientSession) -> dict[str, t.Route]:
                 }]
             }
 
-    async with session.get('https://rt.data.gov.hk/v2/transport/citybus/route/ctb') as request:
+    async with guarded(session.get,
+                       'https://rt.data.gov.hk/v2/transport/citybus/route/ctb',
+                       'ctb.routes') as request:
         return {d[0]: d[1]
                 for d in await asyncio.gather(*[ends(r, session)
                                                 for r in (await request.json())['data']])
@@ -49,29 +57,44 @@ async def routes(*, session: aiohttp.ClientSession) -> dict[str, t.Route]:
 
 @ensure_session
 async def stops(route_id: str, *, session: aiohttp.ClientSession) -> list[dict[str,]]:
-    async def fetch(stop: dict, session: aiohttp.ClientSession):
-        async with session.get(
-                f'https://rt.data.gov.hk/v2/transport/citybus/stop/{stop["stop"]}') as request:
-            detail = (await request.json())['data']
-            return {
-                'id': stop['stop'],
-                'seq': int(stop['seq']),
-                'name': {
-                    'tc': detail.get('name_tc'),
-                    'en': detail.get('name_en'),
-                },
-                'location': (detail['lat'], detail['long'])
-            }
-
     # pylint: disable=line-too-long
-    async with session.get(
-            f'https://rt.data.gov.hk/v2/transport/citybus/route-stop/ctb/{"/".join(route_id.split("_")[:2])}') as request:
-        data = await asyncio.gather(
-            *[fetch(stop, session) for stop in (await request.json())['data']])
+    async with guarded(
+            session.get,
+            f'https://rt.data.gov.hk/v2/transport/citybus/route-stop/ctb/{"/".join(route_id.split("_")[:2])}',
+            'ctb.route-stops') as request:
+        route_stops = (await request.json())['data']
 
-    if len(data) == 0:
+    if len(route_stops) == 0:
         raise KeyError('route not exists')
-    return data
+    details = await asyncio.gather(
+        *[_stop_detail(stop['stop'], session) for stop in route_stops])
+    return [{
+        'id': stop['stop'],
+        'seq': int(stop['seq']),
+        **details[idx]
+    } for idx, stop in enumerate(route_stops)]
+
+
+@ensure_session
+async def prefill_stops(stop_ids: Iterable[str], *, session: aiohttp.ClientSession) -> int:
+    '''Fill the shared stop-detail cache with the given stops.
+
+    Citybus does not publish a bulk stop listing, so the details are fetched
+    one stop at a time; stops that are already cached are skipped.
+
+    Returns:
+        Number of stops cached.
+    '''
+    return len(await asyncio.gather(*[_stop_detail(s, session) for s in set(stop_ids)]))
+
+
+async def stop_locations(*, session: aiohttp.ClientSession = None) -> list[t.StopLocation]:
+    '''Get the (ID, name, location) of the stops fetched so far.
+
+    Citybus does not publish a bulk stop listing, see `prefill_stops()`.
+    '''
+    # pylint: disable=unused-argument
+    return cached_stop_locations('ctb')
 
 
 @ensure_session
@@ -80,16 +103,41 @@ async def etas(route_id: str,
                language: t.Language = 'tc',
                *,
                session: aiohttp.ClientSession) -> t.Etas:
-    route, direction, _ = route_id.split('_')
+    try:
+        response = await _fetch_etas(_eta_endpoint(route_id, stop_id, language), session)
+    except CircuitOpenError:
+        return error_eta('api-error', language=language)
+    return _parse_etas(response, route_id, stop_id, language)
+
+
+def _eta_endpoint(route_id: str, stop_id: str, _language: t.Language) -> tuple[str, ...]:
+    return stop_id, route_id.split('_')[0]
+
+
+def _generated_at(response: dict) -> Optional[datetime]:
+    return datetime.fromisoformat(response['generated_timestamp'])
+
 
-    async with session.get(
-            f'https://rt.data.gov.hk/v2/transport/citybus/eta/ctb/{stop_id}/{route}') as request:
-        response = await request.json()
+@ETAS.cached('ctb', _generated_at)
+@single_flight
+async def _fetch_etas(endpoint: tuple[str, ...], session: aiohttp.ClientSession) -> dict:
+    async with guarded(session.get,
+                       f'https://rt.data.gov.hk/v2/transport/citybus/eta/ctb/{"/".join(endpoint)}',
+                       'ctb.eta') as request:
+        return await request.json()
+
+
+@timed('ctb.eta')
+def _parse_etas(response: dict,
+                route_id: str,
+                stop_id: str,
+                language: t.Language) -> t.Etas:
+    _, direction, _ = route_id.split('_')
 
     if len(response) == 0 or response.get('data') is None:
-        return error_eta('api-error')
+        return error_eta('api-error', language=language)
     if len(response['data']) == 0:
-        return error_eta('empty')
+        return error_eta('empty', language=language)
 
     etas_ = []
     timestamp = datetime.fromisoformat(response['generated_timestamp'])
@@ -133,6 +181,54 @@ async def etas(route_id: str,
     }
 
 
+@timed('ctb.eta')
+def _parse_compact(response: dict,
+                   route_id: str,
+                   stop_id: str,
+                   language: t.Language) -> t.CompactEtas:
+    _, direction, _ = route_id.split('_')
+
+    if len(response) == 0 or response.get('data') is None:
+        return error_compact('api-error')
+    if len(response['data']) == 0:
+        return error_compact('empty')
+
+    etas_ = []
+    timestamp = epoch(response['generated_timestamp'])
+
+    for eta in response['data']:
+        if eta['dir'].lower() != direction[0]:
+            continue
+        # no ETA during the hours the route is operated by KMB
+        eta_ts = epoch(eta['eta']) if eta['eta'] else None
+        etas_.append(t.CompactEta(
+            eta_ts,
+            eta_ts is not None and eta_ts - timestamp < 60,
+            True,
+            intern(eta[f'dest_{language}']),
+            None,
+            None,
+            None,
+            intern(eta[f'rmk_{language}'])))
+    return t.CompactEtas(timestamp, None, tuple(etas_))
+
+
+async def _stop_detail(stop_id: str, session: aiohttp.ClientSession) -> dict[str,]:
+    if (detail := STOP_DETAILS.get(('ctb', stop_id))) is None:
+        url = f'https://rt.data.gov.hk/v2/transport/citybus/stop/{stop_id}'
+        async with guarded(session.get, url, 'ctb.stop') as request:
+            data = (await request.json())['data']
+        detail = {
+            'name': {
+                'tc': data.get('name_tc'),
+                'en': data.get('name_en'),
+            },
+            'location': (data['lat'], data['long'])
+        }
+        STOP_DETAILS.set(('ctb', stop_id), detail)
+    return detail
+
+
 # @ensure_session
 # async def routes(*, session: aiohttp.ClientSession):
 #     # Stop ID of the same stop from different route will have the same ID,
@@ -1,20 +1,43 @@
 import asyncio
+import json
+import os
+import tempfile
+import time
 from datetime import datetime
 from itertools import chain
+from pathlib import Path
 from typing import Generator, Literal, Optional
 
 import aiohttp
 
 from . import t
-from ._utils import dt_to_8601, ensure_session, error_eta
+from ._cache import ETAS, STOP_DETAILS, cached_routes, cached_stop_locations
+from ._metrics import timed
+from ._resilience import CircuitOpenError, guarded
+from ._utils import (dt_to_8601, ensure_session, epoch, error_compact, error_eta, intern,
+                     single_flight)
+
+_BASE_PATH = Path(tempfile.gettempdir())
+
+# seconds before the on-disk route-stop index is rebuilt
+ROUTE_STOP_TTL = 86400
+
+_route_stops: Optional[dict[str, list[tuple[str, int]]]] = None
+_route_stops_expiry = 0.0
+
+# `time.monotonic()` of the last bulk stop listing loaded into `STOP_DETAILS`
+_stops_loaded_at: Optional[float] = None
 
 
 @ensure_session
+@cached_routes('kmb')
 async def routes(*, session: aiohttp.ClientSession) -> dict[str, t.Route]:
     routes_ = {}
     specials = set()
 
-    async with session.get('https://data.etabus.gov.hk/v1/transport/kmb/route') as request:
+    async with guarded(session.get,
+                       'https://data.etabus.gov.hk/v1/transport/kmb/route',
+                       'kmb.routes') as request:
         for route in (await request.json())['data']:
             routes_.setdefault(route['route'], {'inbound': [], 'outbound': []})
             direction = 'outbound' if route['bound'] == 'O' else 'inbound'
@@ -45,29 +68,52 @@ async def routes(*, session: aiohttp.ClientSession) -> dict[str, t.Route]:
 
 @ensure_session
 async def stops(route_id: str, *, session: aiohttp.ClientSession) -> list[dict[str,]]:
-    async def fetch(stop: dict, session: aiohttp.ClientSession):
-        async with session.get(
-                f'https://data.etabus.gov.hk/v1/transport/kmb/stop/{stop["stop"]}') as request:
-            detail = (await request.json())['data']
-            return {
-                'id': stop['stop'],
-                'seq': int(stop['seq']),
-                'name': {
-                    'tc': detail.get('name_tc'),
-                    'en': detail.get('name_en'),
-                },
-                'location': (detail['lat'], detail['long'])
-            }
-
-    # pylint: disable=line-too-long
-    async with session.get(
-            f'https://data.etabus.gov.hk/v1/transport/kmb/route-stop/{"/".join(route_id.split("_"))}') as request:
-        data = await asyncio.gather(
-            *[fetch(stop, session) for stop in (await request.json())['data']])
-
-    if len(data) == 0:
+    async def fetch(stop_id: str, session: aiohttp.ClientSession):
+        if (detail := STOP_DETAILS.get(('kmb', stop_id))) is None:
+            url = f'https://data.etabus.gov.hk/v1/transport/kmb/stop/{stop_id}'
+            async with guarded(session.get, url, 'kmb.stop') as request:
+                detail = _stop_detail((await request.json())['data'])
+            STOP_DETAILS.set(('kmb', stop_id), detail)
+        return detail
+
+    if (route_stops := (await _route_stop_index(session)).get(route_id)) is None:
         raise KeyError('route not exists')
-    return data
+    if _stops_expired() and any(('kmb', s) not in STOP_DETAILS for s, _ in route_stops):
+        await prefill_stops(session=session)
+    details = await asyncio.gather(*[fetch(stop_id, session) for stop_id, _ in route_stops])
+    return [{
+        'id': stop_id,
+        'seq': seq,
+        **details[idx]
+    } for idx, (stop_id, seq) in enumerate(route_stops)]
+
+
+@ensure_session
+async def prefill_stops(*, session: aiohttp.ClientSession) -> int:
+    '''Fill the shared stop-detail cache from the bulk stop listing.
+
+    Returns:
+        Number of stops cached.
+    '''
+    return await _load_stops('https://data.etabus.gov.hk/v1/transport/kmb/stop', session)
+
+
+@ensure_session
+async def stop_locations(*, session: aiohttp.ClientSession) -> list[t.StopLocation]:
+    '''Get the (ID, name, location) of every stop from the bulk stop listing.'''
+    await prefill_stops(session=session)
+    return cached_stop_locations('kmb')
+
+
+@ensure_session
+async def prefill_route_stops(*, session: aiohttp.ClientSession) -> int:
+    '''Rebuild the on-disk route-stop index from the bulk route-stop dataset.
+
+    Returns:
+        Number of routes indexed.
+    '''
+    return await _load_route_stops('https://data.etabus.gov.hk/v1/transport/kmb/route-stop',
+                                   session)
 
 
 @ensure_session
@@ -76,12 +122,37 @@ async def etas(route_id: str,
                language: t.Language = 'tc',
                *,
                session: aiohttp.ClientSession) -> t.Etas:
-    route, direction, service_type = route_id.split('_')
+    try:
+        response = await _fetch_etas(_eta_endpoint(route_id, stop_id, language), session)
+    except CircuitOpenError:
+        return error_eta('api-error', language=language)
+    return _parse_etas(response, route_id, stop_id, language)
+
+
+def _eta_endpoint(route_id: str, stop_id: str, _language: t.Language) -> tuple[str, ...]:
+    route, _, service_type = route_id.split('_')
+    return stop_id, route, service_type
+
+
+def _generated_at(response: dict) -> Optional[datetime]:
+    return datetime.fromisoformat(response['generated_timestamp'])
 
-    # pylint: disable=line-too-long
-    async with session.get(
-            f'https://data.etabus.gov.hk/v1/transport/kmb/eta/{stop_id}/{route}/{service_type}') as request:
-        response = await request.json()
+
+@ETAS.cached('kmb', _generated_at)
+@single_flight
+async def _fetch_etas(endpoint: tuple[str, ...], session: aiohttp.ClientSession) -> dict:
+    async with guarded(session.get,
+                       f'https://data.etabus.gov.hk/v1/transport/kmb/eta/{"/".join(endpoint)}',
+                       'kmb.eta') as request:
+        return await request.json()
+
+
+@timed('kmb.eta')
+def _parse_etas(response: dict,
+                route_id: str,
+                stop_id: str,
+                language: t.Language) -> t.Etas:
+    _, direction, _ = route_id.split('_')
 
     if len(response) == 0:
         return error_eta('api-error', language=language)
@@ -96,10 +167,10 @@ async def etas(route_id: str,
             continue
         if eta['eta'] is None:
             if eta['rmk_en'] == 'The final bus has departed from this stop':
-                return error_eta('eos')
+                return error_eta('eos', language=language)
             elif eta['rmk_en'] == '':
-                return error_eta('empty')
-            return error_eta(eta[f'rmk_{language}'])
+                return error_eta('empty', language=language)
+            return error_eta(eta[f'rmk_{language}'], language=language)
 
         eta_dt = datetime.fromisoformat(eta['eta'])
         etas_.append({
@@ -122,17 +193,112 @@ async def etas(route_id: str,
     }
 
 
+@timed('kmb.eta')
+def _parse_compact(response: dict,
+                   route_id: str,
+                   stop_id: str,
+                   language: t.Language) -> t.CompactEtas:
+    _, direction, _ = route_id.split('_')
+
+    if len(response) == 0:
+        return error_compact('api-error')
+    if response.get('data') is None:
+        return error_compact('empty')
+
+    etas_ = []
+    timestamp = epoch(response['generated_timestamp'])
+
+    for eta in response['data']:
+        if eta['dir'].lower() != direction[0]:
+            continue
+        if eta['eta'] is None:
+            if eta['rmk_en'] == 'The final bus has departed from this stop':
+                return error_compact('eos')
+            elif eta['rmk_en'] == '':
+                return error_compact('empty')
+            return error_compact(eta[f'rmk_{language}'])
+
+        eta_ts = epoch(eta['eta'])
+        etas_.append(t.CompactEta(
+            eta_ts,
+            eta_ts - timestamp < 30,
+            eta.get(f'rmk_{language}') in ('\u539f\u5b9a\u73ed\u6b21', 'Scheduled Bus'),
+            intern(eta[f'dest_{language}']),
+            _varient_text(eta['service_type'], language),
+            None,
+            None,
+            intern(eta[f'rmk_{language}'])))
+    return t.CompactEtas(timestamp, None, tuple(etas_))
+
+
+async def _route_stop_index(session: aiohttp.ClientSession) -> dict[str, list[tuple[str, int]]]:
+    global _route_stops, _route_stops_expiry  # pylint: disable=global-statement
+
+    if _route_stops is not None and _route_stops_expiry > time.time():
+        return _route_stops
+
+    path = _BASE_PATH.joinpath('_hketa_kmb_route_stop.json')
+    try:
+        if path.stat().st_mtime + ROUTE_STOP_TTL > time.time():
+            with open(path, 'r', encoding='utf-8') as f:
+                _route_stops = json.load(f)
+            _route_stops_expiry = path.stat().st_mtime + ROUTE_STOP_TTL
+            return _route_stops
+    except (OSError, ValueError):
+        pass
+    await prefill_route_stops(session=session)
+    return _route_stops
+
+
+def _stops_expired() -> bool:
+    return _stops_loaded_at is None or _stops_loaded_at + STOP_DETAILS.ttl <= time.monotonic()
+
+
+@single_flight
+async def _load_stops(url: str, session: aiohttp.ClientSession) -> int:
+    global _stops_loaded_at  # pylint: disable=global-statement
+
+    async with guarded(session.get, url, 'kmb.stops') as request:
+        data = (await request.json())['data']
+    STOP_DETAILS.update((('kmb', stop['stop']), _stop_detail(stop)) for stop in data)
+    _stops_loaded_at = time.monotonic()
+    return len(data)
+
+
+@single_flight
+async def _load_route_stops(url: str, session: aiohttp.ClientSession) -> int:
+    global _route_stops, _route_stops_expiry  # pylint: disable=global-statement
+
+    index = {}
+    async with guarded(session.get, url, 'kmb.route-stops') as request:
+        for stop in (await request.json())['data']:
+            direction = 'outbound' if stop['bound'] == 'O' else 'inbound'
+            index.setdefault(f'{stop["route"]}_{direction}_{stop["service_type"]}', [])\
+                .append((stop['stop'], int(stop['seq'])))
+    for route_stops in index.values():
+        route_stops.sort(key=lambda s: s[1])
+
+    # readers never see a partially written index
+    path = _BASE_PATH.joinpath('_hketa_kmb_route_stop.json')
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps(index), encoding='utf-8')
+    os.replace(tmp, path)
+    _route_stops, _route_stops_expiry = index, time.time() + ROUTE_STOP_TTL
+    return len(index)
+
+
 async def _variants(route: str,
                     direction: Literal['1', '2'],
                     session: aiohttp.ClientSession) -> list[dict]:
-    async with session.request('GET',
-                               'https://search.kmb.hk/KMBWebSite/Function/FunctionRequest.ashx',
-                               params={
-                                   'action': 'getSpecialRoute',
-                                   'route': route,
-                                   'bound': direction
-                               },
-                               ) as requset:
+    url = 'https://search.kmb.hk/KMBWebSite/Function/FunctionRequest.ashx'
+    async with guarded(session.get,
+                       url,
+                       'kmb.variants',
+                       params={
+                           'action': 'getSpecialRoute',
+                           'route': route,
+                           'bound': direction
+                       }) as requset:
         return (await requset.json(content_type=None))['data']['routes']
 
 
@@ -140,3 +306,13 @@ def _varient_text(service_type: str, language: t.Language) -> Optional[str]:
     if service_type == '1':
         return None
     return '\u7279\u5225\u73ed\u6b21' if language == 'tc' else 'Special Departure'
+
+
+def _stop_detail(stop: dict) -> dict[str,]:
+    return {
+        'name': {
+            'tc': stop.get('name_tc'),
+            'en': stop.get('name_en'),
+        },
+        'location': (stop['lat'], stop['long'])
+    }
@@ -1,62 +1,62 @@
-import asyncio
-import csv
 from datetime import datetime, timedelta
-from typing import Generator
+from typing import Generator, Optional
 
 import aiohttp
-import pytz
 
 from . import t
-from ._utils import dt_to_8601, ensure_session, error_eta, search_location
+from ._cache import ETAS, cached_routes
+from ._opendata import CsvDataset
+from ._metrics import timed
+from ._resilience import CircuitOpenError, guarded
+from ._utils import (HKT, dt_to_8601, ensure_session, epoch, error_compact, error_eta,
+                     intern, search_locations, single_flight)
+
+_ROUTES_STOPS = CsvDataset(
+    'https://opendata.mtr.com.hk/data/light_rail_routes_and_stops.csv',
+    lambda row: (row[0], 'outbound' if row[1] == '1' else 'inbound'),
+    endpoint='lrt.routes-stops')
 
 
 @ensure_session
+@cached_routes('lrt')
 async def routes(*, session: aiohttp.ClientSession) -> dict[str, t.Route]:
     routes_ = {}
-    async with session.get(
-            'https://opendata.mtr.com.hk/data/light_rail_routes_and_stops.csv') as request:
-        for row in csv.reader((await request.text('utf-8')).splitlines()[1:]):
-            # column definition:
-            #   route, direction, stopCode, stopID, stopTCName, stopENName, seq
-            direction = 'outbound' if row[1] == '1' else 'inbound'
-            routes_.setdefault(row[0], {'outbound': [], 'inbound': []})
-
-            if row[6] == '1.00':
-                # original
-                routes_[row[0]][direction].append({
-                    'id': None,
-                    'description': None,
-                    'orig':  {'en': row[5], 'tc': row[4]},
-                    'dest': {}
-                })
+    for row in (await _ROUTES_STOPS.load(session)).rows:
+        # column definition:
+        #   route, direction, stopCode, stopID, stopTCName, stopENName, seq
+        direction = 'outbound' if row[1] == '1' else 'inbound'
+        routes_.setdefault(row[0], {'outbound': [], 'inbound': []})
+
+        if row[6] == '1.00':
+            # original
+            routes_[row[0]][direction].append({
+                'id': None,
+                'description': None,
+                'orig':  {'en': row[5], 'tc': row[4]},
+                'dest': {}
+            })
+        else:
+            # destination
+            if row[0] in ('705', '706'):
+                routes_[row[0]][direction][0]['id'] =\
+                    f'{row[0]}_{direction}_TSW Circular'
             else:
-                # destination
-                if row[0] in ('705', '706'):
-                    routes_[row[0]][direction][0]['id'] =\
-                        f'{row[0]}_{direction}_TSW Circular'
-                else:
-                    routes_[row[0]][direction][0]['id'] =\
-                        f'{row[0]}_{direction}_{row[5]}'
-
-                routes_[row[0]][direction][0]['dest'] = {
-                    'en': row[5], 'tc': row[4]
-                }
+                routes_[row[0]][direction][0]['id'] =\
+                    f'{row[0]}_{direction}_{row[5]}'
+
+            routes_[row[0]][direction][0]['dest'] = {
+                'en': row[5], 'tc': row[4]
+            }
     return routes_
 
 
-@ ensure_session
+@ensure_session
 async def stops(route_id: str, *, session: aiohttp.ClientSession) -> Generator[t.Stop, None, None]:
-    async with session.get(
-            'https://opendata.mtr.com.hk/data/light_rail_routes_and_stops.csv') as request:
-        # pylint: disable=line-too-long
-        stops_ = [stop for stop in csv.reader((await request.text('utf-8')).splitlines()[1:])
-                  if set((stop[0], 'outbound' if stop[1] == '1' else 'inbound')) == set(route_id.split('_')[:2])]
-
-    if len(stops_) == 0:
+    route, direction, *_ = route_id.split('_')
+    if (stops_ := (await _ROUTES_STOPS.load(session)).index.get((route, direction))) is None:
         raise KeyError('route not exists')
 
-    locations = await asyncio.gather(
-        *[search_location(f'\u8f15\u9435\uff0d{s[4]}', session) for s in stops_])
+    locations = await search_locations([f'\u8f15\u9435\uff0d{s[4]}' for s in stops_], session)
     return ({
         'id': s[3],
         'seq': int(s[6].removesuffix('.00')),
@@ -65,29 +65,77 @@ async def stops(route_id: str, *, session: aiohttp.ClientSession) -> Generator[t
     } for i, s in enumerate(stops_))
 
 
-@ ensure_session
+@ensure_session
+async def prefill_locations(*, session: aiohttp.ClientSession) -> int:
+    '''Geocode every station into the on-disk geocoding cache.
+
+    Returns:
+        Number of stations geocoded.
+    '''
+    names = {row[4] for row in (await _ROUTES_STOPS.load(session)).rows}
+    await search_locations([f'\u8f15\u9435\uff0d{name}' for name in names], session)
+    return len(names)
+
+
+@ensure_session
+async def stop_locations(*, session: aiohttp.ClientSession) -> list[t.StopLocation]:
+    '''Get the (ID, name, location) of every stop, geocoding those not cached yet.'''
+    stops_ = {row[3]: row for row in (await _ROUTES_STOPS.load(session)).rows}
+    locations = await search_locations(
+        [f'\u8f15\u9435\uff0d{s[4]}' for s in stops_.values()], session)
+    return [(sid, {'tc': s[4], 'en': s[5]}, locations[i])
+            for i, (sid, s) in enumerate(stops_.items())]
+
+
+@ensure_session
 async def etas(route_id: str,
                stop_id: str,
                language: t.Language = 'tc',
                *,
                session: aiohttp.ClientSession) -> t.Etas:
+    try:
+        response = await _fetch_etas(_eta_endpoint(route_id, stop_id, language), session)
+    except CircuitOpenError:
+        return error_eta('api-error', language=language)
+    return _parse_etas(response, route_id, stop_id, language)
+
+
+def _eta_endpoint(_route_id: str, stop_id: str, _language: t.Language) -> tuple[str, ...]:
+    # the station schedule covers every route and language
+    return (stop_id, )
+
+
+def _generated_at(response: dict) -> Optional[datetime]:
+    return datetime.fromisoformat(response['system_time'])
+
+
+@ETAS.cached('lrt', _generated_at)
+@single_flight
+async def _fetch_etas(endpoint: tuple[str, ...], session: aiohttp.ClientSession) -> dict:
+    async with guarded(session.get,
+                       'https://rt.data.gov.hk/v1/transport/mtr/lrt/getSchedule',
+                       'lrt.eta',
+                       params={'station_id': endpoint[0]}) as request:
+        return await request.json()
+
+
+@timed('lrt.eta')
+def _parse_etas(response: dict,
+                route_id: str,
+                stop_id: str,
+                language: t.Language) -> t.Etas:
     route, _, destination = route_id.split('_')
     lc = 'ch' if language == 'tc' else 'en'
 
-    async with session.get('https://rt.data.gov.hk/v1/transport/mtr/lrt/getSchedule',
-                           params={'station_id': stop_id}) as request:
-        response = await request.json()
-
     if len(response) == 0 or response.get('status', 0) == 0:
-        return error_eta('api-error')
+        return error_eta('api-error', language=language)
     if all(platform.get('end_service_status', False)
             for platform in response['platform_list']):
-        return error_eta('eos')
+        return error_eta('eos', language=language)
 
     etas_ = []
     cnt_stopped = 0
-    timestamp = datetime.fromisoformat(response['system_time'])\
-        .astimezone(pytz.timezone('Asia/Hong_kong'))
+    timestamp = datetime.fromtimestamp(epoch(response['system_time']), HKT)
 
     for platform in response['platform_list']:
         for eta in platform.get('route_list', []):
@@ -108,24 +156,25 @@ async def etas(route_id: str,
                     'is_arriving': False,
                     'is_scheduled': False,
                     'extras': {
-                        'destination': eta[f'dest_{lc}'],
+                        'destinaion': eta[f'dest_{lc}'],
                         'varient': None,
                         'platform': str(platform['platform_id']),
                         'car_length': eta['train_length']
                     },
+                    'remark': None,
                 })
             else:
                 etas_.append({
                     'eta': dt_to_8601(timestamp),
                     'is_arriving': True,
                     'is_scheduled': False,
-                    'remark': eta_min,
                     'extras': {
-                        'destination': eta[f'dest_{lc}'],
+                        'destinaion': eta[f'dest_{lc}'],
                         'varient': None,
                         'platform': str(platform['platform_id']),
                         'car_length': eta['train_length']
-                    }
+                    },
+                    'remark': eta_min,
                 })
 
     if len(etas_) > 0:
@@ -135,7 +184,56 @@ async def etas(route_id: str,
             'etas': etas_
         }
     if 'red_alert_status' in response.keys():
-        return error_eta(response[f'red_alert_message_{lc}'])
+        return error_eta(response[f'red_alert_message_{lc}'], language=language)
+    if cnt_stopped > 0:
+        return error_eta('eos', language=language)
+    return error_eta('empty', language=language)
+
+
+@timed('lrt.eta')
+def _parse_compact(response: dict,
+                   route_id: str,
+                   stop_id: str,
+                   language: t.Language) -> t.CompactEtas:
+    route, _, destination = route_id.split('_')
+    lc = 'ch' if language == 'tc' else 'en'
+
+    if len(response) == 0 or response.get('status', 0) == 0:
+        return error_compact('api-error')
+    if all(platform.get('end_service_status', False)
+            for platform in response['platform_list']):
+        return error_compact('eos')
+
+    etas_ = []
+    cnt_stopped = 0
+    timestamp = epoch(response['system_time'])
+
+    for platform in response['platform_list']:
+        for eta in platform.get('route_list', []):
+            if eta['route_no'] != route:
+                continue
+            if eta.get('stop') == 1:
+                cnt_stopped += 1
+                continue
+            if eta['dest_en'] != destination:
+                continue
+
+            eta_min: str = eta[f'time_{lc}'].split(' ')[0]  # e.g. 3 分鐘 / 即將抵達
+            is_numeric = eta_min.isnumeric()
+            etas_.append(t.CompactEta(
+                timestamp + int(float(eta_min) * 60) if is_numeric else timestamp,
+                not is_numeric,
+                False,
+                intern(eta[f'dest_{lc}']),
+                None,
+                intern(str(platform['platform_id'])),
+                eta['train_length'],
+                None if is_numeric else intern(eta_min)))
+
+    if len(etas_) > 0:
+        return t.CompactEtas(timestamp, None, tuple(etas_))
+    if 'red_alert_status' in response.keys():
+        return error_compact(response[f'red_alert_message_{lc}'])
     if cnt_stopped > 0:
-        return error_eta('eos')
-    return error_eta('empty')
+        return error_compact('eos')
+    return error_compact('empty')
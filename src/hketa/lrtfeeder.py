@@ -1,48 +1,50 @@
-import csv
 from datetime import datetime, timedelta
-from typing import Generator
+from typing import Generator, Optional
 
 import aiohttp
-import pytz
 
 from . import t
-from ._utils import dt_to_8601, ensure_session, error_eta
+from ._cache import ETAS, cached_routes
+from ._opendata import CsvDataset
+from ._metrics import timed
+from ._resilience import CircuitOpenError, guarded
+from ._utils import HKT, dt_to_8601, ensure_session, error_compact, error_eta, single_flight
+
+_STOPS = CsvDataset('https://opendata.mtr.com.hk/data/mtr_bus_stops.csv',
+                    lambda row: (row[0], 'outbound' if row[1] == 'O' else 'inbound'),
+                    endpoint='lrtfeeder.stops')
 
 
 @ensure_session
+@cached_routes('lrtfeeder')
 async def routes(*, session: aiohttp.ClientSession) -> dict[str, t.Route]:
     routes_ = {}
-    async with session.get('https://opendata.mtr.com.hk/data/mtr_bus_stops.csv') as request:
-        for row in csv.reader((await request.text('utf-8')).splitlines()[1:]):
-            # column definition:
-            #   route, direction, seq, stopID, stopLAT, stopLONG, stopTCName, stopENName
-            direction = 'outbound' if row[1] == 'O' else 'inbound'
-            routes_.setdefault(row[0], {'outbound': [], 'inbound': []})
-
-            if row[2] == '1.00' or row[2] == '1':
-                # orignal
-                routes_[row[0]][direction].append({
-                    'id': f'{row[0]}_{direction}_1',
-                    'description': None,
-                    'orig': {'en': row[7], 'tc': row[6]},
-                    'dest': {}
-                })
-            else:
-                # destination
-                routes_[row[0]][direction][0]['dest'] = {
-                    'en': row[7], 'tc': row[6]
-                }
+    for row in (await _STOPS.load(session)).rows:
+        # column definition:
+        #   route, direction, seq, stopID, stopLAT, stopLONG, stopTCName, stopENName
+        direction = 'outbound' if row[1] == 'O' else 'inbound'
+        routes_.setdefault(row[0], {'outbound': [], 'inbound': []})
+
+        if row[2] == '1.00' or row[2] == '1':
+            # orignal
+            routes_[row[0]][direction].append({
+                'id': f'{row[0]}_{direction}_1',
+                'description': None,
+                'orig': {'en': row[7], 'tc': row[6]},
+                'dest': {}
+            })
+        else:
+            # destination
+            routes_[row[0]][direction][0]['dest'] = {
+                'en': row[7], 'tc': row[6]
+            }
     return routes_
 
 
 @ensure_session
 async def stops(route_id: str, *, session: aiohttp.ClientSession) -> Generator[t.Stop, None, None]:
-    async with session.get('https://opendata.mtr.com.hk/data/mtr_bus_stops.csv') as request:
-        # pylint: disable=line-too-long
-        stops_ = [stop for stop in csv.reader((await request.text('utf-8')).splitlines()[1:])
-                  if set((stop[0], 'outbound' if stop[1] == 'O' else 'inbound')) == set(route_id.split('_')[:2])]
-
-    if len(stops_) == 0:
+    route, direction, *_ = route_id.split('_')
+    if (stops_ := (await _STOPS.load(session)).index.get((route, direction))) is None:
         raise KeyError('route not exists')
     return ({
         'id': s[3],
@@ -52,28 +54,62 @@ async def stops(route_id: str, *, session: aiohttp.ClientSession) -> Generator[t
     } for s in stops_)
 
 
-@ ensure_session
+@ensure_session
+async def stop_locations(*, session: aiohttp.ClientSession) -> list[t.StopLocation]:
+    '''Get the (ID, name, location) of every stop.'''
+    stops_ = {row[3]: row for row in (await _STOPS.load(session)).rows}
+    return [(sid, {'tc': s[6], 'en': s[7]}, (float(s[4]), float(s[5])))
+            for sid, s in stops_.items()]
+
+
+@ensure_session
 async def etas(route_id: str,
                stop_id: str,
                language: t.Language = 'tc',
                *,
                session: aiohttp.ClientSession) -> t.Etas:
-    route, *_ = route_id.split('_')
+    try:
+        response = await _fetch_etas(_eta_endpoint(route_id, stop_id, language), session)
+    except CircuitOpenError:
+        return error_eta('api-error', language=language)
+    return _parse_etas(response, route_id, stop_id, language)
+
+
+def _eta_endpoint(route_id: str, _stop_id: str, language: t.Language) -> tuple[str, ...]:
+    # the route schedule covers every stop of the route
+    return route_id.split('_')[0], language
+
+
+def _generated_at(response: dict) -> Optional[datetime]:
+    return datetime.strptime(response['routeStatusTime'], '%Y/%m/%d %H:%M')
 
-    async with session.post('https://rt.data.gov.hk/v1/transport/mtr/bus/getSchedule',
-                            json={'routeName': route, 'language': language}) as request:
-        response = await request.json()
 
+@ETAS.cached('lrtfeeder', _generated_at)
+@single_flight
+async def _fetch_etas(endpoint: tuple[str, ...], session: aiohttp.ClientSession) -> dict:
+    route, language = endpoint
+    async with guarded(session.post,
+                       'https://rt.data.gov.hk/v1/transport/mtr/bus/getSchedule',
+                       'lrtfeeder.eta',
+                       json={'routeName': route, 'language': language}) as request:
+        return await request.json()
+
+
+@timed('lrtfeeder.eta')
+def _parse_etas(response: dict,
+                route_id: str,
+                stop_id: str,
+                language: t.Language) -> t.Etas:
     if len(response) == 0:
-        return error_eta('api-error')
+        return error_eta('api-error', language=language)
     if response['routeStatusRemarkTitle'] is not None:
         if response['routeStatusRemarkTitle'] in ('\u505c\u6b62\u670d\u52d9', 'Non-service hours'):
-            return error_eta('eos')
-        return error_eta(response['routeStatusRemarkTitle'])
+            return error_eta('eos', language=language)
+        return error_eta(response['routeStatusRemarkTitle'], language=language)
 
     etas_ = []
     timestamp = datetime.strptime(response['routeStatusTime'], '%Y/%m/%d %H:%M')\
-        .astimezone(pytz.timezone('Asia/Hong_kong'))
+        .replace(tzinfo=HKT)
 
     for stop in (s for s in response['busStop'] if s['busStopId'] == stop_id):
         for eta in stop['bus']:
@@ -86,7 +122,7 @@ async def etas(route_id: str,
                     'is_arriving': False,
                     'is_scheduled': eta['busLocation']['longitude'] == 0,
                     'extras': {
-                        'destination': None,
+                        'destinaion': None,
                         'varient': None,
                         'platform': None,
                         'car_length': None
@@ -99,7 +135,7 @@ async def etas(route_id: str,
                     'is_arriving': True,
                     'is_scheduled': eta['busLocation']['longitude'] == 0,
                     'extras': {
-                        'destination': None,
+                        'destinaion': None,
                         'varient': None,
                         'platform': None,
                         'car_length': None
@@ -112,3 +148,36 @@ async def etas(route_id: str,
         'message': None,
         'etas': etas_
     }
+
+
+@timed('lrtfeeder.eta')
+def _parse_compact(response: dict,
+                   route_id: str,
+                   stop_id: str,
+                   language: t.Language) -> t.CompactEtas:
+    if len(response) == 0:
+        return error_compact('api-error')
+    if response['routeStatusRemarkTitle'] is not None:
+        if response['routeStatusRemarkTitle'] in ('\u505c\u6b62\u670d\u52d9', 'Non-service hours'):
+            return error_compact('eos')
+        return error_compact(response['routeStatusRemarkTitle'])
+
+    timestamp = int(datetime.strptime(response['routeStatusTime'], '%Y/%m/%d %H:%M')
+                    .replace(tzinfo=HKT)
+                    .timestamp())
+    etas_ = []
+    for stop in (s for s in response['busStop'] if s['busStopId'] == stop_id):
+        for eta in stop['bus']:
+            time_ref = 'departure' if eta['arrivalTimeInSecond'] == '108000' else 'arrival'
+            # eta TimeText has numbers (e.g. 3 分鐘/3 Minutes)
+            has_eta = any(c.isdigit() for c in eta[f'{time_ref}TimeText'])
+            etas_.append(t.CompactEta(
+                timestamp + int(eta[f'{time_ref}TimeInSecond']) if has_eta else timestamp,
+                not has_eta,
+                eta['busLocation']['longitude'] == 0,
+                None,
+                None,
+                None,
+                None,
+                None))
+    return t.CompactEtas(timestamp, None, tuple(etas_))
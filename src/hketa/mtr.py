@@ -1,78 +1,64 @@
-import asyncio
-import csv
 from datetime import datetime
 from typing import Generator, Optional
 
 import aiohttp
-import pytz
 
 from . import t
-from ._utils import dt_to_8601, ensure_session, error_eta, search_location
+from ._cache import ETAS, cached_routes
+from ._opendata import CsvDataset
+from ._metrics import timed
+from ._resilience import CircuitOpenError, guarded
+from ._utils import (HKT, dt_to_8601, ensure_session, epoch, error_compact, error_eta,
+                     intern, search_locations, single_flight)
+
+
+def _route_key(row: list[str]) -> tuple[str, str, Optional[str]]:
+    # column definition:
+    #   route, direction, stopCode, stopID, stopTCName, stopENName, seq
+    direction, _, branch = row[1].partition('-')
+    if branch:
+        # route with branch lines
+        direction, branch = branch, direction  # e.g. LMC-DT
+    return row[0], 'outbound' if direction == 'DT' else 'inbound', branch or None
+
+
+_STATIONS = CsvDataset('https://opendata.mtr.com.hk/data/mtr_lines_and_stations.csv', _route_key,
+                       endpoint='mtr.stations')
 
 
 @ensure_session
+@cached_routes('mtr')
 async def routes(*, session: aiohttp.ClientSession) -> dict[str, t.Route]:
     routes_ = {}
-    async with session.get(
-            'https://opendata.mtr.com.hk/data/mtr_lines_and_stations.csv') as request:
-        for row in csv.reader((await request.text('utf-8')).splitlines()[1:]):
-            # column definition:
-            #   route, direction, stopCode, stopID, stopTCName, stopENName, seq
-            if not any(row):  # skip empty lines
-                continue
-
-            direction, _, branch = row[1].partition('-')
-            if branch:
-                # route with branch lines
-                direction, branch = branch, direction  # e.g. LMC-DT
-            direction = 'outbound' if direction == 'DT' else 'inbound'
-            routes_.setdefault(row[0], {'inbound': [], 'outbound': []})
-
-            if (row[6] == '1.00'):
-                # origin
-                routes_[row[0]][direction].append({
-                    'id': (route_id := '_'.join(filter(None, (row[0], direction, branch)))),
-                    'description': None,
-                    'orig': {'en': row[5], 'tc': row[4]},
-                    'dest': {}
-                })
-            else:
-                # destination
-                if len(routes_[row[0]][direction]) == 1:
-                    routes_[row[0]][direction][0]['dest'] = {
-                        'en': row[5], 'tc': row[4]
-                    }
-                else:
-                    for idx, branch in enumerate(routes_[row[0]][direction]):
-                        if branch['id'] != route_id:
-                            continue
-                        routes_[row[0]][direction][idx]['dest'] = {
-                            'en': row[5], 'tc': row[4]
-                        }
-                        break
+    for row in (await _STATIONS.load(session)).rows:
+        route, direction, branch = _route_key(row)
+        route_id = '_'.join(filter(None, (route, direction, branch)))
+        routes_.setdefault(route, {'inbound': [], 'outbound': []})
+
+        if (row[6] == '1.00'):
+            # origin
+            routes_[route][direction].append({
+                'id': route_id,
+                'description': None,
+                'orig': {'en': row[5], 'tc': row[4]},
+                'dest': {}
+            })
+        else:
+            # destination
+            for service in routes_[route][direction]:
+                if service['id'] == route_id:
+                    service['dest'] = {'en': row[5], 'tc': row[4]}
+                    break
     return routes_
 
 
 @ensure_session
 async def stops(route_id: str, *, session: aiohttp.ClientSession) -> Generator[t.Stop, None, None]:
-    # column definition:
-    #   route, direction, stopCode, stopID, stopTCName, stopENName, seq
-    async with session.get(
-            'https://opendata.mtr.com.hk/data/mtr_lines_and_stations.csv') as request:
-        if len(route_id := route_id.split('_')) > 2:
-            stops_ = [stop for stop in csv.reader((await request.text('utf-8')).splitlines()[1:])
-                      if stop[0] == route_id[0]
-                      and stop[1] == f'{route_id[2]}-{"DT" if route_id[1] == "outbound" else "UT"}']
-        else:
-            stops_ = [stop for stop in csv.reader((await request.text('utf-8')).splitlines()[1:])
-                      if stop[0] == route_id[0]
-                      and stop[1] == ('DT' if route_id[1] == 'outbound' else 'UT')]
-
-    if len(stops_) == 0:
+    route, direction, branch = (route_id.split('_') + [None])[:3]
+    if (stops_ := (await _STATIONS.load(session)).index.get((route, direction, branch))) is None:
         raise KeyError('route not exists')
 
-    locations = await asyncio.gather(
-        *[search_location(f'\u6e2f\u9435{s[4]}\u7ad9', session) for s in stops_])
+    locations = await search_locations([f'\u6e2f\u9435{s[4]}\u7ad9' for s in stops_], session)
     return ({
         'id': s[2],
         'seq': int(s[6].removesuffix('.00')),
@@ -81,45 +67,92 @@ async def stops(route_id: str, *, session: aiohttp.ClientSession) -> Generator[t
     } for i, s in enumerate(stops_))
 
 
-@ ensure_session
+@ensure_session
+async def prefill_locations(*, session: aiohttp.ClientSession) -> int:
+    '''Geocode every station into the on-disk geocoding cache.
+
+    Returns:
+        Number of stations geocoded.
+    '''
+    names = {row[4] for row in (await _STATIONS.load(session)).rows}
+    await search_locations([f'\u6e2f\u9435{name}\u7ad9' for name in names], session)
+    return len(names)
+
+
+@ensure_session
+async def stop_locations(*, session: aiohttp.ClientSession) -> list[t.StopLocation]:
+    '''Get the (ID, name, location) of every station, geocoding those not cached yet.'''
+    stations = {row[2]: row for row in (await _STATIONS.load(session)).rows}
+    locations = await search_locations(
+        [f'\u6e2f\u9435{s[4]}\u7ad9' for s in stations.values()], session)
+    return [(sid, {'tc': s[4], 'en': s[5]}, locations[i])
+            for i, (sid, s) in enumerate(stations.items())]
+
+
+@ensure_session
 async def etas(route_id: str,
                stop_id: str,
                language: t.Language = 'tc',
                *,
                session: aiohttp.ClientSession) -> t.Etas:
-    route, direction, _ = route_id.split('_')
+    try:
+        response = await _fetch_etas(_eta_endpoint(route_id, stop_id, language), session)
+    except CircuitOpenError:
+        return error_eta('api-error', language=language)
+    return _parse_etas(response, route_id, stop_id, language)
+
+
+def _eta_endpoint(route_id: str, stop_id: str, language: t.Language) -> tuple[str, ...]:
+    return route_id.split('_')[0], stop_id, language
+
+
+def _generated_at(response: dict) -> Optional[datetime]:
+    return datetime.fromisoformat(response['curr_time'])
+
+
+@ETAS.cached('mtr', _generated_at)
+@single_flight
+async def _fetch_etas(endpoint: tuple[str, ...], session: aiohttp.ClientSession) -> dict:
+    line, station, language = endpoint
+    async with guarded(session.get,
+                       'https://rt.data.gov.hk/v1/transport/mtr/getSchedule.php',
+                       'mtr.eta',
+                       params={
+                           'line': line,
+                           'sta': station,
+                           'lang': language
+                       }) as request:
+        return await request.json()
+
+
+@timed('mtr.eta')
+def _parse_etas(response: dict,
+                route_id: str,
+                stop_id: str,
+                language: t.Language) -> t.Etas:
+    route, direction, *_ = route_id.split('_')
     direction = 'DOWN' if direction == 'outbound' else 'UP'
 
-    async with session.get('https://rt.data.gov.hk/v1/transport/mtr/getSchedule.php',
-                           params={
-                               'line': route,
-                               'sta': stop_id,
-                               'lang': language
-                           }) as request:
-        response = await request.json()
-
     if len(response) == 0:
-        return error_eta('api-error')
+        return error_eta('api-error', language=language)
     if response.get('status', 0) == 0:
         if 'suspended' in response['message']:
-            return error_eta(response['message'])
+            return error_eta(response['message'], language=language)
         if response.get('url') is not None:
-            return error_eta('ss-effect')
-        return error_eta('api-error')
+            return error_eta('ss-effect', language=language)
+        return error_eta('api-error', language=language)
 
     etas_ = []
-    timestamp = datetime.fromisoformat(response['curr_time'])\
-        .astimezone(pytz.timezone('Asia/Hong_kong'))
+    timestamp = datetime.fromtimestamp(epoch(response['curr_time']), HKT)
 
     for entry in response['data'][f'{route}-{stop_id}'].get(direction, []):
-        eta_dt = datetime.fromisoformat(entry['time'])\
-            .astimezone(pytz.timezone('Asia/Hong_kong'))
+        eta_dt = datetime.fromtimestamp(epoch(entry['time']), HKT)
         etas_.append({
             'eta': dt_to_8601(eta_dt),
             'is_arriving': (eta_dt - timestamp).total_seconds() < 90,
             'is_scheduled': False,
             'extras': {
-                'destination': entry['dest'],
+                'destinaion': entry['dest'],
                 'varient': _varient_text(entry.get('route'), language),
                 'platform': entry['plat'],
                 'car_length': None
@@ -128,7 +161,7 @@ async def etas(route_id: str,
         })
 
     if len(etas_) == 0:
-        return error_eta('empty')
+        return error_eta('empty', language=language)
     return {
         'timestamp': dt_to_8601(timestamp),
         'message': None,
@@ -136,6 +169,42 @@ async def etas(route_id: str,
     }
 
 
+@timed('mtr.eta')
+def _parse_compact(response: dict,
+                   route_id: str,
+                   stop_id: str,
+                   language: t.Language) -> t.CompactEtas:
+    route, direction, *_ = route_id.split('_')
+    direction = 'DOWN' if direction == 'outbound' else 'UP'
+
+    if len(response) == 0:
+        return error_compact('api-error')
+    if response.get('status', 0) == 0:
+        if 'suspended' in response['message']:
+            return error_compact(response['message'])
+        if response.get('url') is not None:
+            return error_compact('ss-effect')
+        return error_compact('api-error')
+
+    timestamp = epoch(response['curr_time'])
+    etas_ = []
+    for entry in response['data'][f'{route}-{stop_id}'].get(direction, []):
+        eta_ts = epoch(entry['time'])
+        etas_.append(t.CompactEta(
+            eta_ts,
+            eta_ts - timestamp < 90,
+            False,
+            intern(entry['dest']),
+            _varient_text(entry.get('route'), language),
+            intern(entry['plat']),
+            None,
+            None))
+
+    if len(etas_) == 0:
+        return error_compact('empty')
+    return t.CompactEtas(timestamp, None, tuple(etas_))
+
+
 def _varient_text(val: Optional[str], language: t.Language):
     if val == 'RAC':
         return '\u7d93\u99ac\u5834' if language == 'tc' else 'Via Racecourse'
@@ -1,15 +1,19 @@
+import time
 from datetime import datetime
-from typing import Generator
+from typing import Generator, Optional
 
 import aiohttp
-import bs4
-import pytz
 
 from . import t
-from ._utils import dt_to_8601, ensure_session, error_eta, ua_header
+from ._cache import ETAS, STOP_DETAILS, cached_routes, cached_stop_locations
+from ._metrics import client_session, timed
+from ._resilience import CircuitOpenError, guarded
+from ._utils import (HKT, dt_to_8601, ensure_session, epoch, error_compact, error_eta,
+                     intern, single_flight, ua_header)
 
 
 @ensure_session
+@cached_routes('nlb')
 async def routes(*, session: aiohttp.ClientSession) -> dict[str, t.Route]:
     def description(route: dict[str,]):
         descr = {}
@@ -20,13 +24,22 @@ async def routes(*, session: aiohttp.ClientSession) -> dict[str, t.Route]:
                     break
         return descr or None
 
+    # parsing the route page is the only use of bs4
+    import bs4  # pylint: disable=import-outside-toplevel
+
     descriptions = {'e': {}, 'c': {}}
-    async with aiohttp.ClientSession(headers=ua_header()) as sess_cua:
+    # its own cookies keep the language setting, the connections are the caller's
+    async with client_session(headers=ua_header(),
+                              connector=session.connector,
+                              connector_owner=False) as sess_cua:
         for lc in ('e', 'c'):
-            async with sess_cua.get(
-                    f'https://www.nlb.com.hk/language/set/{"en" if lc == "e" else "zh"}'):
+            async with guarded(sess_cua.get,
+                               f'https://www.nlb.com.hk/language/set/{"en" if lc == "e" else "zh"}',
+                               'nlb.descriptions'):
                 pass
-            async with sess_cua.get('https://www.nlb.com.hk/route') as request:
+            async with guarded(sess_cua.get,
+                               'https://www.nlb.com.hk/route',
+                               'nlb.descriptions') as request:
                 bs = bs4.BeautifulSoup(await request.text(), "html.parser")
 
             for tr in bs.select('table.property-table tr')[1:]:
@@ -39,8 +52,9 @@ async def routes(*, session: aiohttp.ClientSession) -> dict[str, t.Route]:
                 })
 
     routes_ = {}
-    async with session.get(
-            'https://rt.data.gov.hk/v2/transport/nlb/route.php?action=list') as request:
+    async with guarded(session.get,
+                       'https://rt.data.gov.hk/v2/transport/nlb/route.php?action=list',
+                       'nlb.routes') as request:
         for route in (await request.json())['routes']:
             routes_.setdefault(route['routeNo'],
                                {'outbound': [], 'inbound': []})
@@ -82,11 +96,17 @@ async def routes(*, session: aiohttp.ClientSession) -> dict[str, t.Route]:
 @ensure_session
 async def stops(route_id: str, *, session: aiohttp.ClientSession) -> Generator[t.Stop, None, None]:
     # pylint: disable=line-too-long
-    async with session.get(
-            f'https://rt.data.gov.hk/v2/transport/nlb/stop.php?action=list&routeId={route_id.split("_")[-1]}') as request:
+    async with guarded(
+            session.get,
+            f'https://rt.data.gov.hk/v2/transport/nlb/stop.php?action=list&routeId={route_id.split("_")[-1]}',
+            'nlb.stops') as request:
         if len(stops_ := (await request.json())['stops']) == 0:
             raise KeyError('route not exists')
 
+    STOP_DETAILS.update((('nlb', stop['stopId']), {
+        'name': {'tc': stop['stopName_c'], 'en': stop['stopName_e']},
+        'location': (stop['latitude'], stop['longitude'])
+    }) for stop in stops_)
     return ({
         'id': stop['stopId'],
         'seq': idx,
@@ -98,33 +118,69 @@ async def stops(route_id: str, *, session: aiohttp.ClientSession) -> Generator[t
     } for idx, stop in enumerate(stops_))
 
 
+async def stop_locations(*, session: aiohttp.ClientSession = None) -> list[t.StopLocation]:
+    '''Get the (ID, name, location) of the stops of the routes fetched so far.
+
+    NLB only lists the stops of one route at a time, see `stops()`.
+    '''
+    # pylint: disable=unused-argument
+    return cached_stop_locations('nlb')
+
+
 @ensure_session
 async def etas(route_id: str,
                stop_id: str,
                language: t.Language = 'tc',
                *,
                session: aiohttp.ClientSession) -> t.Etas:
-    async with session.get('https://rt.data.gov.hk/v2/transport/nlb/stop.php',
-                           params={
-                               'action': 'estimatedArrivals',
-                               'routeId': route_id.split('_')[-1],
-                               'stopId': stop_id,
-                               'language': language,
-                           }) as request:
-        response = await request.json()
-
+    try:
+        response = await _fetch_etas(_eta_endpoint(route_id, stop_id, language), session)
+    except CircuitOpenError:
+        return error_eta('api-error', language=language)
+    return _parse_etas(response, route_id, stop_id, language)
+
+
+def _eta_endpoint(route_id: str, stop_id: str, language: t.Language) -> tuple[str, ...]:
+    return route_id.split('_')[-1], stop_id, language
+
+
+def _generated_at(_response: dict) -> Optional[datetime]:
+    # the responses carry no generation time
+    return None
+
+
+@ETAS.cached('nlb', _generated_at)
+@single_flight
+async def _fetch_etas(endpoint: tuple[str, ...], session: aiohttp.ClientSession) -> dict:
+    route, stop_id, language = endpoint
+    async with guarded(session.get,
+                       'https://rt.data.gov.hk/v2/transport/nlb/stop.php',
+                       'nlb.eta',
+                       params={
+                           'action': 'estimatedArrivals',
+                           'routeId': route,
+                           'stopId': stop_id,
+                           'language': language,
+                       }) as request:
+        return await request.json()
+
+
+@timed('nlb.eta')
+def _parse_etas(response: dict,
+                route_id: str,
+                stop_id: str,
+                language: t.Language) -> t.Etas:
     if len(response) == 0:
         # incorrect parameter will result in a empty json response
-        return error_eta('api-error')
+        return error_eta('api-error', language=language)
     if not response.get('estimatedArrivals', []):
-        return error_eta('empty')
+        return error_eta('empty', language=language)
 
     etas_ = []
-    timestamp = datetime.now().replace(tzinfo=pytz.timezone('Etc/GMT-8'))
+    timestamp = datetime.now(HKT).replace(microsecond=0)
 
     for eta in response['estimatedArrivals']:
-        eta_dt = datetime.fromisoformat(eta['estimatedArrivalTime']) \
-            .astimezone(pytz.timezone('Asia/Hong_kong'))
+        eta_dt = datetime.fromtimestamp(epoch(eta['estimatedArrivalTime']), HKT)
 
         etas_.append({
             'eta': dt_to_8601(eta_dt),
@@ -145,3 +201,29 @@ async def etas(route_id: str,
         'message': None,
         'etas': etas_
     }
+
+
+@timed('nlb.eta')
+def _parse_compact(response: dict,
+                   route_id: str,
+                   stop_id: str,
+                   language: t.Language) -> t.CompactEtas:
+    if len(response) == 0:
+        return error_compact('api-error')
+    if not response.get('estimatedArrivals', []):
+        return error_compact('empty')
+
+    timestamp = int(time.time())
+    etas_ = []
+    for eta in response['estimatedArrivals']:
+        eta_ts = epoch(eta['estimatedArrivalTime'])
+        etas_.append(t.CompactEta(
+            eta_ts,
+            eta_ts - timestamp < 60,
+            not (eta.get('departed') == '1' and eta.get('noGPS') == '1'),
+            None,
+            intern(eta.get('routeVariantName')),
+            None,
+            None,
+            None))
+    return t.CompactEtas(timestamp, None, tuple(etas_))
@@ -1,4 +1,4 @@
-from typing import Literal, Optional, TypedDict
+from typing import Literal, NamedTuple, Optional, TypedDict
 
 
 Transport = Literal['ctb', 'kmb', 'lrt', 'lrtfeeder', 'nlb', 'mtr']
@@ -28,6 +28,25 @@ class Etas(TypedDict):
     etas: Optional[Eta]
 
 
+class CompactEta(NamedTuple):
+    '''An ETA without formatting, times are seconds since epoch.'''
+    eta: Optional[int]
+    is_arriving: bool
+    is_scheduled: bool
+    destination: Optional[str]
+    varient: Optional[str]
+    platform: Optional[str]
+    car_length: Optional[int]
+    remark: Optional[str]
+
+
+class CompactEtas(NamedTuple):
+    '''`Etas` without formatting, `message` is an error code (e.g. `empty`) or upstream text.'''
+    timestamp: int
+    message: Optional[str]
+    etas: Optional[tuple[CompactEta, ...]]
+
+
 class Route(TypedDict):
     class Service(TypedDict):
         id: str
@@ -40,6 +59,10 @@ class Route(TypedDict):
     inbound: list[Service]
 
 
+# (ID, name, (latitude, longitude))
+StopLocation = tuple[str, dict[Language, str], tuple[float, float]]
+
+
 class Stop(TypedDict):
     id: str
     seq: int